@@ -0,0 +1,30 @@
+"""Add processing fingerprints
+
+Revision ID: 3f4b5d6e7a81
+Revises: 19c37eae5bb2
+Create Date: 2026-10-18 10:12:31.402518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f4b5d6e7a81'
+down_revision = '19c37eae5bb2'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    op.add_column('layer', sa.Column('checksum', sa.String(), nullable=True), schema='processing')
+    op.add_column('hazardset', sa.Column('fingerprint', sa.String(), nullable=True), schema='processing')
+    op.add_column('hazardset', sa.Column('divisions_fingerprint', sa.String(), nullable=True), schema='processing')
+    op.add_column('output', sa.Column('fingerprint', sa.String(), nullable=True), schema='processing')
+
+
+def downgrade(engine_name):
+    op.drop_column('output', 'fingerprint', schema='processing')
+    op.drop_column('hazardset', 'divisions_fingerprint', schema='processing')
+    op.drop_column('hazardset', 'fingerprint', schema='processing')
+    op.drop_column('layer', 'checksum', schema='processing')
@@ -0,0 +1,24 @@
+"""Add column hazardset.decided
+
+Revision ID: 5a9c2e8f1b37
+Revises: 3f4b5d6e7a81
+Create Date: 2026-10-18 11:02:47.118305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a9c2e8f1b37'
+down_revision = '3f4b5d6e7a81'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    op.add_column('hazardset', sa.Column('decided', sa.DateTime(), nullable=True), schema='processing')
+
+
+def downgrade(engine_name):
+    op.drop_column('hazardset', 'decided', schema='processing')
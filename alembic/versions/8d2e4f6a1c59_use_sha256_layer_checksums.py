@@ -0,0 +1,27 @@
+"""Use SHA-256 layer checksums
+
+Revision ID: 8d2e4f6a1c59
+Revises: 5a9c2e8f1b37
+Create Date: 2026-10-18 14:21:09.537114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4f6a1c59'
+down_revision = '5a9c2e8f1b37'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade(engine_name):
+    # SHA-1 checksums are replaced by SHA-256 ones, keys of the raster
+    # store. Next download run moves existing files in the store.
+    op.execute('UPDATE processing.layer '
+               'SET checksum = NULL, downloaded = false')
+
+
+def downgrade(engine_name):
+    op.execute('UPDATE processing.layer '
+               'SET checksum = NULL, downloaded = false')
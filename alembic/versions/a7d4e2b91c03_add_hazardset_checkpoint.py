@@ -0,0 +1,28 @@
+"""Add hazardset checkpoint
+
+Revision ID: a7d4e2b91c03
+Revises: f3a1c5d08e62
+Create Date: 2026-10-18 20:14:52.630417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a7d4e2b91c03'
+down_revision = 'f3a1c5d08e62'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    op.add_column('hazardset', sa.Column('checkpoint_key', sa.String(), nullable=True), schema='processing')
+    op.add_column('hazardset', sa.Column('checkpoint_id', sa.Integer(), nullable=True), schema='processing')
+    op.add_column('hazardset', sa.Column('checkpoint_fingerprint', sa.String(), nullable=True), schema='processing')
+
+
+def downgrade(engine_name):
+    op.drop_column('hazardset', 'checkpoint_fingerprint', schema='processing')
+    op.drop_column('hazardset', 'checkpoint_id', schema='processing')
+    op.drop_column('hazardset', 'checkpoint_key', schema='processing')
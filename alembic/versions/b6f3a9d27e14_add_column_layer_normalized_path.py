@@ -0,0 +1,24 @@
+"""Add column layer.normalized_path
+
+Revision ID: b6f3a9d27e14
+Revises: 8d2e4f6a1c59
+Create Date: 2026-10-18 15:03:52.280461
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b6f3a9d27e14'
+down_revision = '8d2e4f6a1c59'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    op.add_column('layer', sa.Column('normalized_path', sa.String(), nullable=True), schema='processing')
+
+
+def downgrade(engine_name):
+    op.drop_column('layer', 'normalized_path', schema='processing')
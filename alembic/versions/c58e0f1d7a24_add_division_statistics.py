@@ -0,0 +1,41 @@
+"""Add division statistics
+
+Revision ID: c58e0f1d7a24
+Revises: a7d4e2b91c03
+Create Date: 2026-10-18 21:03:11.482905
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c58e0f1d7a24'
+down_revision = 'a7d4e2b91c03'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade(engine_name):
+    op.create_table('statistics',
+    sa.Column('hazardset_id', sa.String(), nullable=False),
+    sa.Column('admin_id', sa.Integer(), nullable=False),
+    sa.Column('layer', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('minimum', sa.Float(), nullable=True),
+    sa.Column('maximum', sa.Float(), nullable=True),
+    sa.Column('values', postgresql.ARRAY(sa.Float()), nullable=True),
+    sa.Column('counts', postgresql.ARRAY(sa.Integer()), nullable=True),
+    sa.Column('mask', sa.Boolean(), nullable=False),
+    sa.Column('upper', postgresql.ARRAY(sa.Float(), dimensions=2), nullable=True),
+    sa.Column('lower', postgresql.ARRAY(sa.Float(), dimensions=2), nullable=True),
+    sa.ForeignKeyConstraint(['admin_id'], [u'datamart.administrativedivision.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['hazardset_id'], [u'processing.hazardset.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('hazardset_id', 'admin_id', 'layer'),
+    schema='processing'
+    )
+
+
+def downgrade(engine_name):
+    op.drop_table('statistics', schema='processing')
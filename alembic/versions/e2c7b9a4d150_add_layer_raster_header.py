@@ -0,0 +1,41 @@
+"""Add layer raster header
+
+Revision ID: e2c7b9a4d150
+Revises: b6f3a9d27e14
+Create Date: 2026-10-18 17:41:09.518224
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2c7b9a4d150'
+down_revision = 'b6f3a9d27e14'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade(engine_name):
+    op.add_column('layer', sa.Column('width', sa.Integer(), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('height', sa.Integer(), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('transform', postgresql.ARRAY(sa.Float()), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('bounds', postgresql.ARRAY(sa.Float()), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('dtype', sa.String(), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('nodata', sa.Float(), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('block_width', sa.Integer(), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('block_height', sa.Integer(), nullable=True), schema='processing')
+    op.add_column('layer', sa.Column('file_size', sa.BigInteger(), nullable=True), schema='processing')
+
+
+def downgrade(engine_name):
+    op.drop_column('layer', 'file_size', schema='processing')
+    op.drop_column('layer', 'block_height', schema='processing')
+    op.drop_column('layer', 'block_width', schema='processing')
+    op.drop_column('layer', 'nodata', schema='processing')
+    op.drop_column('layer', 'dtype', schema='processing')
+    op.drop_column('layer', 'bounds', schema='processing')
+    op.drop_column('layer', 'transform', schema='processing')
+    op.drop_column('layer', 'height', schema='processing')
+    op.drop_column('layer', 'width', schema='processing')
@@ -0,0 +1,48 @@
+"""Add region membership
+
+Revision ID: e91b4f0c6d38
+Revises: c58e0f1d7a24
+Create Date: 2026-10-18 22:36:40.118542
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e91b4f0c6d38'
+down_revision = 'c58e0f1d7a24'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+
+
+def upgrade(engine_name):
+    op.create_table('regionmembership',
+    sa.Column('region_id', sa.Integer(), nullable=False),
+    sa.Column('admin_id', sa.Integer(), nullable=False),
+    sa.Column('bbox', geoalchemy2.types.Geometry(srid=4326), nullable=False),
+    sa.ForeignKeyConstraint(['admin_id'], [u'datamart.administrativedivision.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['region_id'], [u'datamart.enum_region.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('region_id', 'admin_id'),
+    schema='processing'
+    )
+    op.create_index(op.f('ix_processing_regionmembership_admin_id'), 'regionmembership', ['admin_id'], unique=False, schema='processing')
+    op.create_index('idx_regionmembership_bbox', 'regionmembership', ['bbox'], unique=False, schema='processing', postgresql_using='gist')
+    op.execute('''
+INSERT INTO processing.regionmembership (region_id, admin_id, bbox)
+SELECT DISTINCT rel.region_id, reg.id, ST_Envelope(reg.geom)
+FROM datamart.administrativedivision reg
+JOIN datamart.enum_adminleveltype lt ON lt.id = reg.leveltype_id
+JOIN datamart.administrativedivision pro ON pro.code = reg.parent_code
+JOIN datamart.administrativedivision cou ON cou.code = pro.parent_code
+JOIN datamart.rel_region_administrativedivision rel
+    ON rel.administrativedivision_id = cou.id
+WHERE lt.mnemonic = 'REG' AND reg.geom IS NOT NULL;
+''')
+
+
+def downgrade(engine_name):
+    op.drop_index('idx_regionmembership_bbox', table_name='regionmembership', schema='processing')
+    op.drop_index(op.f('ix_processing_regionmembership_admin_id'), table_name='regionmembership', schema='processing')
+    op.drop_table('regionmembership', schema='processing')
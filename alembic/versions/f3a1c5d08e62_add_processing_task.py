@@ -0,0 +1,41 @@
+"""Add processing task
+
+Revision ID: f3a1c5d08e62
+Revises: e2c7b9a4d150
+Create Date: 2026-10-18 19:02:37.114851
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3a1c5d08e62'
+down_revision = 'e2c7b9a4d150'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade(engine_name):
+    op.create_table('task',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('hazardset_id', sa.String(), nullable=False),
+    sa.Column('admin_ids', postgresql.ARRAY(sa.Integer()), nullable=False),
+    sa.Column('fingerprint', sa.String(), nullable=True),
+    sa.Column('divisions_fingerprint', sa.String(), nullable=True),
+    sa.Column('worker', sa.String(), nullable=True),
+    sa.Column('heartbeat', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('done', sa.Boolean(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['hazardset_id'], [u'processing.hazardset.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    schema='processing'
+    )
+    op.create_index(op.f('ix_processing_task_hazardset_id'), 'task', ['hazardset_id'], unique=False, schema='processing')
+
+
+def downgrade(engine_name):
+    op.drop_index(op.f('ix_processing_task_hazardset_id'), table_name='task', schema='processing')
+    op.drop_table('task', schema='processing')
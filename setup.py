@@ -81,9 +81,12 @@ setup(name='thinkhazard',
               "import_contacts = thinkhazard.scripts.import:import_contacts",
               "harvest = thinkhazard.processing.harvesting:Harvester.run",
               "download = thinkhazard.processing.downloading:Downloader.run",
+              "normalize = thinkhazard.processing.normalizing:Normalizer.run",
               "complete = thinkhazard.processing.completing:Completer.run",
               "process = thinkhazard.processing.processing:Processor.run",
               "decision_tree = thinkhazard.processing.decisiontree:DecisionMaker.run",
+              "pipeline = thinkhazard.processing.pipeline:Pipeline.run",
+              "simulate = thinkhazard.processing.simulation:Simulator.run",
               "publish = thinkhazard.scripts.publish:main",
               "importpo = thinkhazard.scripts.importpo:main",
           ],
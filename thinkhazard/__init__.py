@@ -101,6 +101,7 @@ def main(global_config, **settings):
 
         config.add_route('admin_hazardsets', '/hazardsets')
         config.add_route('admin_hazardset', '/hazardset/{hazardset}')
+        config.add_route('admin_simulation', '/simulation')
 
         config.add_route('admin_contacts', '/contacts')
         config.add_route('admin_contact_new', '/contact/new')
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+"""Time the classification rules of a hazard type alone, without reading
+rasters: the former walk of the settings for every level of every window,
+and the evaluation of the compiled classification plan, on random windows
+of pixels held in memory.
+
+usage: python -m thinkhazard.benchmarks.classification <config_uri>
+       [hazardtype=FL_void] [windows=10000] [size=32]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from collections import namedtuple
+from pyramid.paster import setup_logging
+from pyramid.scripts.common import parse_vars
+
+from ..settings import load_full_settings
+from ..processing.classification import (
+    LEVELS,
+    compile_plan,
+    )
+from ..processing.processing import Processor
+
+
+# Attributes of the layers used by the classification rules
+LayerSettings = namedtuple('LayerSettings', ['local', 'hazardunit'])
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [hazardtype=FL_void] [windows=10000] '
+          '[size=32]\n'
+          '(example: "%s development.ini hazardtype=DG")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = load_full_settings(config_uri, options=options)
+
+    hazardtype = options.get('hazardtype', 'FL_void')
+    count = int(options.get('windows', 10000))
+    size = int(options.get('size', 32))
+
+    processor = Processor()
+    processor.settings = settings
+    processor.type_settings = settings['hazard_types'][hazardtype]
+    layers = dict((key, LayerSettings(False, unit(processor.type_settings)))
+                  for key in LEVELS + ('mask',))
+    plan = compile_plan(processor.type_settings, layers)
+    if plan.preprocessed:
+        windows = synthetic_windows(count, size,
+                                    sorted(plan.lookup.weights.keys()),
+                                    discrete=True)
+        methods = (('plan', lambda: classify_values(plan, windows)),)
+    else:
+        windows = synthetic_windows(count, size,
+                                    sorted(plan.thresholds.values()))
+        methods = (
+            ('settings', lambda: classify_settings(processor, hazardtype,
+                                                   layers, windows)),
+            ('plan', lambda: classify_plan(plan, windows)),
+        )
+
+    results = []
+    for name, classify in methods:
+        chrono = time.time()
+        results.append(classify())
+        duration = time.time() - chrono
+        print '{:<8} {} windows in {:.2f}s, {:.0f} windows/s'.format(
+            name, count, duration, count / duration if duration else 0)
+    assert all(result == results[0] for result in results)
+
+
+def unit(type_settings):
+    """First unit found in the thresholds settings"""
+    thresholds = type_settings.get('thresholds')
+    if thresholds is None:
+        return None
+    while isinstance(thresholds.values()[0], dict):
+        thresholds = thresholds.get('global', thresholds.get(
+            'HIG', thresholds.values()[0]))
+    return sorted(thresholds.keys())[0]
+
+
+def synthetic_windows(count, size, values, discrete=False):
+    """Random windows of pixels around the given values, or drawn from them
+    when discrete, as lists of arrays for each level and the mask"""
+    random = np.random.RandomState(0)
+    high = 2 * max([abs(value) for value in values] + [1])
+    shape = (size, size)
+
+    def pixels():
+        if discrete:
+            return random.choice(values + [0], size=shape)
+        return random.uniform(0, high, shape)
+
+    return [[np.ma.masked_array(pixels(), random.uniform(0, 1, shape) < 0.1)
+             for key in LEVELS + ('mask',)]
+            for i in xrange(0, count)]
+
+
+def classify_settings(processor, hazardtype, layers, windows):
+    """Former rules, looked up in the settings for each window"""
+    levels = []
+    for window in windows:
+        type_settings = processor.type_settings
+        inverted = ('inverted_comparison' in type_settings and
+                    type_settings['inverted_comparison'])
+        mask = None
+        if 'mask_return_period' in type_settings:
+            threshold = processor.get_threshold(hazardtype, False, u'MASK',
+                                                layers['mask'].hazardunit)
+            mask = window[3] < threshold if inverted else \
+                window[3] > threshold
+        levels.append(None)
+        for i, level in enumerate(LEVELS):
+            threshold = processor.get_threshold(hazardtype, False, level,
+                                                layers[level].hazardunit)
+            data = window[i] < threshold if inverted else \
+                window[i] > threshold
+            if mask is not None:
+                data.mask = np.ma.getmaskarray(data) | mask.filled(False)
+            if data.any():
+                levels[-1] = level
+                break
+    return levels
+
+
+def classify_plan(plan, windows):
+    """Rules evaluated from the compiled plan"""
+    levels = []
+    for window in windows:
+        mask = None
+        if plan.mask_threshold is not None:
+            mask = plan.masked(window[3]).filled(False)
+        levels.append(None)
+        for i, (level, threshold) in enumerate(plan.levels):
+            data = plan.exceeds(window[i], threshold)
+            if mask is not None:
+                data.mask = np.ma.getmaskarray(data) | mask
+            if data.any():
+                levels[-1] = level
+                break
+    return levels
+
+
+def classify_values(plan, windows):
+    """Highest level weight of the values of each window"""
+    return [plan.lookup.max_weight(window[0]) for window in windows]
+
+
+if __name__ == '__main__':
+    main()
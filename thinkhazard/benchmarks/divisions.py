@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the iteration over administrative divisions with LIMIT/OFFSET
+paging of mapped objects and with a server side cursor of tuples, on
+synthetic divisions inserted in a transaction which is rolled back.
+
+usage: python -m thinkhazard.benchmarks.divisions <config_uri>
+       [count=50000] [vertices=64]
+"""
+
+import os
+import sys
+import time
+import transaction
+from shapely import wkb
+from geoalchemy2.shape import to_shape
+from sqlalchemy import (
+    engine_from_config,
+    func,
+    )
+from pyramid.paster import setup_logging
+from pyramid.scripts.common import parse_vars
+
+from ..settings import load_full_settings
+from ..models import (
+    DBSession,
+    AdministrativeDivision,
+    AdminLevelType,
+    )
+from ..processing.processing import (
+    BATCH_SIZE,
+    division_batches,
+    spatial_order,
+    )
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [count=50000] [vertices=64]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = load_full_settings(config_uri, options=options)
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+    count = int(options.get('count', 50000))
+    vertices = int(options.get('vertices', 64))
+
+    try:
+        code = populate(count, vertices)
+        query = DBSession.query(AdministrativeDivision) \
+            .filter(AdministrativeDivision.code >= code) \
+            .order_by(spatial_order(AdministrativeDivision.geom),
+                      AdministrativeDivision.id)
+
+        for name, iterate in (('offset', iterate_offset),
+                              ('cursor', iterate_cursor)):
+            chrono = time.time()
+            rows = iterate(query)
+            duration = time.time() - chrono
+            print '{:<8} {} divisions in {:.1f}s, {:.0f} divisions/s'.format(
+                name, rows, duration, rows / duration if duration else 0)
+    finally:
+        transaction.abort()
+
+
+def populate(count, vertices):
+    """Insert a grid of synthetic divisions, return their first code"""
+    code = (DBSession.query(func.max(AdministrativeDivision.code))
+            .scalar() or 0) + 1
+    side = int(count ** 0.5) + 1
+    print 'Creating {} synthetic divisions'.format(count)
+    DBSession.execute('''
+INSERT INTO datamart.administrativedivision (code, leveltype_id, name, geom)
+SELECT
+    :code + i,
+    :leveltype_id,
+    'Synthetic division ' || i,
+    ST_Multi(ST_Buffer(
+        ST_SetSRID(ST_MakePoint(-180 + (i % :side + 0.5) * 360.0 / :side,
+                                -90 + (i / :side + 0.5) * 180.0 / :side),
+                   4326),
+        90.0 / :side,
+        :quad_segs))
+FROM generate_series(0, :count - 1) AS i
+''', {
+        'code': code,
+        'leveltype_id': AdminLevelType.get(u'REG').id,
+        'side': side,
+        'count': count,
+        'quad_segs': max(vertices // 4, 1)})
+    return code
+
+
+def iterate_offset(query):
+    """Former iteration of Processor.create_outputs"""
+    rows = 0
+    total = query.count()
+    query = query.limit(BATCH_SIZE)
+    for offset in xrange(0, total, BATCH_SIZE):
+        for admindiv in query.offset(offset):
+            to_shape(admindiv.geom)
+            DBSession.expunge(admindiv)
+            rows += 1
+    return rows
+
+
+def iterate_cursor(query):
+    rows = 0
+    for batch in division_batches(query):
+        for admin_id, code, name, geometry, fingerprint in batch:
+            wkb.loads(str(geometry))
+            rows += 1
+    return rows
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time the normalizing, completing, processing and decision tree steps on
+a synthetic hazardset made of generated GeoTIFFs and administrative
+divisions, and save the results as JSON. Rasters are generated strip
+organized, like GeoNode often serves them, and the throughput of windowed
+reads is compared before and after normalization.
+
+The decision tree is applied to the whole database, so run this against a
+dedicated database, like the tests one. Synthetic data are removed at the
+end.
+
+usage: python -m thinkhazard.benchmarks.pipeline <config_uri>
+       [hazardtype=EQ] [divisions=5000] [vertices=64]
+       [width=3600] [height=1800] [engine=polygon] [block_cache=0]
+       [division_index=false] [pyramid=false] [memory_budget=256]
+       [normalize=true] [reads=1000] [output=benchmark-<date>.json]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import resource
+import tempfile
+import platform
+import datetime
+import transaction
+import numpy as np
+import rasterio
+from affine import Affine
+from shapely.geometry import (
+    MultiPolygon,
+    Point,
+    )
+from geoalchemy2.shape import from_shape
+from sqlalchemy import (
+    engine_from_config,
+    event,
+    func,
+    )
+from pyramid.paster import setup_logging
+from pyramid.scripts.common import parse_vars
+
+from ..settings import load_full_settings
+from ..models import (
+    DBSession,
+    AdministrativeDivision,
+    AdminLevelType,
+    HazardLevel,
+    HazardSet,
+    HazardType,
+    Layer,
+    Output,
+    Region,
+    RegionMembership,
+    )
+from ..processing import BaseProcessor
+from ..processing.completing import Completer
+from ..processing.decisiontree import DecisionMaker
+from ..processing.normalizing import Normalizer
+from ..processing.outputwriter import OutputWriter
+from ..processing.processing import Processor
+
+
+HAZARDSET_ID = u'BENCHMARK'
+
+NODATA = -9999
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s tests.ini divisions=20000")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = load_full_settings(config_uri, options=options)
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+    params = {
+        'hazardtype': options.get('hazardtype', 'EQ'),
+        'divisions': int(options.get('divisions', 5000)),
+        'vertices': int(options.get('vertices', 64)),
+        'width': int(options.get('width', 3600)),
+        'height': int(options.get('height', 1800)),
+        'engine': options.get('engine', 'polygon'),
+        'block_cache': int(options.get('block_cache', 0)),
+        'division_index': options.get('division_index', 'false') == 'true',
+        'pyramid': options.get('pyramid', 'false') == 'true',
+        'memory_budget': int(options.get('memory_budget', 256)),
+        'normalize': options.get('normalize', 'true') == 'true',
+        'reads': int(options.get('reads', 1000)),
+    }
+    output = options.get('output', 'benchmark-{}.json'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+    settings['data_path'] = tempfile.mkdtemp()
+    timer = DatabaseTimer(engine)
+    try:
+        clean()
+        print 'Generating synthetic data'
+        populate(settings, params)
+
+        steps = []
+        reads = None
+
+        if params['normalize']:
+            normalizer = Normalizer()
+            normalizer.settings = settings
+            steps.append(measure('normalize', timer, params['divisions'],
+                                 normalize_layers, normalizer))
+            reads = compare_reads(normalizer, params)
+
+        completer = Completer()
+        completer.settings = settings
+        steps.append(measure('complete', timer, params['divisions'],
+                             completer.complete_hazardset, HAZARDSET_ID))
+
+        processor = Processor()
+        processor.settings = settings
+        processor.engine = params['engine']
+        processor.block_cache_size = params['block_cache'] * 1024 * 1024
+        processor.use_division_index = params['division_index']
+        processor.use_pyramid = params['pyramid']
+        processor.window_budget = params['memory_budget'] * 1024 * 1024
+        steps.append(measure('process', timer, params['divisions'],
+                             processor.process_hazardset, HAZARDSET_ID))
+
+        decision_maker = DecisionMaker()
+        decision_maker.settings = settings
+        steps.append(measure('decision_tree', timer, params['divisions'],
+                             decision_maker.do_execute))
+    finally:
+        transaction.abort()
+        clean()
+        shutil.rmtree(settings['data_path'])
+        timer.close()
+
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'params': params,
+        'versions': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'rasterio': rasterio.__version__,
+        },
+        'steps': steps,
+        'reads': reads,
+    }
+    for step in steps:
+        print ('{name:<14} {duration:8.2f}s {divisions_per_second:10.1f} '
+               'divisions/s  db {db_time:8.2f}s  cumulative peak RSS '
+               '{cumulative_peak_rss_mb:8.1f} MB'.format(**step))
+    if reads is not None:
+        for name in ('downloaded', 'normalized'):
+            print ('{:<14} {windows_per_second:10.1f} windows/s '
+                   '{mb_per_second:8.1f} MB/s'.format(
+                       name + ' reads', **reads[name]))
+        print 'read throughput gain x{:.2f}'.format(reads['gain'])
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'Results saved to {}'.format(output)
+
+
+def measure(name, timer, divisions, function, *args):
+    """Run one step in its own transaction and return its metrics"""
+    timer.reset()
+    chrono = time.time()
+    function(*args)
+    transaction.commit()
+    duration = time.time() - chrono
+    return {
+        'name': name,
+        'duration': duration,
+        'divisions_per_second': divisions / duration if duration else 0,
+        'db_time': timer.duration,
+        'cumulative_peak_rss_mb': peak_rss() / 1024.0,
+    }
+
+
+def normalize_layers(normalizer):
+    for layer in DBSession.query(HazardSet).get(HAZARDSET_ID).layers:
+        normalizer.normalize_layer(layer.geonode_id)
+
+
+def compare_reads(processor, params):
+    """Compare the throughput of random windowed reads, of the size of a
+    division, in downloaded and normalized rasters.
+    """
+    layers = DBSession.query(HazardSet).get(HAZARDSET_ID).layers
+    side = int(math.ceil(math.sqrt(params['divisions'])))
+    height = max(params['height'] // side, 1)
+    width = max(params['width'] // side, 1)
+    state = np.random.RandomState(0)
+    windows = []
+    for i in xrange(0, params['reads']):
+        row = state.randint(0, params['height'] - height + 1)
+        col = state.randint(0, params['width'] - width + 1)
+        windows.append(((row, row + height), (col, col + width)))
+
+    results = {}
+    for name, path in (('downloaded', processor.layer_path),
+                       ('normalized', processor.raster_path)):
+        size = 0
+        chrono = time.time()
+        with rasterio.drivers():
+            for layer in layers:
+                with rasterio.open(path(layer)) as reader:
+                    for window in windows:
+                        size += reader.read(1, window=window).nbytes
+        duration = time.time() - chrono
+        count = len(windows) * len(layers)
+        results[name] = {
+            'duration': duration,
+            'windows_per_second': count / duration if duration else 0,
+            'mb_per_second': size / 1048576.0 / duration if duration else 0,
+        }
+    results['gain'] = (results['downloaded']['duration'] /
+                       results['normalized']['duration']
+                       if results['normalized']['duration'] else 0)
+    return results
+
+
+def peak_rss():
+    """Peak resident set size in kB, of this process and its children,
+    since the start of the benchmark: ru_maxrss is never reset, so a step
+    only shows a new value when it uses more memory than the previous
+    ones"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class DatabaseTimer(object):
+    """Sum the time spent in the database by the statements of an engine,
+    and by the COPY of outputs.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.duration = 0.0
+        event.listen(engine, 'before_cursor_execute', self.before)
+        event.listen(engine, 'after_cursor_execute', self.after)
+
+        self.flush = OutputWriter.flush
+
+        def flush(writer):
+            # Statements run by the flush are included in its duration
+            duration = self.duration
+            chrono = time.time()
+            try:
+                self.flush(writer)
+            finally:
+                self.duration = duration + time.time() - chrono
+        OutputWriter.flush = flush
+
+    def before(self, conn, cursor, statement, parameters, context,
+               executemany):
+        conn.info.setdefault('benchmark_start', []).append(time.time())
+
+    def after(self, conn, cursor, statement, parameters, context,
+              executemany):
+        self.duration += time.time() - conn.info['benchmark_start'].pop()
+
+    def reset(self):
+        self.duration = 0.0
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.before)
+        event.remove(self.engine, 'after_cursor_execute', self.after)
+        OutputWriter.flush = self.flush
+
+
+def populate(settings, params):
+    hazardtype = HazardType.get(unicode(params['hazardtype']))
+    type_settings = settings['hazard_types'][hazardtype.mnemonic]
+
+    region = Region(
+        id=(DBSession.query(func.max(Region.id)).scalar() or 0) + 1,
+        name=u'Benchmark',
+        level=3)
+    DBSession.add(region)
+
+    code = (DBSession.query(func.max(AdministrativeDivision.code))
+            .scalar() or 0) + 1
+    country = AdministrativeDivision(
+        code=code,
+        leveltype_id=AdminLevelType.get(u'COU').id,
+        name=u'Benchmark country')
+    country.regions = [region]
+    province = AdministrativeDivision(
+        code=code + 1,
+        leveltype_id=AdminLevelType.get(u'PRO').id,
+        name=u'Benchmark province',
+        parent_code=code)
+    DBSession.add_all([country, province])
+    DBSession.flush()
+
+    DBSession.execute(
+        AdministrativeDivision.__table__.insert(),
+        [{'code': code + 2 + i,
+          'leveltype_id': AdminLevelType.get(u'REG').id,
+          'name': u'Benchmark division {}'.format(i),
+          'parent_code': code + 1,
+          'geom': from_shape(geometry, 4326)}
+         for i, geometry in enumerate(divisions(params['divisions'],
+                                                params['vertices']))])
+
+    hazardset = HazardSet(
+        id=HAZARDSET_ID,
+        hazardtype=hazardtype,
+        regions=[region])
+    DBSession.add(hazardset)
+
+    geonode_id = (DBSession.query(func.max(Layer.geonode_id))
+                  .scalar() or 0) + 1
+    now = datetime.datetime.now()
+    random = np.random.RandomState(0)
+    os.makedirs(os.path.join(settings['data_path'], 'hazardsets'))
+    # Raster headers are read at download time
+    downloader = BaseProcessor()
+    downloader.settings = settings
+    for level, mask, values, unit in layers(type_settings):
+        layer = Layer(
+            geonode_id=geonode_id,
+            hazardset=hazardset,
+            hazardlevel=HazardLevel.get(level) if level else None,
+            mask=mask,
+            hazardunit=unit,
+            data_lastupdated_date=now,
+            metadata_lastupdated_date=now,
+            download_url='/benchmark/{}.tif'.format(geonode_id),
+            calculation_method_quality=5,
+            scientific_quality=1,
+            local=False,
+            downloaded=True)
+        DBSession.add(layer)
+        geonode_id += 1
+        write_raster(os.path.join(settings['data_path'],
+                                  'hazardsets',
+                                  layer.filename()),
+                     params['width'], params['height'], values, random)
+        downloader.read_header(layer)
+
+    RegionMembership.refresh()
+    transaction.commit()
+
+
+def layers(type_settings):
+    """Yield (level, mask, values, unit) of the layers to generate, where
+    values is a function drawing pixel values.
+    """
+    if 'values' in type_settings:
+        choices = [0] + [value
+                         for values in type_settings['values'].values()
+                         for value in values]
+        yield (None, False,
+               lambda random, shape: random.choice(choices, size=shape),
+               None)
+        return
+
+    processor = Processor()
+    processor.settings = {'hazard_types': {'type': type_settings}}
+    unit = threshold_unit(type_settings['thresholds'])
+    for level in (u'HIG', u'MED', u'LOW'):
+        threshold = processor.get_threshold('type', False, level, unit)
+        yield (level, False,
+               lambda random, shape, threshold=threshold:
+                   random.uniform(0, 2 * threshold, size=shape),
+               unit)
+    if 'mask_return_period' in type_settings:
+        threshold = processor.get_threshold('type', False, u'MASK', unit)
+        yield (None, True,
+               lambda random, shape: random.uniform(0, 2 * threshold,
+                                                    size=shape),
+               unit)
+
+
+def threshold_unit(thresholds):
+    """First unit found in the thresholds settings"""
+    while isinstance(thresholds.values()[0], dict):
+        thresholds = thresholds.get('global', thresholds.get(
+            'HIG', thresholds.values()[0]))
+    return sorted(thresholds.keys())[0]
+
+
+def divisions(count, vertices):
+    """Yield a grid of disc shaped divisions covering the world"""
+    side = int(math.ceil(math.sqrt(count)))
+    width = 360.0 / side
+    height = 180.0 / side
+    for i in xrange(0, count):
+        x = -180 + (i % side + 0.5) * width
+        y = -90 + (i // side + 0.5) * height
+        yield MultiPolygon([
+            Point(x, y).buffer(min(width, height) / 2,
+                               max(vertices // 4, 1))])
+
+
+def write_raster(path, width, height, values, random):
+    affine = Affine(360.0 / width, 0.0, -180.0,
+                    0.0, -180.0 / height, 90.0)
+    with rasterio.open(path, 'w',
+                       driver='GTiff',
+                       width=width,
+                       height=height,
+                       count=1,
+                       dtype='float32',
+                       crs={'init': 'epsg:4326'},
+                       transform=affine,
+                       nodata=NODATA,
+                       compress='deflate') as dst:
+        rows = 256
+        for row in xrange(0, height, rows):
+            shape = (min(rows, height - row), width)
+            data = values(random, shape).astype(np.float32)
+            data[random.uniform(0, 1, shape) < 0.05] = NODATA
+            dst.write(data, 1, window=((row, row + shape[0]), (0, width)))
+
+
+def clean():
+    """Remove synthetic data of a previous run"""
+    DBSession.query(Output) \
+        .filter(Output.hazardset_id == HAZARDSET_ID) \
+        .delete(synchronize_session=False)
+    DBSession.query(Layer) \
+        .filter(Layer.hazardset_id == HAZARDSET_ID) \
+        .delete(synchronize_session=False)
+    hazardset = DBSession.query(HazardSet).get(HAZARDSET_ID)
+    if hazardset is not None:
+        hazardset.regions = []
+        DBSession.delete(hazardset)
+    regions = DBSession.query(Region).filter(Region.name == u'Benchmark')
+    for region in regions:
+        region.administrativedivisions = []
+        DBSession.delete(region)
+    DBSession.query(AdministrativeDivision) \
+        .filter(AdministrativeDivision.name.in_([u'Benchmark country',
+                                                 u'Benchmark province']) |
+                AdministrativeDivision.name.like(u'Benchmark division %')) \
+        .delete(synchronize_session=False)
+    transaction.commit()
+
+
+if __name__ == '__main__':
+    main()
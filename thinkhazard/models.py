@@ -23,10 +23,13 @@ import pytz
 from slugify import slugify
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
+    Float,
     ForeignKey,
+    func,
     inspect,
     Integer,
     String,
@@ -36,6 +39,7 @@ from sqlalchemy import (
     select,
     )
 from sqlalchemy.schema import MetaData
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -556,6 +560,18 @@ class HazardSet(Base):
     processed = Column(DateTime)
     # If not processed, reason why
     processing_error = Column(String)
+    # fingerprints of the processing inputs (layers and settings) and of the
+    # administrative divisions, used by incremental processing
+    fingerprint = Column(String)
+    divisions_fingerprint = Column(String)
+    # key of the last administrative division (spatial order and id) whose
+    # output has been committed by an unfinished processing, and fingerprint
+    # of its inputs, used to resume it
+    checkpoint_key = Column(String)
+    checkpoint_id = Column(Integer)
+    checkpoint_fingerprint = Column(String)
+    # date the outputs were last used by the decision tree
+    decided = Column(DateTime)
 
     hazardtype = relationship('HazardType', backref="hazardsets")
 
@@ -633,6 +649,25 @@ class Layer(Base):
     # when the geotiff file has been downloaded
     downloaded = Column(Boolean, nullable=False, default=False)
 
+    # SHA-256 checksum of the downloaded geotiff file, its key in the
+    # raster store
+    checksum = Column(String)
+    # tiled copy of the downloaded geotiff file, relative to data_path
+    normalized_path = Column(String)
+
+    # header of the downloaded geotiff file, read once it is downloaded
+    width = Column(Integer)
+    height = Column(Integer)
+    # affine transform coefficients (a, b, c, d, e, f)
+    transform = Column(ARRAY(Float))
+    # (left, bottom, right, top)
+    bounds = Column(ARRAY(Float))
+    dtype = Column(String)
+    nodata = Column(Float)
+    block_width = Column(Integer)
+    block_height = Column(Integer)
+    file_size = Column(BigInteger)
+
     hazardlevel_order = deferred(
         select([HazardLevel.order]).where(HazardLevel.id == hazardlevel_id))
     hazardset = relationship(
@@ -649,7 +684,9 @@ class Layer(Base):
             return '{}-{}'.format(self.hazardset_id, self.return_period)
 
     def filename(self):
-        return self.download_url.split('/').pop()
+        # layers may publish files with the same name
+        return '{}-{}'.format(self.geonode_id,
+                              self.download_url.split('/').pop())
 
 
 class Output(Base):
@@ -669,12 +706,115 @@ class Output(Base):
     hazardlevel_id = Column(Integer,
                             ForeignKey('datamart.enum_hazardlevel.id'),
                             nullable=False)
+    # hash of the administrative division geometry used
+    fingerprint = Column(String)
 
     hazardset = relationship('HazardSet')
     administrativedivision = relationship('AdministrativeDivision')
     hazardlevel = relationship('HazardLevel')
 
 
+class ProcessingTask(Base):
+    """Chunk of administrative divisions of a hazardset, in the queue of
+    processing tasks shared by the processing hosts"""
+    __tablename__ = 'task'
+    __table_args__ = {u'schema': 'processing'}
+    id = Column(Integer, primary_key=True)
+    hazardset_id = Column(String,
+                          ForeignKey('processing.hazardset.id',
+                                     ondelete="CASCADE"),
+                          nullable=False, index=True)
+    admin_ids = Column(ARRAY(Integer), nullable=False)
+    # fingerprints to record in the hazardset once all its tasks are done
+    fingerprint = Column(String)
+    divisions_fingerprint = Column(String)
+    # the worker holding the task, as long as its heartbeat is recent
+    worker = Column(String)
+    heartbeat = Column(DateTime(timezone=True))
+    attempts = Column(Integer, nullable=False, default=0)
+    done = Column(Boolean, nullable=False, default=False)
+    error = Column(String)
+
+    hazardset = relationship('HazardSet')
+
+
+class DivisionStatistics(Base):
+    """Statistics of the pixels of a layer touched by an administrative
+    division, used to simulate the outputs of other processing settings"""
+    __tablename__ = 'statistics'
+    __table_args__ = {u'schema': 'processing'}
+    hazardset_id = Column(String,
+                          ForeignKey('processing.hazardset.id',
+                                     ondelete="CASCADE"),
+                          primary_key=True)
+    admin_id = Column(Integer,
+                      ForeignKey('datamart.administrativedivision.id',
+                                 ondelete="CASCADE"),
+                      primary_key=True)
+    # hazard level mnemonic of the layer, or 'values' for a preprocessed one
+    layer = Column(String, primary_key=True)
+    # valid pixels and their extremes
+    count = Column(Integer, nullable=False)
+    minimum = Column(Float)
+    maximum = Column(Float)
+    # distinct values and their number of pixels, null when too many
+    values = Column(ARRAY(Float))
+    counts = Column(ARRAY(Integer))
+    # whether the pixels of a mask layer were read, and the extremes of the
+    # pixels kept by mask thresholds, as [mask value, extreme] points, null
+    # when too many (see processing.statistics.Statistics)
+    mask = Column(Boolean, nullable=False, default=False)
+    upper = Column(ARRAY(Float, dimensions=2))
+    lower = Column(ARRAY(Float, dimensions=2))
+
+    hazardset = relationship('HazardSet')
+
+
+class RegionMembership(Base):
+    """Regions of the REG administrative divisions, through their country,
+    with the bounding box of the divisions, so that processing selects the
+    divisions of a hazardset with an indexed join. Rebuilt by harvesting and
+    import_admindivs only, see refresh."""
+    __tablename__ = 'regionmembership'
+    __table_args__ = {u'schema': 'processing'}
+    region_id = Column(Integer,
+                       ForeignKey('datamart.enum_region.id',
+                                  ondelete="CASCADE"),
+                       primary_key=True)
+    admin_id = Column(Integer,
+                      ForeignKey('datamart.administrativedivision.id',
+                                 ondelete="CASCADE"),
+                      primary_key=True, index=True)
+    bbox = Column(Geometry('GEOMETRY', 4326), nullable=False)
+
+    @classmethod
+    def refresh(cls):
+        """Rebuild the memberships from the region associations and the
+        geometries of the administrative divisions"""
+        adminlevel_reg = AdminLevelType.get(u'REG')
+        division = AdministrativeDivision.__table__
+        province = division.alias()
+        country = division.alias()
+        regions = region_administrativedivision_table
+        memberships = select([regions.c.region_id,
+                              division.c.id,
+                              func.ST_Envelope(division.c.geom)]) \
+            .select_from(
+                division
+                .join(province, division.c.parent_code == province.c.code)
+                .join(country, province.c.parent_code == country.c.code)
+                .join(regions,
+                      regions.c.administrativedivision_id == country.c.id)) \
+            .where(division.c.leveltype_id == adminlevel_reg.id) \
+            .where(division.c.geom.isnot(None)) \
+            .distinct()
+        # Associations and divisions not flushed yet would be missed
+        DBSession.flush()
+        DBSession.execute(cls.__table__.delete())
+        DBSession.execute(cls.__table__.insert().from_select(
+            ['region_id', 'admin_id', 'bbox'], memberships))
+
+
 class FeedbackStatus(Base):
     __tablename__ = 'enum_feedbackstatus'
 
@@ -22,10 +22,15 @@ import argparse
 import os
 import logging
 import colorlog
+import rasterio
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from sqlalchemy import engine_from_config
 
 from ..settings import load_full_settings
 from ..models import DBSession
+from . import store
 
 
 logger = colorlog.getLogger(__name__)
@@ -120,3 +125,53 @@ class BaseProcessor():
         return os.path.join(self.settings['data_path'],
                             'hazardsets',
                             layer.filename())
+
+    def raster_path(self, layer):
+        """Path of the raster to read, normalized one if available"""
+        if layer.normalized_path is not None:
+            return os.path.join(self.settings['data_path'],
+                                layer.normalized_path)
+        return self.layer_path(layer)
+
+    def read_header(self, layer):
+        """Store the header of the layer file in the layer"""
+        path = self.layer_path(layer)
+        with rasterio.drivers():
+            with rasterio.open(path) as reader:
+                layer.height, layer.width = reader.shape
+                layer.transform = list(reader.affine)[:6]
+                layer.bounds = list(reader.bounds)
+                layer.dtype = reader.dtypes[0]
+                layer.nodata = reader.nodata
+                layer.block_height, layer.block_width = \
+                    reader.block_shapes[0]
+        layer.file_size = os.path.getsize(path)
+
+    def layer_checksum(self, layer):
+        """Return the SHA-256 checksum of the layer file, None if missing"""
+        path = self.layer_path(layer)
+        if not os.path.isfile(path):
+            return None
+        return store.file_checksum(path)
+
+
+def prefetch(function, objects, workers, initializer=None):
+    '''Yield callables returning function(object) for each object, in
+    order. With several workers, calls are made in advance by a pool of
+    threads, with at most twice as many pending calls as workers.'''
+    if workers < 2:
+        for object in objects:
+            yield partial(function, object)
+        return
+
+    pool = ThreadPool(workers, initializer)
+    try:
+        pending = deque()
+        for object in objects:
+            pending.append(pool.apply_async(function, (object, )))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get
+        while pending:
+            yield pending.popleft().get
+    finally:
+        pool.terminate()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import numpy as np
+from numpy import ma
+
+
+# Size of the cache blocks for rasters which are not internally tiled
+BLOCK_SIZE = 256
+
+
+class BlockCache(object):
+    """Least recently used cache of decoded raster blocks, bounded in
+    bytes and keyed by (layer, block row, block col).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.blocks = OrderedDict()
+
+    def get(self, key, load):
+        block = self.blocks.pop(key, None)
+        if block is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            block = load()
+            self.bytes += block_bytes(block)
+            while self.bytes > self.max_bytes and len(self.blocks) > 0:
+                _, evicted = self.blocks.popitem(last=False)
+                self.bytes -= block_bytes(evicted)
+        # Most recently used blocks are at the end
+        self.blocks[key] = block
+        return block
+
+    def clear(self):
+        self.blocks.clear()
+        self.bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return '{} hits, {} misses ({:.0f}% hit rate)'.format(
+            self.hits,
+            self.misses,
+            100.0 * self.hits / total if total > 0 else 0)
+
+
+class CachedReader(object):
+    """Wrap a rasterio reader so that windowed reads of band 1 are served
+    from block aligned reads shared through a BlockCache.
+    """
+
+    def __init__(self, reader, cache, key):
+        self.reader = reader
+        self.cache = cache
+        self.key = key
+        self.block_shape = cache_block_shape(reader)
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def read(self, indexes, window=None, masked=False):
+        if indexes != 1 or window is None or not masked:
+            return self.reader.read(indexes, window=window, masked=masked)
+
+        height, width = self.reader.shape
+        (row_start, row_stop), (col_start, col_stop) = window
+        row_start, row_stop = max(row_start, 0), min(row_stop, height)
+        col_start, col_stop = max(col_start, 0), min(col_stop, width)
+        if row_stop <= row_start or col_stop <= col_start:
+            return self.reader.read(indexes, window=window, masked=masked)
+
+        block_height, block_width = self.block_shape
+        data = None
+        for block_row in xrange(row_start // block_height,
+                                (row_stop - 1) // block_height + 1):
+            for block_col in xrange(col_start // block_width,
+                                    (col_stop - 1) // block_width + 1):
+                block = self.block(block_row, block_col)
+                if data is None:
+                    data = ma.masked_array(
+                        np.empty((row_stop - row_start,
+                                  col_stop - col_start),
+                                 dtype=block.dtype),
+                        np.empty((row_stop - row_start,
+                                  col_stop - col_start),
+                                 dtype=np.bool))
+
+                # Intersection of the block and the window
+                top = block_row * block_height
+                left = block_col * block_width
+                r0, r1 = max(row_start, top), min(row_stop,
+                                                  top + block_height)
+                c0, c1 = max(col_start, left), min(col_stop,
+                                                   left + block_width)
+                target = (slice(r0 - row_start, r1 - row_start),
+                          slice(c0 - col_start, c1 - col_start))
+                source = (slice(r0 - top, r1 - top),
+                          slice(c0 - left, c1 - left))
+                data.data[target] = block.data[source]
+                data.mask[target] = block.mask[source]
+        return data
+
+    def block(self, block_row, block_col):
+        def load():
+            height, width = self.reader.shape
+            block_height, block_width = self.block_shape
+            window = ((block_row * block_height,
+                       min((block_row + 1) * block_height, height)),
+                      (block_col * block_width,
+                       min((block_col + 1) * block_width, width)))
+            block = self.reader.read(1, window=window, masked=True)
+            return ma.masked_array(block.data, ma.getmaskarray(block))
+
+        return self.cache.get((self.key, block_row, block_col), load)
+
+
+def cache_block_shape(reader):
+    """Native block shape of internally tiled rasters, square blocks for
+    strip organized ones.
+    """
+    try:
+        block_height, block_width = reader.block_shapes[0]
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return (BLOCK_SIZE, BLOCK_SIZE)
+    height, width = reader.shape
+    if block_width >= width and width > BLOCK_SIZE:
+        return (BLOCK_SIZE, BLOCK_SIZE)
+    return (block_height, block_width)
+
+
+def block_bytes(block):
+    return block.data.nbytes + block.mask.nbytes
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import numbers
+
+from ..models import level_weights
+from .lookup import LevelLookup
+
+
+# Levels of the layers of not preprocessed hazardsets, highest first
+LEVELS = (u'HIG', u'MED', u'LOW')
+
+
+class ClassificationError(Exception):
+    pass
+
+
+class ClassificationPlan(object):
+    """Rules classifying the pixels of the layers of a hazardset, compiled
+    once from the settings of its hazard type and the units of its layers,
+    so that the processing of each division only evaluates them.
+
+    A plan holds either the lookup of the values of a preprocessed layer, or
+    the threshold of each level, the comparison and the threshold of the
+    mask layer, if any. It is not modified once compiled.
+    """
+
+    def __init__(self, settings, lookup=None, thresholds=None,
+                 inverted=False, mask_threshold=None):
+        # Hazard type settings the plan was compiled from
+        self.settings = settings
+        self.lookup = lookup
+        self.thresholds = dict(thresholds or {})
+        self.inverted = inverted
+        self.mask_threshold = mask_threshold
+
+    @property
+    def preprocessed(self):
+        return self.lookup is not None
+
+    @property
+    def levels(self):
+        """(level, threshold) tuples, highest level first"""
+        return tuple((level, self.thresholds[level]) for level in LEVELS)
+
+    def exceeds(self, data, threshold):
+        """Pixels of data beyond threshold: greater than threshold, or lower
+        with inverted comparison"""
+        if self.inverted:
+            return data < threshold
+        return data > threshold
+
+    def masked(self, mask_data):
+        """Pixels excluded by the mask layer"""
+        return self.exceeds(mask_data, self.mask_threshold)
+
+
+def compile_plan(type_settings, layers):
+    """Validate the settings of a hazard type for the given layers, a dict
+    of layers by level mnemonic, 'mask' or 0 for a preprocessed layer, and
+    return their ClassificationPlan. Raise ClassificationError with the
+    first missing or invalid setting.
+    """
+    if 'values' in type_settings:
+        values = type_settings['values']
+        if not isinstance(values, dict):
+            raise ClassificationError('values must be a mapping of hazard '
+                                      'levels to lists of values')
+        for level, level_values in values.iteritems():
+            if level not in level_weights:
+                raise ClassificationError(
+                    'Unknown hazard level {} in values'.format(level))
+            if not isinstance(level_values, list) or \
+                    not all(is_number(value) for value in level_values):
+                raise ClassificationError(
+                    'Values of {} must be a list of numbers'.format(level))
+        return ClassificationPlan(type_settings,
+                                  lookup=LevelLookup(values))
+
+    if 'thresholds' not in type_settings:
+        raise ClassificationError('Neither values nor thresholds are set')
+
+    inverted = type_settings.get('inverted_comparison', False)
+    if not isinstance(inverted, bool):
+        raise ClassificationError('inverted_comparison must be a boolean')
+
+    thresholds = {}
+    for level in LEVELS:
+        if level not in layers:
+            raise ClassificationError('No layer for level {}'.format(level))
+        thresholds[level] = layer_threshold(type_settings, level,
+                                            layers[level])
+
+    mask_threshold = None
+    if 'mask_return_period' in type_settings:
+        if 'mask' not in layers:
+            raise ClassificationError('No mask layer')
+        mask_threshold = layer_threshold(type_settings, u'MASK',
+                                         layers['mask'])
+
+    return ClassificationPlan(type_settings,
+                              thresholds=thresholds,
+                              inverted=inverted,
+                              mask_threshold=mask_threshold)
+
+
+def layer_threshold(type_settings, level, layer):
+    threshold = find_threshold(type_settings['thresholds'],
+                               layer.local, level, layer.hazardunit)
+    if not is_number(threshold):
+        raise ClassificationError(
+            'No threshold found for {} {} {}'
+            .format('local' if layer.local else 'global',
+                    level,
+                    layer.hazardunit))
+    return float(threshold)
+
+
+def find_threshold(thresholds, local, level, unit):
+    """Walk the nested thresholds settings down to the threshold of the
+    given level and unit, and return it, or None if missing."""
+    while type(thresholds) is dict:
+        if 'local' in thresholds.keys():
+            thresholds = thresholds.get('local' if local else 'global')
+        elif 'HIG' in thresholds.keys():
+            thresholds = thresholds.get(level)
+        elif unit in thresholds.keys():
+            thresholds = thresholds[unit]
+        else:
+            return None
+    return thresholds
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
@@ -19,13 +19,14 @@
 
 import logging
 import transaction
-import rasterio
 from sqlalchemy import func
 
 from ..models import (
     DBSession,
+    HazardLevel,
     HazardSet,
     Layer,
+    hazardset_region_table,
     )
 
 from ..processing import BaseProcessor
@@ -62,111 +63,145 @@ class Completer(BaseProcessor):
                 logger.error('Batch reset to incomplete state failed',
                              exc_info=True)
 
-        ids = DBSession.query(HazardSet.id)
+        hazardsets = DBSession.query(HazardSet)
         if not self.force:
-            ids = ids.filter(HazardSet.complete.is_(False))
+            hazardsets = hazardsets.filter(HazardSet.complete.is_(False))
         if hazardset_id is not None:
-            ids = ids.filter(HazardSet.id == hazardset_id)
-        ids = ids.order_by(HazardSet.id)
-        for id in ids:
+            hazardsets = hazardsets.filter(HazardSet.id == hazardset_id)
+        hazardsets = hazardsets.order_by(HazardSet.id).all()
+        if len(hazardsets) == 0:
+            return
+
+        # Layers and regions of all hazardsets are loaded at once
+        ids = [hazardset.id for hazardset in hazardsets]
+        layers = {}
+        for layer in DBSession.query(Layer) \
+                .filter(Layer.hazardset_id.in_(ids)) \
+                .order_by(Layer.geonode_id):
+            layers.setdefault(layer.hazardset_id, []).append(layer)
+        regions = dict(
+            DBSession.query(hazardset_region_table.c.hazardset_id,
+                            func.count())
+            .filter(hazardset_region_table.c.hazardset_id.in_(ids))
+            .group_by(hazardset_region_table.c.hazardset_id))
+
+        for hazardset in hazardsets:
+            # Changes of a hazardset are rolled back on error, without
+            # losing the other hazardsets
+            savepoint = transaction.savepoint()
             try:
                 # complete can be either True or an error message
-                complete = self.complete_hazardset(id[0])
+                complete = self.complete_layers(
+                    hazardset,
+                    layers.get(hazardset.id, []),
+                    regions.get(hazardset.id, 0))
                 if complete is not True:
-                    hazardset = DBSession.query(HazardSet).get(id)
                     hazardset.complete_error = complete
                     logger.warning('Hazardset {} incomplete: {}'
                                    .format(hazardset.id, complete))
-                transaction.commit()
+                DBSession.flush()
             except Exception:
-                transaction.abort()
-                logger.error('An error occurred with hazardset {}'.format(id),
+                savepoint.rollback()
+                logger.error('An error occurred with hazardset {}'
+                             .format(hazardset.id),
                              exc_info=True)
 
+        try:
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            logger.error('Hazardsets completion failed', exc_info=True)
+
     def complete_hazardset(self, hazardset_id, dry_run=False):
-        logger.info('Completing hazardset {}'.format(hazardset_id))
         hazardset = DBSession.query(HazardSet).get(hazardset_id)
         if hazardset is None:
             raise Exception('Hazardset {} does not exist.'
                             .format(hazardset_id))
+        layers = DBSession.query(Layer) \
+            .filter(Layer.hazardset_id == hazardset_id) \
+            .order_by(Layer.geonode_id) \
+            .all()
+        complete = self.complete_layers(hazardset, layers,
+                                        len(hazardset.regions))
+        DBSession.flush()
+        return complete
+
+    def complete_layers(self, hazardset, layers, regions):
+        """Check the layers of a hazardset from their stored raster headers,
+        and complete it. Return True, or the reason why it is incomplete.
+        """
+        logger.info('Completing hazardset {}'.format(hazardset.id))
 
         hazardtype = hazardset.hazardtype
         type_settings = self.settings['hazard_types'][hazardtype.mnemonic]
         preprocessed = 'values' in type_settings
 
-        if len(hazardset.regions) == 0:
+        if regions == 0:
             return 'No associated regions'
 
-        layers = []
+        selected = []
         if preprocessed:
-            if len(hazardset.layers) == 0:
+            if len(layers) == 0:
                 return 'No layer found'
-            layers.append(hazardset.layers[0])
+            selected.append(layers[0])
         else:
             for level in (u'LOW', u'MED', u'HIG'):
-                layer = hazardset.layer_by_level(level)
+                hazardlevel = HazardLevel.get(level)
+                layer = next((layer for layer in layers
+                              if layer.hazardlevel_id == hazardlevel.id),
+                             None)
                 if layer is None:
                     return 'No layer for level {}'.format(level)
-
-                layers.append(layer)
+                selected.append(layer)
             if ('mask_return_period' in type_settings):
-                layer = DBSession.query(Layer) \
-                    .filter(Layer.hazardset_id == hazardset_id) \
-                    .filter(Layer.mask.is_(True))
-                if layer.count() == 0:
+                layer = next((layer for layer in layers if layer.mask), None)
+                if layer is None:
                     return 'Missing mask layer'
-                layers.append(layer.one())
+                selected.append(layer)
 
-        affine = None
+        transform = None
         shape = None
-        for layer in layers:
+        for layer in selected:
             if not layer.downloaded:
                 return 'No data for layer {}'.format(layer.name())
-            try:
-                with rasterio.drivers():
-                    with rasterio.open(self.layer_path(layer)) as reader:
-                        bounds = reader.bounds
-                        if bounds.bottom > bounds.top:
-                            return 'bounds.bottom > bounds.top'
-                        if affine is None:
-                            affine = reader.affine
-                            shape = reader.shape
-                        else:
-                            if (reader.affine != affine or
-                                    reader.shape != shape):
-                                return (
-                                    'All layers should have the same origin,'
-                                    ' resolution and size')
-            except:
-                logger.error('Layer {} - Error opening file {}'
-                             .format(layer.name(),
-                                     self.layer_path(layer)),
-                             exc_info=True)
-                return 'Error opening layer {}'.format(layer.name())
-
-        stats = DBSession.query(
-            Layer.local,
-            func.min(Layer.data_lastupdated_date),
-            func.min(Layer.metadata_lastupdated_date),
-            func.min(Layer.calculation_method_quality),
-            func.min(Layer.scientific_quality)) \
-            .filter(Layer.hazardset_id == hazardset.id) \
-            .filter(Layer.mask.isnot(True)) \
-            .group_by(Layer.local)
-
-        if stats.count() > 1:
+            if layer.width is None:
+                # Downloaded before raster headers were stored
+                try:
+                    self.read_header(layer)
+                except Exception:
+                    logger.error('Layer {} - Error opening file {}'
+                                 .format(layer.name(),
+                                         self.layer_path(layer)),
+                                 exc_info=True)
+                    return 'Error opening layer {}'.format(layer.name())
+            left, bottom, right, top = layer.bounds
+            if bottom > top:
+                return 'bounds.bottom > bounds.top'
+            if transform is None:
+                transform = list(layer.transform)
+                shape = (layer.height, layer.width)
+            elif (list(layer.transform) != transform or
+                    (layer.height, layer.width) != shape):
+                return ('All layers should have the same origin,'
+                        ' resolution and size')
+
+        stats = [layer for layer in layers if layer.mask is not True]
+        if len(set(layer.local for layer in stats)) > 1:
             return 'Mixed local and global layers'
 
-        stat = stats.one()
-
-        hazardset.local = stat[0]
-        hazardset.data_lastupdated_date = stat[1]
-        hazardset.metadata_lastupdated_date = stat[2]
-        hazardset.calculation_method_quality = stat[3]
-        hazardset.scientific_quality = stat[4]
+        hazardset.local = stats[0].local
+        hazardset.data_lastupdated_date = min(
+            layer.data_lastupdated_date for layer in stats)
+        hazardset.metadata_lastupdated_date = min(
+            layer.metadata_lastupdated_date for layer in stats)
+        hazardset.calculation_method_quality = min(
+            layer.calculation_method_quality for layer in stats)
+        hazardset.scientific_quality = min(
+            layer.scientific_quality for layer in stats)
         hazardset.complete = True
         hazardset.complete_error = None
-        DBSession.flush()
+        # Ratings may have changed, see DecisionMaker
+        hazardset.decided = None
 
         logger.info('  Completed')
         return True
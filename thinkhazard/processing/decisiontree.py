@@ -18,6 +18,7 @@
 # ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import datetime
 from ..models import (
     DBSession,
     AdminLevelType,
@@ -31,21 +32,29 @@ logger = logging.getLogger(__name__)
 
 class DecisionMaker(BaseProcessor):
 
-    def do_execute(self, hazardset_id=None):
+    @staticmethod
+    def argument_parser():
+        parser = BaseProcessor.argument_parser()
+        parser.add_argument(
+            '--incremental', dest='incremental',
+            action='store_const', const=True, default=False,
+            help='Only update the relations of the administrative divisions '
+                 'and hazard types touched by hazardsets changed since '
+                 'last run')
+        return parser
+
+    def do_execute(self, hazardset_id=None, incremental=False):
+        # Hazardsets processed from now on will be considered as changed
+        now = datetime.datetime.now()
         connection = DBSession.bind.connect()
         trans = connection.begin()
         try:
-            logger.info("Purging previous relations")
-            connection.execute(clearall_query())
-
-            logger.info("Calculating level REG")
-            connection.execute(level_reg_query())
-
-            logger.info("Upscaling to PRO")
-            connection.execute(upscaling_query(u'PRO'))
+            if incremental:
+                self.update_relations(connection)
+            else:
+                self.rebuild_relations(connection)
 
-            logger.info("Upscaling to COU")
-            connection.execute(upscaling_query(u'COU'))
+            connection.execute(decided_query(), now=now)
 
             trans.commit()
         except:
@@ -53,6 +62,50 @@ class DecisionMaker(BaseProcessor):
             logger.error('An error occurred in decision tree',
                          exc_info=True)
 
+    def rebuild_relations(self, connection):
+        logger.info("Purging previous relations")
+        connection.execute(clearall_query())
+
+        logger.info("Calculating level REG")
+        connection.execute(level_reg_query())
+
+        logger.info("Upscaling to PRO")
+        connection.execute(upscaling_query(u'PRO'))
+
+        logger.info("Upscaling to COU")
+        connection.execute(upscaling_query(u'COU'))
+
+    def update_relations(self, connection):
+        """Compute the relations of the (administrative division, hazard
+        type) partitions touched by changed hazardsets in staging tables,
+        then replace them in one go.
+        """
+        connection.execute(changed_hazardsets_query())
+        count = connection.execute(
+            'SELECT count(*) FROM changed_hazardset').scalar()
+        logger.info("{} hazardsets changed since last run".format(count))
+        if count == 0:
+            return
+
+        logger.info("Calculating level REG")
+        connection.execute(staging_reg_query())
+
+        logger.info("Upscaling to PRO")
+        connection.execute(staging_upscaling_query(u'PRO'))
+
+        logger.info("Upscaling to COU")
+        connection.execute(staging_upscaling_query(u'COU'))
+
+        logger.info("Replacing relations")
+        connection.execute(swap_query())
+
+
+def decided_query():
+    return '''
+UPDATE processing.hazardset
+SET decided = CASE WHEN complete THEN %(now)s ELSE NULL END;
+'''
+
 
 def clearall_query():
     return '''
@@ -191,3 +244,301 @@ FROM
         AND hc_ad_parent.hazardcategory_id = hc_ad_child.hazardcategory_id
 WHERE ad_parent.leveltype_id = {leveltype_id};
 '''.format(leveltype_id=AdminLevelType.get(level).id)
+
+
+def changed_hazardsets_query():
+    return '''
+/*
+ * Hazardsets processed or completed again since last run, hazardsets whose
+ * processing failed since then, their outputs being removed, and hazardsets
+ * which are not complete anymore
+ */
+CREATE TEMPORARY TABLE changed_hazardset ON COMMIT DROP AS
+SELECT id
+FROM processing.hazardset
+WHERE (complete AND (decided IS NULL OR decided < processed))
+    OR (complete AND processed IS NULL AND decided IS NOT NULL)
+    OR (NOT complete AND decided IS NOT NULL);
+
+
+/*
+ * (administrative division, hazard type) partitions to compute again, for
+ * all levels
+ */
+CREATE TEMPORARY TABLE affected ON COMMIT DROP AS
+SELECT
+    output.admin_id AS administrativedivision_id,
+    set.hazardtype_id
+FROM
+    processing.output AS output
+    JOIN processing.hazardset AS set
+        ON set.id = output.hazardset_id
+    JOIN changed_hazardset AS changed
+        ON changed.id = set.id
+UNION
+SELECT
+    rel.administrativedivision_id,
+    category.hazardtype_id
+FROM
+    datamart.rel_hazardcategory_administrativedivision_hazardset AS rel_hs
+    JOIN changed_hazardset AS changed
+        ON changed.id = rel_hs.hazardset_id
+    JOIN datamart.rel_hazardcategory_administrativedivision AS rel
+        ON rel.id = rel_hs.rel_hazardcategory_administrativedivision_id
+    JOIN datamart.hazardcategory AS category
+        ON category.id = rel.hazardcategory_id
+    JOIN datamart.administrativedivision AS admindiv
+        ON admindiv.id = rel.administrativedivision_id
+WHERE admindiv.leveltype_id = {leveltype_id};
+
+CREATE INDEX ON affected (administrativedivision_id, hazardtype_id);
+
+
+/*
+ * New relations of the affected partitions
+ */
+CREATE TEMPORARY TABLE staging_rel (
+    administrativedivision_id integer,
+    hazardtype_id integer,
+    hazardcategory_id integer
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE staging_rel_hazardset (
+    administrativedivision_id integer,
+    hazardcategory_id integer,
+    hazardset_id varchar
+) ON COMMIT DROP;
+'''.format(leveltype_id=AdminLevelType.get(u'REG').id)
+
+
+def staging_reg_query():
+    return '''
+/*
+ * Apply decision tree on first level, for affected partitions
+ */
+INSERT INTO staging_rel (
+    administrativedivision_id,
+    hazardtype_id,
+    hazardcategory_id
+)
+SELECT DISTINCT
+    output.admin_id AS administrativedivision_id,
+    set.hazardtype_id,
+    first_value(category.id) OVER w AS hazardcategory_id
+FROM
+    processing.output AS output
+    JOIN processing.hazardset AS set
+        ON set.id = output.hazardset_id
+    JOIN affected
+        ON affected.administrativedivision_id = output.admin_id
+        AND affected.hazardtype_id = set.hazardtype_id
+    JOIN datamart.hazardcategory AS category
+        ON category.hazardtype_id = set.hazardtype_id
+        AND category.hazardlevel_id = output.hazardlevel_id
+    WHERE set.complete = TRUE
+WINDOW w AS (
+    PARTITION BY
+        output.admin_id,
+        set.hazardtype_id
+    ORDER BY
+        set.calculation_method_quality DESC,
+        set.scientific_quality DESC,
+        set.local DESC,
+        set.data_lastupdated_date DESC
+);
+
+
+/*
+ * Produce relations with hazardsets (sources)
+ */
+INSERT INTO staging_rel_hazardset (
+    administrativedivision_id,
+    hazardcategory_id,
+    hazardset_id
+)
+SELECT DISTINCT
+    output.admin_id AS administrativedivision_id,
+    rel.hazardcategory_id,
+    first_value(set.id) OVER w AS hazardset_id
+FROM
+    processing.output AS output
+    JOIN processing.hazardset AS set
+        ON set.id = output.hazardset_id
+    JOIN datamart.hazardcategory AS category
+        ON category.hazardtype_id = set.hazardtype_id
+        AND category.hazardlevel_id = output.hazardlevel_id
+    JOIN staging_rel AS rel
+        ON rel.administrativedivision_id = output.admin_id
+        AND rel.hazardcategory_id = category.id
+WINDOW w AS (
+    PARTITION BY
+        output.admin_id,
+        set.hazardtype_id
+    ORDER BY
+        set.calculation_method_quality DESC,
+        set.scientific_quality DESC,
+        set.local DESC,
+        set.data_lastupdated_date DESC
+);
+'''
+
+
+def staging_upscaling_query(level):
+    return '''
+/*
+ * Parents of the affected partitions
+ */
+INSERT INTO affected (
+    administrativedivision_id,
+    hazardtype_id
+)
+SELECT DISTINCT
+    admindiv_parent.id,
+    affected.hazardtype_id
+FROM
+    affected
+    JOIN datamart.administrativedivision AS admindiv_child
+        ON admindiv_child.id = affected.administrativedivision_id
+    JOIN datamart.administrativedivision AS admindiv_parent
+        ON admindiv_parent.code = admindiv_child.parent_code
+WHERE admindiv_parent.leveltype_id = {leveltype_id};
+
+
+/*
+ * Relations of the children of the affected parents, once updated:
+ * current ones for unaffected children, staging ones for the others
+ */
+CREATE TEMPORARY TABLE children_rel ON COMMIT DROP AS
+SELECT
+    admindiv_parent.id AS parent_id,
+    category.hazardtype_id,
+    category.hazardlevel_id,
+    rel.hazardcategory_id,
+    rel_hs.hazardset_id
+FROM
+    datamart.rel_hazardcategory_administrativedivision AS rel
+    JOIN datamart.hazardcategory AS category
+        ON category.id = rel.hazardcategory_id
+    JOIN datamart.administrativedivision AS admindiv_child
+        ON admindiv_child.id = rel.administrativedivision_id
+    JOIN datamart.administrativedivision AS admindiv_parent
+        ON admindiv_parent.code = admindiv_child.parent_code
+    JOIN affected AS affected_parent
+        ON affected_parent.administrativedivision_id = admindiv_parent.id
+        AND affected_parent.hazardtype_id = category.hazardtype_id
+    LEFT JOIN datamart.rel_hazardcategory_administrativedivision_hazardset
+        AS rel_hs
+        ON rel_hs.rel_hazardcategory_administrativedivision_id = rel.id
+WHERE admindiv_parent.leveltype_id = {leveltype_id}
+    AND NOT EXISTS (
+        SELECT 1
+        FROM affected
+        WHERE affected.administrativedivision_id =
+                rel.administrativedivision_id
+            AND affected.hazardtype_id = category.hazardtype_id
+    )
+UNION ALL
+SELECT
+    admindiv_parent.id AS parent_id,
+    rel.hazardtype_id,
+    category.hazardlevel_id,
+    rel.hazardcategory_id,
+    rel_hs.hazardset_id
+FROM
+    staging_rel AS rel
+    JOIN datamart.hazardcategory AS category
+        ON category.id = rel.hazardcategory_id
+    JOIN datamart.administrativedivision AS admindiv_child
+        ON admindiv_child.id = rel.administrativedivision_id
+    JOIN datamart.administrativedivision AS admindiv_parent
+        ON admindiv_parent.code = admindiv_child.parent_code
+    LEFT JOIN staging_rel_hazardset AS rel_hs
+        ON rel_hs.administrativedivision_id = rel.administrativedivision_id
+        AND rel_hs.hazardcategory_id = rel.hazardcategory_id
+WHERE admindiv_parent.leveltype_id = {leveltype_id};
+
+
+/*
+ * Upscale hazard categories for each affected parent
+ */
+INSERT INTO staging_rel (
+    administrativedivision_id,
+    hazardtype_id,
+    hazardcategory_id
+)
+SELECT DISTINCT
+    children_rel.parent_id,
+    children_rel.hazardtype_id,
+    first_value(children_rel.hazardcategory_id) OVER w
+FROM
+    children_rel
+    JOIN datamart.enum_hazardlevel AS level
+        ON level.id = children_rel.hazardlevel_id
+WINDOW w AS (
+    PARTITION BY
+        children_rel.parent_id,
+        children_rel.hazardtype_id
+    ORDER BY
+        level.order
+);
+
+
+/*
+ * Upscale relations with hazardsets (sources)
+ */
+INSERT INTO staging_rel_hazardset (
+    administrativedivision_id,
+    hazardcategory_id,
+    hazardset_id
+)
+SELECT DISTINCT
+    children_rel.parent_id,
+    children_rel.hazardcategory_id,
+    children_rel.hazardset_id
+FROM
+    children_rel
+    JOIN staging_rel AS rel
+        ON rel.administrativedivision_id = children_rel.parent_id
+        AND rel.hazardcategory_id = children_rel.hazardcategory_id
+WHERE children_rel.hazardset_id IS NOT NULL;
+
+DROP TABLE children_rel;
+'''.format(leveltype_id=AdminLevelType.get(level).id)
+
+
+def swap_query():
+    return '''
+/*
+ * Replace the relations of the affected partitions, relations with
+ * hazardsets are removed in cascade
+ */
+DELETE FROM datamart.rel_hazardcategory_administrativedivision AS rel
+USING
+    datamart.hazardcategory AS category,
+    affected
+WHERE category.id = rel.hazardcategory_id
+    AND affected.administrativedivision_id = rel.administrativedivision_id
+    AND affected.hazardtype_id = category.hazardtype_id;
+
+INSERT INTO datamart.rel_hazardcategory_administrativedivision (
+    administrativedivision_id,
+    hazardcategory_id
+)
+SELECT
+    administrativedivision_id,
+    hazardcategory_id
+FROM staging_rel;
+
+INSERT INTO datamart.rel_hazardcategory_administrativedivision_hazardset (
+    rel_hazardcategory_administrativedivision_id,
+    hazardset_id
+)
+SELECT
+    rel.id,
+    rel_hs.hazardset_id
+FROM
+    staging_rel_hazardset AS rel_hs
+    JOIN datamart.rel_hazardcategory_administrativedivision AS rel
+        ON rel.administrativedivision_id = rel_hs.administrativedivision_id
+        AND rel.hazardcategory_id = rel_hs.hazardcategory_id;
+'''
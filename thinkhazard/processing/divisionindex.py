@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+# Folder of the index files, in data_path
+INDEX_DIR = 'divisionindex'
+
+
+class DivisionIndex(object):
+    """Pixels touched by the polygons of the administrative divisions on a
+    given raster grid, stored as runs of pixels (row, col_start, col_stop)
+    in a compressed file, so that geometry masks are computed once per grid.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # (admin_id, polygon index) => (window, runs)
+        self.entries = {}
+        self.modified = False
+        self.hits = 0
+        self.misses = 0
+        if os.path.isfile(path):
+            self.entries.update(load_entries(path))
+
+    def mask(self, admin_id, index, window, shape):
+        """Return the geometry mask of a polygon, as computed by
+        features.geometry_mask, or None if not in index.
+        """
+        entry = self.entries.get((admin_id, index))
+        if entry is None or entry[0] != window_tuple(window):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return runs_to_mask(entry[1], window, shape)
+
+    def add(self, admin_id, index, window, mask):
+        self.entries[(admin_id, index)] = (window_tuple(window),
+                                           mask_to_runs(mask, window))
+        self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        dir_path = os.path.dirname(self.path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        # Lock the index so that entries saved by other processes between
+        # reading and renaming are not lost, the lock is released on close
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.write()
+        self.modified = False
+
+    def write(self):
+        # Keep entries saved by other processes in the meantime
+        entries = load_entries(self.path) if os.path.isfile(self.path) \
+            else {}
+        entries.update(self.entries)
+        self.entries = entries
+
+        keys = sorted(entries.keys())
+        windows = np.array([entries[key][0] for key in keys],
+                           dtype=np.int64).reshape((-1, 4))
+        runs = [entries[key][1] for key in keys]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(r) for r in runs])
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                        suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(
+                    f,
+                    keys=np.array(keys, dtype=np.int64).reshape((-1, 2)),
+                    windows=windows,
+                    offsets=offsets,
+                    runs=np.concatenate(runs) if runs
+                    else np.zeros((0, 3), dtype=np.int32))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def stats(self):
+        return '{} masks from index, {} computed'.format(self.hits,
+                                                         self.misses)
+
+
+def clear(data_path):
+    """Remove all index files, to be called when geometries change"""
+    shutil.rmtree(os.path.join(data_path, INDEX_DIR), ignore_errors=True)
+
+
+def index_path(data_path, affine, shape, fingerprint):
+    """Path of the index of a grid, for the division geometries of the
+    given fingerprint"""
+    return os.path.join(data_path,
+                        INDEX_DIR,
+                        grid_signature(affine, shape, fingerprint) + '.npz')
+
+
+def grid_signature(affine, shape, fingerprint):
+    grid = tuple(affine)[:6] + tuple(shape) + (fingerprint,)
+    return hashlib.sha1(repr(grid)).hexdigest()
+
+
+def load_entries(path):
+    entries = {}
+    f = np.load(path)
+    try:
+        keys = f['keys']
+        windows = f['windows']
+        offsets = f['offsets']
+        runs = f['runs']
+    finally:
+        f.close()
+    for i in xrange(0, len(keys)):
+        entries[(int(keys[i, 0]), int(keys[i, 1]))] = (
+            tuple(int(v) for v in windows[i]),
+            runs[offsets[i]:offsets[i + 1]])
+    return entries
+
+
+def window_tuple(window):
+    (row_start, row_stop), (col_start, col_stop) = window
+    return (int(row_start), int(row_stop), int(col_start), int(col_stop))
+
+
+def mask_to_runs(mask, window):
+    """Encode the pixels not masked as runs in raster coordinates"""
+    (row_start, _), (col_start, _) = window
+    inside = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    inside[:, 1:-1] = ~mask
+    diff = np.diff(inside, axis=1)
+    start_rows, start_cols = np.nonzero(diff == 1)
+    _, stop_cols = np.nonzero(diff == -1)
+    return np.column_stack((start_rows + row_start,
+                            start_cols + col_start,
+                            stop_cols + col_start)).astype(np.int32)
+
+
+def runs_to_mask(runs, window, shape):
+    (row_start, _), (col_start, _) = window
+    mask = np.ones(shape, dtype=np.bool)
+    if len(runs) == 0:
+        return mask
+    lengths = runs[:, 2] - runs[:, 1]
+    ends = np.cumsum(lengths)
+    rows = np.repeat(runs[:, 0] - row_start, lengths)
+    cols = (np.arange(ends[-1]) - np.repeat(ends - lengths, lengths) +
+            np.repeat(runs[:, 1] - col_start, lengths))
+    mask[rows, cols] = False
+    return mask
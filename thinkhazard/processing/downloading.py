@@ -20,9 +20,16 @@
 import logging
 import traceback
 import os
+import re
+import time
+import hashlib
+import threading
+from collections import namedtuple
 from datetime import datetime
+from itertools import izip
 from urlparse import urlunsplit
 import requests
+from requests.exceptions import ChunkedEncodingError
 import transaction
 
 from ..models import (
@@ -30,14 +37,65 @@ from ..models import (
     Layer,
     )
 
-from . import BaseProcessor
+from . import (
+    BaseProcessor,
+    prefetch,
+    pyramid,
+    store,
+    )
 
 
 logger = logging.getLogger(__name__)
 
+# Size of chunks read from network and written to disk
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for the server before retrying
+TIMEOUT = 60
+
+# Statuses considered as transient, requests are retried
+RETRY_STATUSES = (502, 503, 504)
+
+# HTTP sessions of downloading threads, each one keeps its connections alive
+local = threading.local()
+
+Download = namedtuple('Download', [
+    'geonode_id',
+    'name',
+    'url',
+    'path',
+    'lastupdated',
+    'checksum',
+])
+
+
+class TransientError(Exception):
+    pass
+
+
+def session():
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def content_size(response):
+    '''Return the total size of the file, from Content-Range for partial
+    content, from Content-Length otherwise'''
+    if response.status_code == 206:
+        match = re.match(r'bytes \d+-\d+/(\d+)',
+                         response.headers.get('Content-Range', ''))
+        return int(match.group(1)) if match else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length is not None else None
+
 
 class Downloader(BaseProcessor):
 
+    # Retries of transient errors, first delay in seconds, then doubled
+    retries = 3
+    backoff = 1
+
     @staticmethod
     def argument_parser():
         parser = BaseProcessor.argument_parser()
@@ -48,6 +106,9 @@ class Downloader(BaseProcessor):
             '-c', '--clear-cache', dest='clear_cache',
             action='store_const', const=True, default=False,
             help='Clear raster cache')
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=1,
+            help='Number of concurrent downloads. Defaults to 1')
         return parser
 
     def clear_cache(self):
@@ -57,8 +118,10 @@ class Downloader(BaseProcessor):
             file_path = os.path.join(cache_path, filename)
             if os.path.isfile(file_path):
                 os.unlink(file_path)
+        store.clear(self.settings['data_path'])
+        pyramid.clear(self.settings['data_path'])
 
-    def do_execute(self, hazardset_id=None, clear_cache=False):
+    def do_execute(self, hazardset_id=None, clear_cache=False, workers=1):
         if self.force or clear_cache:
             try:
                 logger.info('Resetting all layers to not downloaded state.')
@@ -81,69 +144,280 @@ class Downloader(BaseProcessor):
         if hazardset_id is not None:
             ids = ids.filter(Layer.hazardset_id == hazardset_id)
 
-        for id in ids:
+        downloads = []
+        duplicates = []
+        urls = set()
+        for id in ids.all():
             try:
-                self.download_layer(id)
+                download = self.prepare_download(id)
                 transaction.commit()
             except Exception:
                 transaction.abort()
                 logger.error(traceback.format_exc())
+                continue
+            if download is None:
+                continue
+            if download.url in urls:
+                duplicates.append(download)
+            else:
+                downloads.append(download)
+                urls.add(download.url)
+
+        # Files are transferred by worker threads, the database is updated
+        # by the main thread, in order
+        results = prefetch(self.download_file, downloads, workers)
+        for download, result in izip(downloads, results):
+            try:
+                self.save_download(download, result)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                logger.error(traceback.format_exc())
+
+        # Layers publishing the same file are linked to the transferred one
+        for download in duplicates:
+            try:
+                self.download_layer(download.geonode_id)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                logger.error(traceback.format_exc())
+
+        if not self.dry_run:
+            self.collect_garbage()
 
     def download_layer(self, id):
+        download = self.prepare_download(id)
+        if download is not None:
+            self.save_download(download,
+                               lambda: self.download_file(download))
+
+    def prepare_download(self, id):
+        '''Link the layer file to the store if its content is known, return
+        what is needed to download it otherwise'''
         layer = DBSession.query(Layer).get(id)
         if layer is None:
             raise Exception('Layer {} does not exist.'.format(id))
 
-        logger.info('Downloading layer {}'.format(layer.name()))
+        logger.info('Preparing download of layer {}'.format(layer.name()))
 
+        data_path = self.settings['data_path']
         path = self.layer_path(layer)
 
         dir_path = os.path.dirname(path)
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
-        # If file is obsolete, unlink
-        if os.path.isfile(path):
-            cache_mtime = datetime.fromtimestamp(os.path.getmtime(path))
-            if layer.data_lastupdated_date > cache_mtime:
-                logger.debug('  File {} considered as obsolete {} > {}'
-                             .format(layer.filename(),
-                                     layer.data_lastupdated_date,
-                                     cache_mtime))
-                os.unlink(path)
-            else:
-                logger.info('  File {} found in cache'
-                            .format(layer.filename()))
-
-        # If file not in cache, download it
-        if not os.path.isfile(path):
-            geonode = self.settings['geonode']
-            url = urlunsplit((geonode['scheme'],
-                              geonode['netloc'],
-                              layer.download_url,
-                              '',
-                              ''))
-            logger.info('  Retrieving {}'.format(url))
+        checksum = layer.checksum
+        if checksum is not None and not store.contains(data_path, checksum):
+            checksum = None
+
+        # Adopt files of previous runs, layers of a complete harvesting
+        # have lost their checksum
+        if checksum is None:
+            for cache_path in (path, self.legacy_path(layer)):
+                if not os.path.isfile(cache_path):
+                    continue
+                cache_mtime = datetime.fromtimestamp(
+                    os.path.getmtime(cache_path))
+                if layer.data_lastupdated_date > cache_mtime:
+                    logger.debug('  File {} considered as obsolete {} > {}'
+                                 .format(cache_path,
+                                         layer.data_lastupdated_date,
+                                         cache_mtime))
+                    os.unlink(cache_path)
+                    continue
+                cache_checksum = store.file_checksum(cache_path)
+                if layer.checksum not in (None, cache_checksum):
+                    os.unlink(cache_path)
+                    continue
+                logger.info('  File {} found in cache'.format(cache_path))
+                store.add(data_path, cache_path, cache_checksum)
+                checksum = cache_checksum
+                break
+
+        # Same file published by another layer
+        if checksum is None:
+            other = DBSession.query(Layer) \
+                .filter(Layer.geonode_id != layer.geonode_id) \
+                .filter(Layer.download_url == layer.download_url) \
+                .filter(Layer.data_lastupdated_date ==
+                        layer.data_lastupdated_date) \
+                .filter(Layer.downloaded.is_(True)) \
+                .filter(Layer.checksum.isnot(None)) \
+                .first()
+            if (other is not None and
+                    store.contains(data_path, other.checksum)):
+                logger.info('  Same file as layer {}'.format(other.name()))
+                checksum = other.checksum
+
+        if checksum is not None:
+            store.link(data_path, checksum, path)
+            layer.downloaded = True
+            self.update_layer(layer, checksum)
+            DBSession.flush()
+            return None
+
+        geonode = self.settings['geonode']
+        url = urlunsplit((geonode['scheme'],
+                          geonode['netloc'],
+                          layer.download_url,
+                          '',
+                          ''))
+        return Download(layer.geonode_id,
+                        layer.name(),
+                        url,
+                        path,
+                        layer.data_lastupdated_date,
+                        layer.checksum)
+
+    def save_download(self, download, result):
+        try:
+            checksum = result()
+        except Exception as e:
+            logger.warning('  Unable to download data for layer {}: {}'
+                           .format(download.name, str(e)))
+            return
+
+        layer = DBSession.query(Layer).get(download.geonode_id)
+        layer.downloaded = True
+        self.update_layer(layer, checksum)
+        DBSession.flush()
+
+    def update_layer(self, layer, checksum):
+        '''Record the checksum of the file linked to a layer, and its
+        header when it has changed'''
+        if layer.checksum != checksum or layer.width is None:
             try:
-                r = requests.get(url, stream=True)
-                r.raise_for_status()
-            except Exception as e:
-                logger.warning('  Unable to download data for layer {}: {}'
-                               .format(layer.name(),
-                                       str(e)))
-                return
-
-            logger.info('  Saving to {}'.format(path))
+                self.read_header(layer)
+            except Exception:
+                # Read again, and reported, by the completer
+                layer.width = None
+                logger.warning('  Unable to read header of {}'
+                               .format(self.layer_path(layer)),
+                               exc_info=True)
+        if layer.checksum != checksum:
+            layer.checksum = checksum
+            layer.normalized_path = None
+
+    def legacy_path(self, layer):
+        '''Path of the layer file before the raster store'''
+        return os.path.join(self.settings['data_path'],
+                            'hazardsets',
+                            layer.download_url.split('/').pop())
+
+    def collect_garbage(self):
+        '''Remove the files which are not used by layers anymore'''
+        paths = []
+        checksums = []
+        for layer in DBSession.query(Layer):
+            paths.append(self.layer_path(layer))
+            if layer.checksum is None:
+                paths.append(self.legacy_path(layer))
+            else:
+                checksums.append(layer.checksum)
+        freed = store.collect_garbage(self.settings['data_path'], paths)
+        freed += pyramid.collect_garbage(self.settings['data_path'],
+                                         checksums)
+        logger.info('{} MB of unused files removed'.format(freed >> 20))
+
+    def download_file(self, download):
+        '''Download a file into a .part file, resumed with range requests
+        after interruptions, verify it, add it to the store and link it in
+        place. Return its SHA-256 checksum.'''
+        part_path = download.path + store.PART_SUFFIX
+
+        # Previous partial download of obsolete data
+        if os.path.isfile(part_path):
+            part_mtime = datetime.fromtimestamp(os.path.getmtime(part_path))
+            if download.lastupdated > part_mtime:
+                os.unlink(part_path)
+        part = PartFile(part_path)
+
+        delay = self.backoff
+        for attempt in xrange(self.retries + 1):
             try:
-                with open(path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        f.write(chunk)
-            except:
-                os.unlink(path)
-                logger.error('Failed to save file: {}'.format(path),
-                             exc_info=True)
-                return False
+                self.transfer(download.url, part)
+                break
+            except (requests.ConnectionError,
+                    requests.Timeout,
+                    ChunkedEncodingError,
+                    TransientError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning('  Resuming {} after error: {}'
+                               .format(download.url, e))
+                time.sleep(delay)
+                delay *= 2
 
-        layer.downloaded = os.path.isfile(path)
+        checksum = part.sha256.hexdigest()
+        # GeoNode does not publish checksums, the file must match its
+        # previous download while the layer data date has not changed
+        if download.checksum is not None and checksum != download.checksum:
+            os.unlink(part_path)
+            raise Exception('Checksum mismatch for {}: {} != {}, clear the '
+                            'checksum of layer {} to accept a file published '
+                            'again'.format(download.url, checksum,
+                                           download.checksum, download.name))
 
-        DBSession.flush()
+        data_path = self.settings['data_path']
+        store.add(data_path, part_path, checksum)
+        store.link(data_path, checksum, download.path)
+        logger.info('  Saved {}'.format(download.path))
+        return checksum
+
+    def transfer(self, url, part):
+        '''Append the missing bytes of url to the part file'''
+        headers = {'Range': 'bytes={}-'.format(part.size)} if part.size else {}
+        logger.info('  Retrieving {} from byte {}'.format(url, part.size))
+        r = session().get(url, stream=True, headers=headers, timeout=TIMEOUT)
+        try:
+            if r.status_code == 416:
+                # Range not satisfiable, part may be complete already
+                match = re.match(r'bytes \*/(\d+)',
+                                 r.headers.get('Content-Range', ''))
+                if match and int(match.group(1)) == part.size:
+                    return
+                part.truncate()
+                raise TransientError('Range not satisfiable')
+            if r.status_code in RETRY_STATUSES:
+                raise TransientError('Status {}'.format(r.status_code))
+            r.raise_for_status()
+
+            if r.status_code != 206:
+                # Range not supported, start again
+                part.truncate()
+            total = content_size(r)
+            part.append(r.iter_content(chunk_size=CHUNK_SIZE))
+        finally:
+            r.close()
+
+        if total is not None and part.size != total:
+            raise TransientError('Received {} bytes of {}'
+                                 .format(part.size, total))
+
+
+class PartFile(object):
+    """File being downloaded, with the SHA-256 checksum of its content"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    self.sha256.update(chunk)
+                    self.size += len(chunk)
+
+    def truncate(self):
+        open(self.path, 'wb').close()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def append(self, chunks):
+        with open(self.path, 'ab') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                self.sha256.update(chunk)
+                self.size += len(chunk)
@@ -19,9 +19,15 @@
 
 import os
 import re
+import time
+import socket
 import logging
+import threading
 import traceback
+import httplib
 import httplib2
+from functools import partial
+from itertools import izip
 from urllib import urlencode
 from urlparse import urlunsplit
 import json
@@ -38,13 +44,17 @@ from ..models import (
     Layer,
     Output,
     Region,
+    RegionMembership,
     AdministrativeDivision,
     FurtherResource,
     HazardTypeFurtherResourceAssociation,
     Harvesting,
     )
 
-from . import BaseProcessor
+from . import (
+    BaseProcessor,
+    prefetch,
+    )
 
 
 logger = logging.getLogger(__name__)
@@ -52,6 +62,15 @@ logger = logging.getLogger(__name__)
 region_admindiv_csv_path = \
     'data/geonode_regions_to_administrative_divisions_code.csv'
 
+# We load system ca bundle in order to trust let's encrypt certificates
+ca_certs = '/etc/ssl/certs/ca-certificates.crt'
+
+# GeoNode statuses considered as transient, requests are retried
+RETRY_STATUSES = (502, 503, 504)
+
+# HTTP clients of harvesting threads, each one keeps its connections alive
+local = threading.local()
+
 
 def warning(object, msg):
     logger.warning(('{csw_type} {id}: '+msg).format(**object))
@@ -75,10 +94,18 @@ def between(value, range):
     return False
 
 
+def init_thread():
+    local.http_client = httplib2.Http(ca_certs=ca_certs)
+
+
 class Harvester(BaseProcessor):
 
-    # We load system ca bundle in order to trust let's encrypt certificates
-    http_client = httplib2.Http(ca_certs='/etc/ssl/certs/ca-certificates.crt')
+    http_client = httplib2.Http(ca_certs=ca_certs)
+    workers = 1
+
+    # Retries of transient errors, first delay in seconds, then doubled
+    retries = 3
+    backoff = 1
 
     @staticmethod
     def argument_parser():
@@ -86,9 +113,14 @@ class Harvester(BaseProcessor):
         parser.add_argument(
             '--hazard-type',  dest='hazard_type', action='store',
             help='The hazard type (ie. earthquake, ...)')
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=1,
+            help='Number of concurrent requests to GeoNode. Defaults to 1')
         return parser
 
-    def do_execute(self, hazard_type=None):
+    def do_execute(self, hazard_type=None, workers=1):
+        self.workers = workers
+
         setting_path = os.path.join(
             os.path.dirname(__file__), '..', '..',
             'thinkhazard_processing.yaml')
@@ -136,12 +168,47 @@ class Harvester(BaseProcessor):
             urlencode(params),
             ''))
         logger.info(u'Retrieving {}'.format(url))
-        response, content = self.http_client.request(url)
+        o = self.request(url)
+        return sorted(o['objects'], key=lambda object: object[order_by])
+
+    def fetch_detail(self, category, object):
+        # we need to retrieve more information on this object
+        # since the regions array is not advertised by the main
+        # listing from GeoNode
+        geonode = self.settings['geonode']
+        url = urlunsplit((geonode['scheme'],
+                          geonode['netloc'],
+                          'api/{}/{}/'.format(category, object['id']),
+                          urlencode({'username': geonode['username'],
+                                     'api_key': geonode['api_key']}),
+                          ''))
+        logger.info(u'  Retrieving {}'.format(url))
+        return self.request(url)
+
+    def request(self, url):
+        '''Request GeoNode API, retrying transient errors with exponential
+        backoff, using the HTTP client of the current thread'''
+        http_client = getattr(local, 'http_client', self.http_client)
+        delay = self.backoff
+        for attempt in xrange(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response, content = http_client.request(url)
+            except (socket.error, httplib.HTTPException) as e:
+                if last:
+                    raise
+                logger.warning(u'Retrying {} after error: {}'.format(url, e))
+            else:
+                if response.status not in RETRY_STATUSES or last:
+                    break
+                logger.warning(u'Retrying {} after status {}'
+                               .format(url, response.status))
+            time.sleep(delay)
+            delay *= 2
         if response.status != 200:
             raise Exception(u'Geonode returned status {}: {}'.
                             format(response.status, content))
-        o = json.loads(content)
-        return sorted(o['objects'], key=lambda object: object[order_by])
+        return json.loads(content)
 
     def hazardtype_from_geonode(self, geonode_name):
         for mnemonic, type_settings in \
@@ -173,6 +240,10 @@ class Harvester(BaseProcessor):
                                  .format(row[1], row[2]))
                     logger.error(traceback.format_exc())
 
+        logger.info(u'Refreshing region memberships')
+        RegionMembership.refresh()
+        transaction.commit()
+
     def create_region_admindiv_association(self, row):
         # row[0] is geonode region's name_en (useless here)
         # row[1] is geonode region id
@@ -236,9 +307,13 @@ class Harvester(BaseProcessor):
 
     def harvest_documents(self):
         documents = self.fetch('documents')
-        for doc in documents:
+        details = prefetch(partial(self.fetch_detail, 'documents'),
+                           documents,
+                           self.workers,
+                           init_thread)
+        for doc, detail in izip(documents, details):
             try:
-                self.harvest_document(doc)
+                self.harvest_document(doc, detail())
                 transaction.commit()
             except Exception as e:
                 transaction.abort()
@@ -246,28 +321,13 @@ class Harvester(BaseProcessor):
                              .format(doc['title'], e.message))
                 logger.error(traceback.format_exc())
 
-    def harvest_document(self, object):
+    def harvest_document(self, object, o=None):
         logger.info(u'Harvesting document {id} - {title}'.format(**object))
         title = object['title']
         id = object['id']
 
-        # we need to retrieve more information on this document
-        # since the regions array is not advertised by the main
-        # regions listing from GeoNode
-        geonode = self.settings['geonode']
-        doc_url = urlunsplit((geonode['scheme'],
-                              geonode['netloc'],
-                              'api/documents/{}/'.format(id),
-                              urlencode({'username': geonode['username'],
-                                         'api_key': geonode['api_key']}),
-                              ''))
-        logger.info(u'  Retrieving {}'.format(doc_url))
-        response, content = self.http_client.request(doc_url)
-        if response.status != 200:
-            raise Exception(u'Geonode returned status {}: {}'.
-                            format(response.status, content))
-
-        o = json.loads(content)
+        if o is None:
+            o = self.fetch_detail('documents', object)
 
         if 'regions' not in o.keys():
             warning(o, 'Attribute "regions" is missing')
@@ -368,9 +428,13 @@ class Harvester(BaseProcessor):
         if hazard_type is not None:
             params['hazard_type__in'] = hazard_type
         layers = self.fetch('layers', params)
-        for layer in layers:
+        details = prefetch(partial(self.fetch_detail, 'layers'),
+                           layers,
+                           self.workers,
+                           init_thread)
+        for layer, detail in izip(layers, details):
             try:
-                self.harvest_layer(layer)
+                self.harvest_layer(layer, detail())
                 transaction.commit()
             except Exception as e:
                 transaction.abort()
@@ -378,27 +442,12 @@ class Harvester(BaseProcessor):
                              .format(layer['title'], e.message))
                 logger.error(traceback.format_exc())
 
-    def harvest_layer(self, object):
+    def harvest_layer(self, object, o=None):
         logger.info(u'Harvesting layer {id} - {title}'.format(**object))
         title = object['title']
 
-        # we need to retrieve more information on this layer
-        # since the regions array is not advertised by the main
-        # regions listing from GeoNode
-        geonode = self.settings['geonode']
-        layer_url = urlunsplit((geonode['scheme'],
-                                geonode['netloc'],
-                                'api/layers/{id}/'.format(**object),
-                                urlencode({'username': geonode['username'],
-                                           'api_key': geonode['api_key']}),
-                                ''))
-        logger.info(u'  Retrieving {}'.format(layer_url))
-        response, content = self.http_client.request(layer_url)
-        if response.status != 200:
-            raise Exception(u'Geonode returned status {}: {}'.
-                            format(response.status, content))
-
-        o = json.loads(content)
+        if o is None:
+            o = self.fetch_detail('layers', object)
 
         if 'regions' not in o.keys():
             warning(object, 'Attribute "regions" is missing')
@@ -550,6 +599,8 @@ class Harvester(BaseProcessor):
                     layer.download_url != download_url):
                 logger.info('  Invalidate downloaded')
                 layer.downloaded = False
+                layer.checksum = None
+                layer.normalized_path = None
                 hazardset.complete = False
                 hazardset.processed = None
 
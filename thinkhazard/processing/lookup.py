@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy import ma
+
+from ..models import level_weights
+
+
+# Largest integer types classified with a table indexed by pixel values
+MAX_TABLE_ITEMSIZE = 2
+
+
+class LevelLookup(object):
+    """Hazard level weights of the pixel values of a preprocessed layer,
+    compiled from the ``values`` setting of the hazard type, so that pixels
+    are classified in one pass whatever the number of values.
+
+    8 and 16 bits integer pixels are classified with a table indexed by
+    their bit pattern, other types with a binary search in the sorted
+    values.
+    """
+
+    def __init__(self, values):
+        self.weights = {}
+        for level, level_values in values.iteritems():
+            for value in level_values:
+                self.weights[value] = max(self.weights.get(value, 0),
+                                          level_weights[level])
+        self.tables = {}
+
+    def table(self, dtype):
+        """Return the compiled table for pixels of given type, as a tuple
+        (unsigned type of the index, weights) for integer tables, or
+        (sorted values, weights)."""
+        dtype = np.dtype(dtype)
+        if dtype in self.tables:
+            return self.tables[dtype]
+
+        if dtype.kind in 'iu' and dtype.itemsize <= MAX_TABLE_ITEMSIZE:
+            info = np.iinfo(dtype)
+            index_dtype = np.dtype('u{}'.format(dtype.itemsize))
+            weights = np.zeros(2 ** (8 * dtype.itemsize), dtype=np.uint8)
+            for value, weight in self.weights.iteritems():
+                # Values which no pixel of this type can have
+                if value != int(value) or not info.min <= value <= info.max:
+                    continue
+                index = np.array(int(value), dtype=dtype).view(index_dtype)
+                weights[index] = weight
+            table = (index_dtype, weights)
+        else:
+            values = np.array(sorted(self.weights.keys()), dtype=np.float64)
+            weights = np.array([self.weights[value] for value in values],
+                               dtype=np.uint8)
+            table = (values, weights)
+
+        self.tables[dtype] = table
+        return table
+
+    def classify(self, data):
+        """Return the level weights of the pixels of a masked array, 0 for
+        masked pixels and values without level."""
+        values = ma.getdata(data)
+        index, weights = self.table(values.dtype)
+        if isinstance(index, np.dtype):
+            result = weights[values.view(index)]
+        else:
+            if len(index) == 0:
+                return np.zeros(values.shape, dtype=np.uint8)
+            positions = np.searchsorted(index, values)
+            np.minimum(positions, len(index) - 1, out=positions)
+            result = np.where(index[positions] == values,
+                              weights[positions],
+                              0).astype(np.uint8)
+        result[ma.getmaskarray(data)] = 0
+        return result
+
+    def max_weight(self, data):
+        """Return the highest level weight of the pixels of a masked
+        array"""
+        if data.size == 0:
+            return 0
+        return int(self.classify(data).max())
+
+
+def group_max(weights, groups, out):
+    """Update out[group] with the highest of the weights of each group, in
+    one pass per distinct weight, as weights take few values."""
+    for weight in np.unique(weights):
+        if weight == 0:
+            continue
+        members = groups[weights == weight]
+        out[members] = np.maximum(out[members], weight)
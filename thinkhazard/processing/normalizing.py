@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import math
+import errno
+import logging
+import tempfile
+import transaction
+import rasterio
+from rasterio.enums import Resampling
+
+from ..models import (
+    DBSession,
+    Layer,
+    )
+
+from . import BaseProcessor
+
+
+logger = logging.getLogger(__name__)
+
+# Folder of the normalized files, in data_path
+NORMALIZED_DIR = 'normalized'
+
+# Size of the internal tiles, and of the smallest overview
+TILE_SIZE = 256
+
+# Rows of tiles read and written at once
+STRIP_TILES = 4
+
+
+class Normalizer(BaseProcessor):
+    """Rewrite downloaded layers as internally tiled, compressed GeoTIFFs
+    with overviews, for fast windowed reads.
+    """
+
+    @staticmethod
+    def argument_parser():
+        parser = BaseProcessor.argument_parser()
+        parser.add_argument(
+            '--hazardset_id', dest='hazardset_id', action='store',
+            help='The hazardset id')
+        return parser
+
+    def do_execute(self, hazardset_id=None):
+        ids = DBSession.query(Layer.geonode_id) \
+            .filter(Layer.downloaded.is_(True))
+        if not self.force:
+            ids = ids.filter(Layer.normalized_path.is_(None))
+        if hazardset_id is not None:
+            ids = ids.filter(Layer.hazardset_id == hazardset_id)
+        for id in ids.order_by(Layer.geonode_id).all():
+            try:
+                self.normalize_layer(id)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                logger.error('An error occurred with layer {}'.format(id),
+                             exc_info=True)
+
+        if not self.dry_run:
+            self.collect_garbage()
+
+    def normalize_layer(self, id):
+        layer = DBSession.query(Layer).get(id)
+        if layer is None:
+            raise Exception('Layer {} does not exist.'.format(id))
+
+        logger.info('Normalizing layer {}'.format(layer.name()))
+
+        if layer.checksum is None:
+            layer.checksum = self.layer_checksum(layer)
+            if layer.checksum is None:
+                raise Exception('No data for layer {}'.format(layer.name()))
+
+        # Layers with the same file share the normalized one
+        normalized_path = os.path.join(NORMALIZED_DIR,
+                                       '{}.tif'.format(layer.checksum))
+        path = os.path.join(self.settings['data_path'], normalized_path)
+        if self.force or not os.path.isfile(path):
+            normalize(self.layer_path(layer), path)
+        else:
+            logger.info('  File {} found'.format(normalized_path))
+
+        layer.normalized_path = normalized_path
+        DBSession.flush()
+
+    def collect_garbage(self):
+        """Remove the normalized files which are not used anymore"""
+        dir_path = os.path.join(self.settings['data_path'], NORMALIZED_DIR)
+        if not os.path.isdir(dir_path):
+            return
+        used = set(os.path.basename(path) for path, in
+                   DBSession.query(Layer.normalized_path)
+                   .filter(Layer.normalized_path.isnot(None)))
+        for filename in os.listdir(dir_path):
+            if filename not in used:
+                logger.info('Removing unused file {}'.format(filename))
+                os.unlink(os.path.join(dir_path, filename))
+
+
+def normalize(src_path, dst_path):
+    """Rewrite the raster at src_path as a tiled GeoTIFF at dst_path, with
+    lossless compression and overviews. Data and georeferencing are kept
+    unchanged.
+    """
+    try:
+        os.makedirs(os.path.dirname(dst_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Layers sharing a file may be normalized by several processes at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path),
+                                    suffix='.tif')
+    os.close(fd)
+
+    try:
+        with rasterio.drivers():
+            with rasterio.open(src_path) as src:
+                kwargs = src.meta.copy()
+                kwargs.update(
+                    driver='GTiff',
+                    transform=src.affine,
+                    tiled=True,
+                    blockxsize=TILE_SIZE,
+                    blockysize=TILE_SIZE,
+                    compress='deflate',
+                    # Floating point predictor for floats, horizontal
+                    # differencing for integers
+                    predictor=3 if src.dtypes[0].startswith('float') else 2,
+                    interleave='band')
+                kwargs.pop('affine', None)
+                with rasterio.open(tmp_path, 'w', **kwargs) as dst:
+                    height, width = src.shape
+                    rows = TILE_SIZE * STRIP_TILES
+                    for row in xrange(0, height, rows):
+                        window = ((row, min(row + rows, height)), (0, width))
+                        dst.write(src.read(window=window), window=window)
+
+                with rasterio.open(tmp_path, 'r+') as dst:
+                    factors = overview_factors(src.shape)
+                    if factors:
+                        dst.build_overviews(factors, Resampling.nearest)
+
+                with rasterio.open(tmp_path) as dst:
+                    if (dst.affine != src.affine or dst.shape != src.shape or
+                            dst.crs != src.crs or
+                            not same_nodata(dst.nodata, src.nodata)):
+                        raise Exception('Georeferencing of {} has changed'
+                                        .format(src_path))
+    except Exception:
+        if os.path.isfile(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    os.rename(tmp_path, dst_path)
+    logger.info('  Saved {}'.format(dst_path))
+
+
+def same_nodata(a, b):
+    """Compare nodata values, NaN being equal to NaN"""
+    if a is None or b is None:
+        return a is b
+    return a == b or (math.isnan(a) and math.isnan(b))
+
+
+def overview_factors(shape):
+    """Decimation factors down to the size of a tile"""
+    factors = []
+    factor = 2
+    while max(shape) / factor >= TILE_SIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
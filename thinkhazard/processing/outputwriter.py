@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+from cStringIO import StringIO
+
+from ..models import DBSession
+
+
+# Number of rows sent to the database at once
+BUFFER_SIZE = 10000
+
+COPY_OUTPUTS = '''
+COPY processing.output (hazardset_id, admin_id, hazardlevel_id, fingerprint)
+FROM STDIN'''
+
+
+class OutputWriter(object):
+    """Write outputs to the database in the current transaction, with
+    COPY FROM STDIN, buffering a bounded number of rows.
+    """
+
+    def __init__(self, hazardset_id, buffer_size=BUFFER_SIZE):
+        self.hazardset_id = hazardset_id
+        self.buffer_size = buffer_size
+        self.buffer = StringIO()
+        self.buffered = 0
+        self.count = 0
+
+    def write(self, admin_id, hazardlevel_id, fingerprint=None):
+        self.buffer.write(copy_row((self.hazardset_id,
+                                    admin_id,
+                                    hazardlevel_id,
+                                    fingerprint)))
+        self.buffered += 1
+        self.count += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        # Pending changes, like deletion of previous outputs, come first
+        DBSession.flush()
+        self.buffer.seek(0)
+        cursor = DBSession.connection().connection.cursor()
+        try:
+            cursor.copy_expert(COPY_OUTPUTS, self.buffer)
+        finally:
+            cursor.close()
+        self.buffer = StringIO()
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+class OutputList(list):
+    """Collect outputs in memory, for worker processes which do not write
+    to the database.
+    """
+
+    def write(self, admin_id, hazardlevel_id, fingerprint=None):
+        self.append((admin_id, hazardlevel_id, fingerprint))
+
+    @property
+    def count(self):
+        return len(self)
+
+    def close(self):
+        pass
+
+
+def copy_row(values):
+    """Encode a row in the COPY text format"""
+    return '\t'.join(copy_value(value) for value in values) + '\n'
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value \
+        .replace('\\', '\\\\') \
+        .replace('\t', '\\t') \
+        .replace('\n', '\\n') \
+        .replace('\r', '\\r')
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import traceback
+import datetime
+import multiprocessing
+import transaction
+from sqlalchemy import engine_from_config
+
+from ..models import (
+    DBSession,
+    HazardSet,
+    Layer,
+    )
+
+from . import BaseProcessor
+from .harvesting import Harvester
+from .downloading import Downloader
+from .normalizing import Normalizer
+from .completing import Completer
+from .processing import (
+    Processor,
+    add_engine_arguments,
+    )
+from .decisiontree import DecisionMaker
+
+
+logger = logging.getLogger(__name__)
+
+# Stages run for each hazardset, in order, each one depending on the
+# previous ones
+STAGES = ('download', 'normalize', 'complete', 'process')
+
+
+class Pipeline(BaseProcessor):
+    """Harvest GeoNode, then download, normalize, complete and process each
+    hazardset as a chain of stages, independent hazardsets being run
+    concurrently, and finally apply the decision tree to the changed
+    partitions. Stages whose inputs have not changed are skipped.
+    """
+
+    def __init__(self):
+        BaseProcessor.__init__(self)
+        self.engine_options = {}
+
+    @staticmethod
+    def argument_parser():
+        parser = BaseProcessor.argument_parser()
+        parser.add_argument(
+            '--hazardset_id', dest='hazardset_id', action='store',
+            help='The hazardset id')
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=1,
+            help='Number of hazardsets run concurrently, in worker '
+                 'processes. Defaults to 1')
+        parser.add_argument(
+            '--no-harvest', dest='harvest',
+            action='store_const', const=False, default=True,
+            help='Use the metadata already harvested')
+        add_engine_arguments(parser)
+        return parser
+
+    def do_execute(self, hazardset_id=None, workers=1, harvest=True,
+                   engine='polygon', block_cache=0, division_index=False,
+                   pyramid=False, memory_budget=256):
+        self.engine_options = {
+            'engine': engine,
+            'block_cache': block_cache,
+            'division_index': division_index,
+            'pyramid': pyramid,
+            'memory_budget': memory_budget,
+        }
+        chrono = datetime.datetime.now()
+
+        if harvest:
+            self.stage_processor(Harvester).do_execute(workers=workers)
+
+        ids = self.pending_hazardsets(hazardset_id)
+        logger.info('{} hazardsets with pending stages'.format(len(ids)))
+        if workers > 1 and len(ids) > 1 and not self.dry_run:
+            results = self.run_parallel(ids, workers)
+        else:
+            results = (self.run_hazardset(id) for id in ids)
+        for id, stages in results:
+            logger.info('{}: {}'.format(id, ', '.join(stages) or
+                                        'up to date'))
+
+        if not self.dry_run:
+            self.stage_processor(Downloader).collect_garbage()
+            self.stage_processor(Normalizer).collect_garbage()
+            transaction.abort()
+
+        # Only the partitions touched by changed hazardsets are computed
+        # again, nothing is done if no hazardset has changed
+        self.stage_processor(DecisionMaker).do_execute(
+            incremental=not self.force)
+
+        logger.info('Pipeline run in {}'
+                    .format(datetime.datetime.now() - chrono))
+
+    def pending_hazardsets(self, hazardset_id=None):
+        """Ids of the hazardsets having at least one stage to run"""
+        ids = DBSession.query(HazardSet.id)
+        if hazardset_id is not None:
+            ids = ids.filter(HazardSet.id == hazardset_id)
+        ids = [id for id, in ids.order_by(HazardSet.id)
+               if self.force or any(self.pending(id, stage)
+                                    for stage in STAGES)]
+        transaction.abort()
+        return ids
+
+    def pending(self, hazardset_id, stage):
+        """Whether a stage has work to do for a hazardset, given the current
+        state of the previous stages"""
+        layers = DBSession.query(Layer.geonode_id) \
+            .filter(Layer.hazardset_id == hazardset_id)
+        if stage == 'download':
+            return layers.filter(Layer.downloaded.is_(False)).count() > 0
+        if stage == 'normalize':
+            return layers \
+                .filter(Layer.downloaded.is_(True)) \
+                .filter(Layer.normalized_path.is_(None)) \
+                .count() > 0
+        hazardset = DBSession.query(HazardSet).get(hazardset_id)
+        if stage == 'complete':
+            return not hazardset.complete
+        if stage == 'process':
+            return hazardset.complete and hazardset.processed is None
+        raise ValueError('Unknown stage {}'.format(stage))
+
+    def run_hazardset(self, hazardset_id):
+        """Run the pending stages of a hazardset, in order. Return the
+        hazardset id and the names of the stages run."""
+        stages = []
+        for stage in STAGES:
+            try:
+                forced = self.force and stage == 'complete'
+                if not forced and not self.pending(hazardset_id, stage):
+                    continue
+                logger.info('{}: {}'.format(hazardset_id, stage))
+                getattr(self, stage)(hazardset_id)
+                stages.append(stage)
+            except Exception:
+                logger.error(traceback.format_exc())
+                break
+            finally:
+                transaction.abort()
+        return hazardset_id, stages
+
+    def download(self, hazardset_id):
+        downloader = self.stage_processor(Downloader)
+        ids = DBSession.query(Layer.geonode_id) \
+            .filter(Layer.hazardset_id == hazardset_id) \
+            .filter(Layer.downloaded.is_(False)) \
+            .order_by(Layer.geonode_id) \
+            .all()
+        for id in ids:
+            try:
+                downloader.download_layer(id)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                logger.error(traceback.format_exc())
+
+    def normalize(self, hazardset_id):
+        normalizer = self.stage_processor(Normalizer)
+        ids = DBSession.query(Layer.geonode_id) \
+            .filter(Layer.hazardset_id == hazardset_id) \
+            .filter(Layer.downloaded.is_(True)) \
+            .filter(Layer.normalized_path.is_(None)) \
+            .order_by(Layer.geonode_id) \
+            .all()
+        for id in ids:
+            try:
+                normalizer.normalize_layer(id)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                logger.error(traceback.format_exc())
+
+    def complete(self, hazardset_id):
+        completer = self.stage_processor(Completer)
+        completer.force = self.force
+        completer.do_execute(hazardset_id=hazardset_id)
+
+    def process(self, hazardset_id):
+        processor = self.stage_processor(Processor)
+        processor.do_execute(hazardset_id=hazardset_id,
+                             incremental=not self.force,
+                             **self.engine_options)
+
+    def stage_processor(self, cls):
+        """Processor of a stage, sharing the settings of the pipeline.
+        Garbage collection of files is left to the end of the pipeline."""
+        processor = cls()
+        processor.settings = self.settings
+        processor.dry_run = self.dry_run
+        processor.force = self.force if cls is Harvester else False
+        return processor
+
+    def run_parallel(self, hazardset_ids, workers):
+        """Run the hazardsets in a pool of worker processes, yield their
+        results as they are done."""
+        # Forked workers must not share the connections of this process
+        DBSession.remove()
+        DBSession.bind.dispose()
+
+        pool = multiprocessing.Pool(workers,
+                                    initializer=init_worker,
+                                    initargs=(self.settings,
+                                              self.worker_options()))
+        try:
+            for result in pool.imap_unordered(run_hazardset, hazardset_ids):
+                yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def worker_options(self):
+        """Attributes to copy to the worker pipelines"""
+        return {
+            'force': self.force,
+            'dry_run': self.dry_run,
+            'engine_options': self.engine_options,
+        }
+
+
+# Pipeline instance used by the current worker process
+worker_pipeline = None
+
+
+def init_worker(settings, options):
+    """Initialize a worker process with its own database connections"""
+    global worker_pipeline
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.remove()
+    DBSession.configure(bind=engine)
+    worker_pipeline = Pipeline()
+    worker_pipeline.settings = settings
+    for key, value in options.iteritems():
+        setattr(worker_pipeline, key, value)
+
+
+def run_hazardset(hazardset_id):
+    return worker_pipeline.run_hazardset(hazardset_id)
@@ -18,34 +18,92 @@
 # ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import os
 import traceback
+import hashlib
+import json
+import multiprocessing
+import time
 import transaction
 import datetime
+from collections import deque
 import rasterio
 from rasterio import (
     features,
     )
+import numpy as np
 from numpy import ma
-from shapely.geometry import box
-from geoalchemy2.shape import to_shape
-from sqlalchemy import func
+from shapely import wkb
+from shapely.affinity import translate
+from shapely.geometry import (
+    MultiPolygon,
+    box,
+    )
+from shapely.ops import transform
+from shapely.prepared import prep
+from sqlalchemy import func, engine_from_config, inspect, null, or_, tuple_
+from sqlalchemy.orm import Session
 
 from ..models import (
     DBSession,
     AdministrativeDivision,
-    AdminLevelType,
+    DivisionStatistics,
     HazardLevel,
     HazardSet,
     Layer,
     Output,
-    Region,
+    RegionMembership,
+    level_weights,
     )
 
-from . import BaseProcessor
+from . import (
+    BaseProcessor,
+    sharedraster,
+    workqueue,
+    )
+from .blockcache import (
+    BlockCache,
+    CachedReader,
+    )
+from .divisionindex import (
+    DivisionIndex,
+    index_path,
+    )
+from .outputwriter import (
+    OutputList,
+    OutputWriter,
+    )
+from .classification import (
+    ClassificationError,
+    compile_plan,
+    find_threshold,
+    )
+from .pyramid import (
+    load_or_build,
+    pixel_bounds,
+    )
+from .sharedraster import SharedReader
+from .statistics import (
+    Statistics,
+    classify,
+    layer_name,
+    layer_names,
+    )
+from .zonal import TileClassifier
 
 
 logger = logging.getLogger(__name__)
 
+# Number of administrative divisions processed by a worker in one task
+CHUNK_SIZE = 1000
+
+# Number of administrative divisions fetched and classified at once
+BATCH_SIZE = 1000  # 1000 records <=> 10 Mo
+
+# Bytes used per pixel of a window compared with a threshold: values,
+# comparison result, nodata and geometry masks, and the mask layer
+WINDOW_PIXEL_BYTES = 16
+
 
 class ProcessException(Exception):
     def __init__(self, *args, **kwargs):
@@ -54,15 +112,105 @@ class ProcessException(Exception):
 
 class Processor(BaseProcessor):
 
+    def __init__(self):
+        BaseProcessor.__init__(self)
+        self.engine = 'polygon'
+        self.block_cache_size = 0
+        self.block_cache = None
+        self.use_division_index = False
+        self.incremental = False
+        self.division_indexes = {}
+        self.division_index = None
+        # Fingerprint of the geometries of all the divisions, in the path of
+        # the division indexes
+        self.index_fingerprint = None
+        self.use_pyramid = False
+        self.pyramids = None
+        # Classification plan of the current hazardset
+        self.classification = None
+        self.window_budget = 0
+        # division id => division geometry split at the antimeridian
+        self.split_geometries = {}
+        self.shared_rasters = False
+        self.resume = False
+        # Whether division geometries are hashed, for incremental processing
+        # and checkpoints
+        self.hash_divisions = False
+        self.statistics = False
+        # (admin_id, statistics by layer) of the divisions to write
+        self.division_statistics = []
+        # Folder of the rasters decoded for the worker processes
+        self.shared_path = None
+
     @staticmethod
     def argument_parser():
         parser = BaseProcessor.argument_parser()
         parser.add_argument(
             '--hazardset_id', dest='hazardset_id', action='store',
             help='The hazardset id')
+        parser.add_argument(
+            '--workers', dest='workers', type=int, default=1,
+            help='Number of worker processes. Defaults to 1')
+        parser.add_argument(
+            '--incremental', dest='incremental',
+            action='store_const', const=True, default=False,
+            help='Only process the administrative divisions whose inputs '
+                 'have changed since last processing')
+        parser.add_argument(
+            '--resume', dest='resume',
+            action='store_const', const=True, default=False,
+            help='Continue the processing of hazardsets after the last '
+                 'checkpoint of an interrupted run')
+        parser.add_argument(
+            '--statistics', dest='statistics',
+            action='store_const', const=True, default=False,
+            help='Store the statistics of the pixels of each division, used '
+                 'by simulate to try other settings')
+        parser.add_argument(
+            '--shared-rasters', dest='shared_rasters',
+            action='store_const', const=True, default=False,
+            help='With several workers, decode the layers once in memory '
+                 'mapped files in data_path, shared by the workers')
+        parser.add_argument(
+            '--enqueue', dest='enqueue',
+            action='store_const', const=True, default=False,
+            help='Split the hazardsets in tasks of the processing queue, '
+                 'run by process --worker on one or several hosts')
+        parser.add_argument(
+            '--worker', dest='worker',
+            action='store_const', const=True, default=False,
+            help='Run the tasks of the processing queue until it is empty, '
+                 'in --workers processes')
+        parser.add_argument(
+            '--lease', dest='lease', type=int, default=workqueue.LEASE,
+            help='Seconds without heartbeat after which the task of a '
+                 'worker is given to another one. Defaults to {}'
+                 .format(workqueue.LEASE))
+        add_engine_arguments(parser)
         return parser
 
-    def do_execute(self, hazardset_id=None):
+    def do_execute(self, hazardset_id=None, workers=1, engine='polygon',
+                   block_cache=0, division_index=False, incremental=False,
+                   pyramid=False, memory_budget=256, shared_rasters=False,
+                   enqueue=False, worker=False, lease=workqueue.LEASE,
+                   resume=False, statistics=False):
+        self.engine = engine
+        self.block_cache_size = block_cache * 1024 * 1024
+        self.use_division_index = division_index
+        self.incremental = incremental
+        self.use_pyramid = pyramid
+        self.window_budget = memory_budget * 1024 * 1024
+        self.shared_rasters = shared_rasters
+        self.resume = resume
+        self.hash_divisions = incremental or resume
+        self.statistics = statistics
+        if statistics and (workers > 1 or enqueue or worker):
+            logger.warning('Statistics are only stored by sequential '
+                           'processing, ignoring --statistics')
+            self.statistics = False
+        if worker:
+            self.run_queue(workers, lease)
+            return
         ids = DBSession.query(HazardSet.id) \
             .filter(HazardSet.complete.is_(True))
         if hazardset_id is not None:
@@ -73,6 +221,12 @@ class Processor(BaseProcessor):
             logger.info('No hazardset to process')
             return
         ids = ids.order_by(HazardSet.id)
+        if enqueue:
+            self.enqueue_hazardsets([id[0] for id in ids])
+            return
+        if workers > 1:
+            self.process_parallel([id[0] for id in ids], workers)
+            return
         for id in ids:
             logger.info(id[0])
             try:
@@ -98,12 +252,6 @@ class Processor(BaseProcessor):
                     'Hazardset {} has already been processed.'
                     .format(hazardset.id))
 
-        logger.info("  Cleaning previous outputs")
-        DBSession.query(Output) \
-            .filter(Output.hazardset_id == hazardset.id) \
-            .delete()
-        DBSession.flush()
-
         self.type_settings = self.settings['hazard_types'][
             hazardset.hazardtype.mnemonic]
 
@@ -112,65 +260,532 @@ class Processor(BaseProcessor):
         with rasterio.drivers():
             try:
                 logger.info("  Opening raster files")
-                # Open rasters
-                self.layers = {}
-                self.readers = {}
-                if 'values' in self.type_settings.keys():
-                    # preprocessed layer
-                    layer = DBSession.query(Layer) \
-                        .filter(Layer.hazardset_id == hazardset.id) \
-                        .one()
-                    reader = rasterio.open(self.layer_path(layer))
-
-                    self.layers[0] = layer
-                    self.readers[0] = reader
+                try:
+                    self.open_readers(hazardset)
+                except ClassificationError as e:
+                    hazardset.processing_error = \
+                        'Invalid settings of hazard type {}: {}' \
+                        .format(hazardset.hazardtype.mnemonic, e)
+                    logger.error('  ' + hazardset.processing_error)
+                    return
 
-                else:
-                    for level in (u'HIG', u'MED', u'LOW'):
-                        hazardlevel = HazardLevel.get(level)
-                        layer = DBSession.query(Layer) \
-                            .filter(Layer.hazardset_id == hazardset.id) \
-                            .filter(Layer.hazardlevel_id == hazardlevel.id) \
-                            .one()
-                        reader = rasterio.open(self.layer_path(layer))
-
-                        self.layers[level] = layer
-                        self.readers[level] = reader
-                    if ('mask_return_period' in self.type_settings):
-                        layer = DBSession.query(Layer) \
-                            .filter(Layer.hazardset_id == hazardset.id) \
-                            .filter(Layer.mask.is_(True)) \
-                            .one()
-                        reader = rasterio.open(self.layer_path(layer))
-                        self.layers['mask'] = layer
-                        self.readers['mask'] = reader
-
-                outputs, error = self.create_outputs(hazardset)
+                admin_ids, fingerprints = self.plan(hazardset)
+
+                after = None
+                if self.resume:
+                    after = self.checkpoint(hazardset, fingerprints)
+                if after is None:
+                    logger.info("  Cleaning previous outputs")
+                    self.clean_outputs(hazardset, admin_ids)
+                    hazardset.fingerprint = None
+                    if self.resume:
+                        hazardset.checkpoint_fingerprint = \
+                            checkpoint_fingerprint(fingerprints)
+
+                count, error = 0, None
+                if admin_ids != [] and self.resume:
+                    count, error = self.checkpointed_outputs(hazardset_id,
+                                                             admin_ids,
+                                                             after)
+                    # Committed checkpoints detach previous objects
+                    hazardset = DBSession.query(HazardSet).get(hazardset_id)
+                elif admin_ids != []:
+                    writer = OutputWriter(hazardset.id)
+                    error = self.create_outputs(hazardset, writer, admin_ids)
+                    writer.close()
+                    count = writer.count
                 if error:
                     hazardset.processing_error = error
-                if outputs:
-                    DBSession.add_all(outputs)
-                else:
+                    if self.resume:
+                        # Committed outputs and checkpoint are kept for the
+                        # next run, unless inputs change meanwhile
+                        return
+                    # Remove outputs written before the error
+                    self.clean_outputs(hazardset, admin_ids)
+                clear_checkpoint(hazardset)
+                if count == 0 and after is None and admin_ids is None:
                     return
 
             finally:
                 logger.info("  Closing raster files")
-                for key, reader in self.readers.iteritems():
-                    if reader and not reader.closed:
-                        reader.close()
+                self.close_readers()
 
         if not hazardset.processing_error:
             hazardset.processed = datetime.datetime.now()
+            hazardset.fingerprint, hazardset.divisions_fingerprint = \
+                fingerprints
             logger.info('  Successfully processed {},'
                         ' {} outputs generated in {}'
                         .format(hazardset.id,
-                                len(outputs),
+                                count,
                                 datetime.datetime.now() - chrono))
 
         DBSession.flush()
 
-    def create_outputs(self, hazardset):
-        adminlevel_reg = AdminLevelType.get(u'REG')
+    def process_parallel(self, hazardset_ids, workers):
+        """Spread hazardsets, split in chunks of administrative divisions,
+        over a pool of worker processes. Outputs are merged back in the
+        current process as chunks are done, in one transaction per
+        hazardset.
+        """
+        if self.shared_rasters:
+            self.shared_path = sharedraster.create_dir(
+                self.settings['data_path'])
+        try:
+            self.run_pool(hazardset_ids, workers)
+        finally:
+            if self.shared_path is not None:
+                sharedraster.remove_dir(self.shared_path)
+                self.shared_path = None
+
+    def run_pool(self, hazardset_ids, workers):
+        """Process the hazardsets in a pool of worker processes"""
+        tasks = deque()
+        remaining = {}
+        plans = {}
+        # (raster path, shared path) of the layers by hazardset
+        layer_files = {}
+        for hazardset_id in hazardset_ids:
+            try:
+                admin_ids, plans[hazardset_id] = \
+                    self.hazardset_admin_ids(hazardset_id)
+                if self.shared_path is not None:
+                    layer_files[hazardset_id] = \
+                        self.layer_files(hazardset_id)
+            except Exception:
+                logger.error(traceback.format_exc())
+                continue
+            chunks = [admin_ids[i:i + CHUNK_SIZE]
+                      for i in xrange(0, len(admin_ids), CHUNK_SIZE)]
+            if len(chunks) == 0:
+                logger.info('{}: no administrative division to process'
+                            .format(hazardset_id))
+                if plans[hazardset_id][0] is not None:
+                    # Incremental processing with nothing to update
+                    remaining[hazardset_id] = 0
+                continue
+            logger.info('{}: {} administrative divisions in {} chunks'
+                        .format(hazardset_id, len(admin_ids), len(chunks)))
+            remaining[hazardset_id] = len(chunks)
+            for chunk in chunks:
+                tasks.append((hazardset_id, chunk))
+        transaction.abort()
+
+        for hazardset_id, count in remaining.items():
+            if count == 0:
+                plan = plans[hazardset_id]
+                self.commit_outputs(hazardset_id,
+                                    self.start_merge(hazardset_id, plan),
+                                    [], plan)
+
+        # Forked workers must not share the connections of this process
+        DBSession.remove()
+        DBSession.bind.dispose()
+
+        # (writer, errors) of the hazardsets being merged
+        merges = {}
+        # Paths of the decoded layers by hazardset
+        shared = {}
+        # Chunks sent to the pool, a few more than workers so that workers
+        # do not wait. Layers are decoded when the first chunk of their
+        # hazardset is sent and removed once its last chunk is done, so that
+        # only the layers of the hazardsets being processed are on disk.
+        # Results are merged in the order of the chunks, which is the order
+        # of the hazardsets, each one in its own transaction.
+        dispatched = deque()
+        chrono = datetime.datetime.now()
+        pool = multiprocessing.Pool(workers,
+                                    initializer=init_worker,
+                                    initargs=(self.settings,
+                                              self.worker_options()))
+        try:
+            while tasks or dispatched:
+                while tasks and len(dispatched) < 2 * workers:
+                    hazardset_id, chunk = tasks.popleft()
+                    if hazardset_id in layer_files:
+                        shared[hazardset_id] = self.share_layers(
+                            hazardset_id, layer_files.pop(hazardset_id))
+                    dispatched.append(pool.apply_async(
+                        process_chunk, ((hazardset_id, chunk),)))
+
+                hazardset_id, outputs, error = dispatched.popleft().get()
+                plan = plans[hazardset_id]
+                if hazardset_id not in merges:
+                    merges[hazardset_id] = (
+                        self.start_merge(hazardset_id, plan), [])
+                writer, errors = merges[hazardset_id]
+                if error:
+                    errors.append(error)
+                elif writer is not None and not errors:
+                    # Outputs are sent to the database as chunks are done,
+                    # not kept until the hazardset is complete
+                    if not self.merge_chunk(writer, outputs):
+                        merges[hazardset_id] = (None, errors)
+                remaining[hazardset_id] -= 1
+                if remaining[hazardset_id] > 0:
+                    continue
+                for path in shared.pop(hazardset_id, []):
+                    sharedraster.remove(path)
+                writer, errors = merges.pop(hazardset_id)
+                self.commit_outputs(hazardset_id, writer, errors, plan)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        logger.info('{} hazardsets processed in {}'
+                    .format(len(remaining), datetime.datetime.now() - chrono))
+
+    def enqueue_hazardsets(self, hazardset_ids):
+        """Split hazardsets in chunks of administrative divisions, as tasks
+        of the processing queue. Previous outputs of the divisions are
+        removed, outputs are written by the workers as tasks are done.
+        """
+        for hazardset_id in hazardset_ids:
+            try:
+                admin_ids, plan = self.hazardset_admin_ids(hazardset_id)
+                chunks = [admin_ids[i:i + CHUNK_SIZE]
+                          for i in xrange(0, len(admin_ids), CHUNK_SIZE)]
+                if len(chunks) == 0:
+                    logger.info('{}: no administrative division to process'
+                                .format(hazardset_id))
+                    transaction.abort()
+                    if plan[0] is not None:
+                        # Incremental processing with nothing to update
+                        self.commit_outputs(
+                            hazardset_id,
+                            self.start_merge(hazardset_id, plan), [], plan)
+                    continue
+
+                hazardset = DBSession.query(HazardSet).get(hazardset_id)
+                hazardset.processed = None
+                hazardset.fingerprint = None
+                hazardset.processing_error = None
+                self.clean_outputs(hazardset, plan[0])
+                workqueue.enqueue(hazardset_id, chunks, plan[1])
+                transaction.commit()
+                logger.info('{}: {} administrative divisions in {} tasks'
+                            .format(hazardset_id, len(admin_ids),
+                                    len(chunks)))
+            except Exception:
+                transaction.abort()
+                logger.error(traceback.format_exc())
+
+    def run_queue(self, workers, lease):
+        """Run the tasks of the processing queue in worker processes, or
+        in the current one"""
+        if workers == 1:
+            self.work(lease)
+            return
+
+        # Forked workers must not share the connections of this process
+        DBSession.remove()
+        DBSession.bind.dispose()
+
+        pool = multiprocessing.Pool(workers,
+                                    initializer=init_worker,
+                                    initargs=(self.settings,
+                                              self.worker_options()))
+        try:
+            pool.map(work, [lease] * workers, chunksize=1)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def work(self, lease):
+        """Claim and run the tasks of the processing queue, until no task
+        is left. Tasks held by other workers are waited for, as they are
+        given back to the queue if their worker stops sending heartbeats.
+        """
+        worker = workqueue.worker_name()
+        count = 0
+        chrono = datetime.datetime.now()
+        while True:
+            task = workqueue.claim(worker, lease)
+            if task is None:
+                left = workqueue.unfinished()
+                transaction.abort()
+                if left == 0:
+                    break
+                time.sleep(workqueue.POLL_INTERVAL)
+                continue
+            task_id = task.id
+            hazardset_id = task.hazardset_id
+            admin_ids = task.admin_ids
+            attempts = task.attempts
+            # Hashes are recorded if the tasks were enqueued incrementally
+            self.hash_divisions = task.divisions_fingerprint is not None
+            transaction.commit()
+
+            logger.info('{}: task {} of {}'
+                        .format(worker, task_id, hazardset_id))
+            if attempts > workqueue.MAX_ATTEMPTS:
+                outputs, error = [], ('Processing of hazardset {} abandoned '
+                                      'after {} attempts'
+                                      .format(hazardset_id, attempts - 1))
+            else:
+                heartbeat = workqueue.Heartbeat(DBSession.bind, task_id,
+                                                worker, lease / 3.0)
+                heartbeat.start()
+                try:
+                    outputs, error = self.process_chunk(hazardset_id,
+                                                        admin_ids)
+                except Exception:
+                    logger.error(traceback.format_exc())
+                    outputs, error = [], ('Processing of hazardset {} '
+                                          'failed'.format(hazardset_id))
+                finally:
+                    heartbeat.stop()
+                    transaction.abort()
+
+            try:
+                if workqueue.complete(task_id, hazardset_id, worker,
+                                      outputs, error):
+                    count += 1
+                else:
+                    logger.info('{}: task {} was given to another worker'
+                                .format(worker, task_id))
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                logger.error(traceback.format_exc())
+        logger.info('{}: {} tasks run in {}'
+                    .format(worker, count, datetime.datetime.now() - chrono))
+
+    def start_merge(self, hazardset_id, plan):
+        """Remove the previous outputs of a hazardset processed by chunks,
+        and return the writer of its new outputs, None on error"""
+        try:
+            hazardset = DBSession.query(HazardSet).get(hazardset_id)
+            hazardset.processed = None
+            hazardset.fingerprint = None
+            logger.info("  Cleaning previous outputs of {}"
+                        .format(hazardset_id))
+            self.clean_outputs(hazardset, plan[0])
+            return OutputWriter(hazardset_id)
+        except Exception:
+            transaction.abort()
+            logger.error(traceback.format_exc())
+            return None
+
+    def merge_chunk(self, writer, outputs):
+        """Write the outputs of a chunk, return False on error"""
+        try:
+            for admin_id, hazardlevel_id, fingerprint in outputs:
+                writer.write(admin_id, hazardlevel_id, fingerprint)
+            return True
+        except Exception:
+            transaction.abort()
+            logger.error(traceback.format_exc())
+            return False
+
+    def commit_outputs(self, hazardset_id, writer, errors, plan):
+        if writer is None:
+            # Merge failed, reported already
+            return
+        try:
+            self.merge_outputs(hazardset_id, writer, errors, plan)
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            logger.error(traceback.format_exc())
+
+    def worker_options(self):
+        """Attributes to copy to the worker processors"""
+        return {
+            'force': self.force,
+            'engine': self.engine,
+            'block_cache_size': self.block_cache_size,
+            'use_division_index': self.use_division_index,
+            'index_fingerprint': self.index_fingerprint,
+            'use_pyramid': self.use_pyramid,
+            'window_budget': self.window_budget,
+            'shared_path': self.shared_path,
+            'hash_divisions': self.hash_divisions,
+        }
+
+    def hazardset_admin_ids(self, hazardset_id):
+        """Return the ids of the administrative divisions to process for
+        the given hazardset, and the processing plan to merge outputs with.
+        """
+        hazardset = DBSession.query(HazardSet).get(hazardset_id)
+        if hazardset is None:
+            raise ProcessException('Hazardset {} does not exist.'
+                                   .format(hazardset_id))
+
+        self.type_settings = self.settings['hazard_types'][
+            hazardset.hazardtype.mnemonic]
+
+        with rasterio.drivers():
+            try:
+                self.open_readers(hazardset)
+                plan = self.plan(hazardset)
+                if plan[0] is not None:
+                    return plan[0], plan
+                admindivs = self.admindivs_query(hazardset) \
+                    .with_entities(AdministrativeDivision.id)
+                return [admindiv.id for admindiv in admindivs], plan
+            finally:
+                self.close_readers()
+
+    def process_chunk(self, hazardset_id, admin_ids):
+        """Compute hazard levels for a subset of the administrative divisions
+        of a hazardset. Nothing is written to the database, the result is a
+        list of (admin_id, hazardlevel_id) tuples and an error message.
+        """
+        hazardset = DBSession.query(HazardSet).get(hazardset_id)
+        if hazardset is None:
+            raise ProcessException('Hazardset {} does not exist.'
+                                   .format(hazardset_id))
+
+        self.type_settings = self.settings['hazard_types'][
+            hazardset.hazardtype.mnemonic]
+
+        with rasterio.drivers():
+            try:
+                self.open_readers(hazardset)
+                outputs = OutputList()
+                error = self.create_outputs(hazardset, outputs, admin_ids)
+            finally:
+                self.close_readers()
+
+        if error:
+            return [], error
+        return list(outputs), None
+
+    def merge_outputs(self, hazardset_id, writer, errors, plan):
+        """Complete the processing of a hazardset whose outputs have been
+        written by chunks to the writer"""
+        admin_ids, fingerprints = plan
+        hazardset = DBSession.query(HazardSet).get(hazardset_id)
+        hazardset.processing_error = errors[0] if errors else None
+        if hazardset.processing_error:
+            # Remove the outputs of the chunks merged before the error
+            self.clean_outputs(hazardset, admin_ids)
+            return
+
+        writer.close()
+        if writer.count == 0 and admin_ids is None:
+            return
+
+        hazardset.processed = datetime.datetime.now()
+        hazardset.fingerprint, hazardset.divisions_fingerprint = fingerprints
+        DBSession.flush()
+        logger.info('  Successfully processed {}, {} outputs generated'
+                    .format(hazardset.id, writer.count))
+
+    def hazardset_layers(self, hazardset):
+        """Return the layers used to process a hazardset, as a list of
+        (key, layer) tuples, key being the hazard level mnemonic, 'mask', or
+        0 for a preprocessed layer"""
+        layers = []
+        if 'values' in self.type_settings.keys():
+            # preprocessed layer
+            layer = DBSession.query(Layer) \
+                .filter(Layer.hazardset_id == hazardset.id) \
+                .one()
+            layers.append((0, layer))
+
+        else:
+            for level in (u'HIG', u'MED', u'LOW'):
+                hazardlevel = HazardLevel.get(level)
+                layer = DBSession.query(Layer) \
+                    .filter(Layer.hazardset_id == hazardset.id) \
+                    .filter(Layer.hazardlevel_id == hazardlevel.id) \
+                    .one()
+                layers.append((level, layer))
+            if ('mask_return_period' in self.type_settings):
+                layer = DBSession.query(Layer) \
+                    .filter(Layer.hazardset_id == hazardset.id) \
+                    .filter(Layer.mask.is_(True)) \
+                    .one()
+                layers.append(('mask', layer))
+        return layers
+
+    def layer_files(self, hazardset_id):
+        """Return the (raster path, shared path) tuples of the layers of a
+        hazardset"""
+        hazardset = DBSession.query(HazardSet).get(hazardset_id)
+        self.type_settings = self.settings['hazard_types'][
+            hazardset.hazardtype.mnemonic]
+        return [(self.raster_path(layer), self.shared_layer_path(layer))
+                for key, layer in self.hazardset_layers(hazardset)]
+
+    def share_layers(self, hazardset_id, layer_files):
+        """Decode the layers of a hazardset in the folder shared with the
+        worker processes, and return their paths. Workers read the raster
+        files of the layers which could not be decoded."""
+        paths = []
+        chrono = datetime.datetime.now()
+        try:
+            with rasterio.drivers():
+                for raster_path, path in layer_files:
+                    with rasterio.open(raster_path) as reader:
+                        paths.append(path)
+                        sharedraster.write(path, reader)
+        except Exception:
+            logger.error(traceback.format_exc())
+            # Partially decoded files must not be read
+            for path in paths:
+                sharedraster.remove(path)
+            return []
+        logger.info('{}: layers decoded in {}'
+                    .format(hazardset_id, datetime.datetime.now() - chrono))
+        return paths
+
+    def shared_layer_path(self, layer):
+        return os.path.join(self.shared_path, str(layer.geonode_id))
+
+    def open_readers(self, hazardset):
+        self.layers = {}
+        self.readers = {}
+        for key, layer in self.hazardset_layers(hazardset):
+            reader = rasterio.open(self.raster_path(layer))
+            if self.shared_path is not None:
+                path = self.shared_layer_path(layer)
+                # Pixels decoded by the parent process, only the header is
+                # read from the raster file
+                if os.path.isfile(sharedraster.data_file(path)):
+                    reader = SharedReader(reader, path)
+            self.layers[key] = layer
+            self.readers[key] = reader
+
+        self.classification = compile_plan(self.type_settings, self.layers)
+
+        grids = set((reader.shape, tuple(reader.affine))
+                    for reader in self.readers.values())
+        if (self.use_pyramid and self.engine == 'polygon' and
+                'values' not in self.type_settings):
+            if len(grids) > 1:
+                logger.info('  Layers are not on the same grid, '
+                            'not using pyramids')
+            else:
+                self.open_pyramids()
+
+        if self.block_cache_size > 0:
+            self.block_cache = BlockCache(self.block_cache_size)
+            for key, reader in self.readers.items():
+                self.readers[key] = CachedReader(reader,
+                                                 self.block_cache,
+                                                 self.layers[key].geonode_id)
+
+        if self.use_division_index and len(grids) > 1:
+            logger.info('  Layers are not on the same grid, '
+                        'not using the division index')
+        elif self.use_division_index:
+            shape, affine = grids.pop()
+            path = index_path(self.settings['data_path'],
+                              affine,
+                              shape,
+                              self.geometries_fingerprint())
+            # Keep loaded indexes for next hazardsets on the same grid
+            if path not in self.division_indexes:
+                self.division_indexes[path] = DivisionIndex(path)
+            self.division_index = self.division_indexes[path]
 
         self.bbox = None
         for reader in self.readers.itervalues():
@@ -180,90 +795,386 @@ class Processor(BaseProcessor):
             else:
                 self.bbox = self.bbox.intersection(polygon)
 
+    def open_pyramids(self):
+        """Load the pyramids of the layers, building the missing ones"""
+        self.pyramids = {}
+        self.pyramid_stats = [0, 0, 0]
+        for key, reader in self.readers.items():
+            layer = self.layers[key]
+            checksum = layer.checksum or self.layer_checksum(layer)
+            self.pyramids[key] = load_or_build(self.settings['data_path'],
+                                               checksum,
+                                               reader)
+
+    def close_readers(self):
+        for key, reader in self.readers.iteritems():
+            if reader and not reader.closed:
+                reader.close()
+        if self.block_cache is not None:
+            logger.info('  Block cache: {}'.format(self.block_cache.stats()))
+            self.block_cache.clear()
+            self.block_cache = None
+        if self.division_index is not None:
+            logger.info('  Division index: {}'
+                        .format(self.division_index.stats()))
+            self.division_index.save()
+            self.division_index = None
+        if self.pyramids is not None:
+            logger.info('  Pyramid: {} comparisons decided from statistics, '
+                        '{} refined, {} blocks read'
+                        .format(*self.pyramid_stats))
+            self.pyramids = None
+
+    def admindivs_query(self, hazardset):
         regions_ids = [r.id for r in hazardset.regions]
+        bbox = func.ST_GeomFromText(self.bbox.wkt, 4326)
 
         # get the divisions which parents (country) are in the regions set in
-        # the hazardset
-        regions_filter = AdministrativeDivision.parent.has(
-            AdministrativeDivision.parent.has(
-                AdministrativeDivision.regions.any(Region.id.in_(regions_ids))
-            )
-        )
-
-        admindivs = DBSession.query(AdministrativeDivision) \
-            .filter(AdministrativeDivision.leveltype_id == adminlevel_reg.id) \
-            .filter(func.ST_Intersects(AdministrativeDivision.geom,
-                    func.ST_GeomFromText(self.bbox.wkt, 4326))) \
-            .filter(regions_filter) \
-            .order_by(AdministrativeDivision.id)  # Needed by windowed querying
+        # the hazardset, from their precomputed memberships, by bounding box
+        # first. Geometries of the divisions whose bounding box is within the
+        # raster bounding box are not read.
+        memberships = DBSession.query(
+            RegionMembership.admin_id,
+            func.bool_or(func.ST_Within(RegionMembership.bbox, bbox))
+            .label('within')) \
+            .filter(RegionMembership.region_id.in_(regions_ids)) \
+            .filter(RegionMembership.bbox.intersects(bbox)) \
+            .group_by(RegionMembership.admin_id) \
+            .subquery()
+
+        return DBSession.query(AdministrativeDivision) \
+            .join(memberships,
+                  memberships.c.admin_id == AdministrativeDivision.id) \
+            .filter(or_(memberships.c.within,
+                        func.ST_Intersects(AdministrativeDivision.geom,
+                                           bbox))) \
+            .order_by(spatial_order(AdministrativeDivision.geom),
+                      AdministrativeDivision.id)
+
+    def plan(self, hazardset):
+        """Return the ids of the administrative divisions to process again,
+        None for all, and the fingerprints to record once processed.
+        """
+        fingerprint = self.inputs_fingerprint()
+        if not self.hash_divisions:
+            return None, (fingerprint, None)
+
+        hashes = self.admindivs_query(hazardset) \
+            .with_entities(AdministrativeDivision.id,
+                           geometry_hash(AdministrativeDivision.geom)) \
+            .order_by(None) \
+            .order_by(AdministrativeDivision.id) \
+            .all()
+        fingerprints = (fingerprint, divisions_fingerprint(hashes))
+
+        if not self.incremental:
+            return None, fingerprints
+        if fingerprint is None or fingerprint != hazardset.fingerprint:
+            logger.info('  Inputs have changed, processing all divisions')
+            return None, fingerprints
+        if fingerprints[1] == hazardset.divisions_fingerprint:
+            logger.info('  Inputs have not changed')
+            return [], fingerprints
+
+        # Divisions without output are processed again as they may have
+        # changed
+        outputs = dict(DBSession.query(Output.admin_id, Output.fingerprint)
+                       .filter(Output.hazardset_id == hazardset.id))
+        admin_ids = set(admin_id for admin_id, hash in hashes
+                        if outputs.pop(admin_id, None) != hash)
+        # Divisions removed from the hazardset regions
+        admin_ids.update(outputs.keys())
+        logger.info('  {} administrative divisions have changed'
+                    .format(len(admin_ids)))
+        return sorted(admin_ids), fingerprints
+
+    def geometries_fingerprint(self):
+        """Fingerprint of the geometries of all the administrative
+        divisions, computed once, so that division indexes are not reused
+        after geometries have changed, whatever the way.
+        """
+        if self.index_fingerprint is None:
+            self.index_fingerprint = divisions_fingerprint(
+                DBSession.query(AdministrativeDivision.id,
+                                geometry_hash(AdministrativeDivision.geom))
+                .order_by(AdministrativeDivision.id))
+        return self.index_fingerprint
+
+    def inputs_fingerprint(self):
+        """Fingerprint of the layers and settings of the current hazardset,
+        None if a layer file is missing.
+        """
+        layers = []
+        for key, layer in sorted(self.layers.items()):
+            if layer.checksum is None:
+                layer.checksum = self.layer_checksum(layer)
+                if layer.checksum is None:
+                    return None
+            layers.append([key,
+                           layer.geonode_id,
+                           layer.checksum,
+                           layer.hazardunit,
+                           layer.local])
+        inputs = json.dumps({'layers': layers,
+                             'settings': self.type_settings},
+                            sort_keys=True)
+        return hashlib.sha1(inputs).hexdigest()
+
+    def clean_outputs(self, hazardset, admin_ids=None):
+        if admin_ids == []:
+            return
+        outputs = DBSession.query(Output) \
+            .filter(Output.hazardset_id == hazardset.id)
+        if admin_ids is not None:
+            outputs = outputs.filter(Output.admin_id.in_(admin_ids))
+        outputs.delete(synchronize_session=False)
+        statistics = DBSession.query(DivisionStatistics) \
+            .filter(DivisionStatistics.hazardset_id == hazardset.id)
+        if admin_ids is not None:
+            statistics = statistics.filter(
+                DivisionStatistics.admin_id.in_(admin_ids))
+        statistics.delete(synchronize_session=False)
+        DBSession.flush()
+
+    def create_outputs(self, hazardset, writer, admin_ids=None):
+        """Write the outputs of the administrative divisions to the writer,
+        and return an error message if any.
+        """
+        admindivs = self.admindivs_query(hazardset)
+        if admin_ids is not None:
+            admindivs = admindivs.filter(
+                AdministrativeDivision.id.in_(admin_ids))
 
         current = 0
         last_percent = 0
-        outputs = []
         total = admindivs.count()
         logger.info('  Iterating over {} administrative divisions'
                     .format(total))
 
-        # Windowed querying to limit memory usage
-        limit = 1000  # 1000 records <=> 10 Mo
-        admindivs = admindivs.limit(limit)
-        for offset in xrange(0, total, limit):
-            admindivs = admindivs.offset(offset)
-
-            for admindiv in admindivs:
-                current += 1
-
-                if admindiv.geom is None:
-                    logger.warning('    {}-{} has null geometry'
-                                   .format(admindiv.code, admindiv.name))
-                    continue
+        for batch in division_batches(admindivs,
+                                      hashes=self.hash_divisions):
+            error = self.write_outputs(hazardset, writer, batch)
+            if error:
+                return error
+
+            current += len(batch)
+            percent = int(100.0 * min(current, total) / total)
+            if percent // 10 != last_percent // 10:
+                logger.info('  ... processed {}%'.format(percent))
+                last_percent = percent
+
+        return None
+
+    def checkpointed_outputs(self, hazardset_id, admin_ids=None, after=None):
+        """Write the outputs of the administrative divisions of a hazardset
+        coming after the division key ``after``, if any. Divisions are
+        streamed from one server side cursor on a session of its own, so that
+        each batch of outputs can be committed with the key of its last
+        division as checkpoint of the hazardset. Return the number of outputs
+        written and an error message if any.
+        """
+        session = Session(bind=DBSession.bind)
+        try:
+            hazardset = DBSession.query(HazardSet).get(hazardset_id)
+            admindivs = self.admindivs_query(hazardset).with_session(session)
+            if admin_ids is not None:
+                admindivs = admindivs.filter(
+                    AdministrativeDivision.id.in_(admin_ids))
+            if after is not None:
+                admindivs = admindivs.filter(
+                    tuple_(spatial_order(AdministrativeDivision.geom),
+                           AdministrativeDivision.id) > tuple_(*after))
+
+            count = 0
+            current = 0
+            total = admindivs.count()
+            logger.info('  Iterating over {} administrative divisions'
+                        .format(total))
+
+            for batch in division_batches(admindivs,
+                                          hashes=self.hash_divisions,
+                                          keys=True):
+                hazardset = DBSession.query(HazardSet).get(hazardset_id)
+                self.layers = dict(
+                    (key, DBSession.query(Layer).get(inspect(layer).identity))
+                    for key, layer in self.layers.iteritems())
+
+                writer = OutputWriter(hazardset_id)
+                error = self.write_outputs(hazardset, writer,
+                                           [row[:5] for row in batch])
+                if error:
+                    return count, error
+                writer.close()
+                count += writer.count
 
-                shape = to_shape(admindiv.geom)
+                hazardset.checkpoint_key, hazardset.checkpoint_id = \
+                    batch[-1][5], batch[-1][0]
+                transaction.commit()
 
-                # Try block to include admindiv.code in exception message
+                current += len(batch)
+                logger.info('  ... processed {}%, checkpoint committed'
+                            .format(int(100.0 * min(current, total) / total)))
+            return count, None
+        finally:
+            session.close()
+
+    def checkpoint(self, hazardset, fingerprints):
+        """Return the key of the last division whose output has been
+        committed by an interrupted processing of the hazardset with the same
+        inputs, or None.
+        """
+        if hazardset.checkpoint_id is None:
+            return None
+        fingerprint = checkpoint_fingerprint(fingerprints)
+        if fingerprint is None or \
+                fingerprint != hazardset.checkpoint_fingerprint:
+            logger.info('  Inputs have changed since last checkpoint')
+            return None
+        logger.info('  Resuming after division {}'
+                    .format(hazardset.checkpoint_id))
+        return hazardset.checkpoint_key, hazardset.checkpoint_id
+
+    def write_outputs(self, hazardset, writer, batch):
+        """Write the outputs of a batch of administrative divisions, as
+        (id, code, name, WKB, geometry hash) tuples, to the writer, and return
+        an error message if any.
+        """
+        divisions = []
+        fingerprints = {}
+        for admin_id, code, name, geometry, fingerprint in batch:
+            fingerprints[admin_id] = fingerprint
+            if geometry is None:
+                logger.warning('    {}-{} has null geometry'
+                               .format(code, name))
+            else:
+                divisions.append((admin_id,
+                                  code,
+                                  self.division_geometry(
+                                      wkb.loads(str(geometry)),
+                                      admin_id)))
+
+        hazardlevels, error = self.hazardlevels(hazardset, divisions)
+        if error:
+            return error
+
+        for (admin_id, code, shape), hazardlevel in \
+                zip(divisions, hazardlevels):
+            # Create output record
+            if hazardlevel is not None:
+                writer.write(admin_id,
+                             hazardlevel.id,
+                             fingerprints[admin_id])
+        if self.statistics:
+            self.write_statistics(hazardset.id)
+        return None
+
+    def write_statistics(self, hazardset_id):
+        """Insert the statistics of the divisions classified since last
+        call"""
+        rows = []
+        for admin_id, statistics in self.division_statistics:
+            for layer, layer_statistics in sorted(statistics.iteritems()):
+                row = layer_statistics.row()
+                row.update(hazardset_id=hazardset_id,
+                           admin_id=admin_id,
+                           layer=layer)
+                rows.append(row)
+        self.division_statistics = []
+        if rows:
+            # Pending changes, like deletion of previous statistics, first
+            DBSession.flush()
+            DBSession.execute(DivisionStatistics.__table__.insert(), rows)
+
+    def division_geometry(self, geometry, key):
+        """Return the geometry of a division with its polygons crossing the
+        antimeridian split in two, computed once per division key and kept
+        for the next hazardsets.
+        """
+        if not any(crosses_antimeridian(polygon)
+                   for polygon in geometry.geoms):
+            return geometry
+        if key not in self.split_geometries:
+            self.split_geometries[key] = split_antimeridian(geometry)
+        return self.split_geometries[key]
+
+    def hazardlevels(self, hazardset, divisions):
+        """Return the hazard levels of a list of (id, code, shape) tuples
+        and an error message.
+        """
+        hazardtype = hazardset.hazardtype.mnemonic
+
+        if self.statistics:
+            hazardlevels = []
+            for admin_id, code, shape in divisions:
                 try:
-                    if 'values' in self.type_settings.keys():
-                        # preprocessed layer
-                        hazardlevel = self.preprocessed_hazardlevel(shape)
-                    else:
-                        hazardlevel = self.notpreprocessed_hazardlevel(
-                            hazardset.hazardtype.mnemonic,
-                            shape)
-
-                except:
+                    hazardlevel, statistics = self.statistics_hazardlevel(
+                        shape,
+                        admin_id=admin_id)
+                except Exception:
                     error = ("Processing of div. {} failed"
-                             .format(admindiv.code))
+                             .format(code))
                     logger.error(error,
                                  exc_info=True)
-                    return [], error
+                    return None, error
+                hazardlevels.append(hazardlevel)
+                self.division_statistics.append((admin_id, statistics))
+            return hazardlevels, None
 
-                # Create output record
-                if hazardlevel is not None:
-                    output = Output()
-                    output.hazardset = hazardset
-                    output.admin_id = admindiv.id
-                    output.hazardlevel = hazardlevel
-                    outputs.append(output)
-
-                # Remove admindiv from memory
-                DBSession.expunge(admindiv)
+        if self.engine == 'tile':
+            try:
+                classifier = TileClassifier(self, hazardtype)
+                return classifier.hazardlevels(
+                    [shape for admin_id, code, shape in divisions]), None
+            except Exception:
+                error = ("Processing of div. {} to {} failed"
+                         .format(divisions[0][1], divisions[-1][1]))
+                logger.error(error,
+                             exc_info=True)
+                return None, error
+
+        preprocessed = self.classification_plan().preprocessed
+        hazardlevels = []
+        for admin_id, code, shape in divisions:
+            # Try block to include admindiv.code in exception message
+            try:
+                if preprocessed:
+                    # preprocessed layer
+                    hazardlevel = self.preprocessed_hazardlevel(
+                        shape,
+                        admin_id=admin_id)
+                else:
+                    hazardlevel = self.notpreprocessed_hazardlevel(
+                        hazardtype,
+                        shape,
+                        admin_id=admin_id)
 
-                percent = int(100.0 * current / total)
-                if percent % 10 == 0 and percent != last_percent:
-                    logger.info('  ... processed {}%'.format(percent))
-                    last_percent = percent
+            except Exception:
+                error = ("Processing of div. {} failed"
+                         .format(code))
+                logger.error(error,
+                             exc_info=True)
+                return None, error
 
-        return outputs, None
+            hazardlevels.append(hazardlevel)
+        return hazardlevels, None
 
-    def preprocessed_hazardlevel(self, geometry):
-        hazardlevel = None
+    def preprocessed_hazardlevel(self, geometry, admin_id=None):
+        weight = 0
         reader = self.readers[0]
+        lookup = self.classification_plan().lookup
 
-        for polygon in geometry.geoms:
+        for i, polygon in enumerate(geometry.geoms):
             if not polygon.intersects(self.bbox):
                 continue
 
             window = reader.window(*polygon.bounds)
+            if self.exceeds_budget(window):
+                weight = max(weight, self.chunked_weight(polygon, window,
+                                                         lookup))
+                if weight == level_weights[u'HIG']:
+                    break
+                continue
+
             data = reader.read(1, window=window, masked=True)
 
             if data.shape[0] * data.shape[1] == 0:
@@ -271,35 +1182,31 @@ class Processor(BaseProcessor):
             if data.mask.all():
                 continue
 
-            geometry_mask = features.geometry_mask(
-                [polygon],
-                out_shape=data.shape,
-                transform=reader.window_transform(window),
-                all_touched=True)
+            geometry_mask = self.geometry_mask(admin_id, i, polygon,
+                                               reader, window, data.shape)
 
             data.mask = data.mask | geometry_mask
             del geometry_mask
 
-            if data.mask.all():
-                continue
-
-            for level in (u'HIG', u'MED', u'LOW', u'VLO'):
-                level_obj = HazardLevel.get(level)
-                if level_obj <= hazardlevel:
-                    break
+            weight = max(weight, lookup.max_weight(data))
+            if weight == level_weights[u'HIG']:
+                break
 
-                if level in self.type_settings['values']:
-                    values = self.type_settings['values'][level]
-                    for value in values:
-                        if value in data:
-                            hazardlevel = level_obj
-                            break
+        return level_from_weight(weight)
 
-        return hazardlevel
+    def classification_plan(self):
+        """Classification plan of the current hazardset, compiled when its
+        readers are opened, or from the current settings and layers."""
+        if self.classification is None or \
+                self.classification.settings is not self.type_settings:
+            self.classification = compile_plan(self.type_settings,
+                                               self.layers)
+        return self.classification
 
     def notpreprocessed_hazardlevel(self,
                                     hazardtype,
-                                    geometry):
+                                    geometry,
+                                    admin_id=None):
         level_vlo = HazardLevel.get(u'VLO')
 
         hazardlevel = None
@@ -309,18 +1216,12 @@ class Processor(BaseProcessor):
         bboxes = {}
         geometry_masks = {}  # Storage for the geometry geometry_masks
 
-        inverted_comparison = ('inverted_comparison' in self.type_settings and
-                               self.type_settings['inverted_comparison'])
+        plan = self.classification_plan()
 
-        for level in (u'HIG', u'MED', u'LOW'):
-            layer = self.layers[level]
+        for level, threshold in plan.levels:
+            level_hazardlevel = HazardLevel.get(level)
             reader = self.readers[level]
 
-            threshold = self.get_threshold(hazardtype,
-                                           layer.local,
-                                           layer.hazardlevel.mnemonic,
-                                           layer.hazardunit)
-
             for i in xrange(0, len(geometry.geoms)):
                 if i not in polygons:
                     polygon = geometry.geoms[i]
@@ -336,6 +1237,22 @@ class Processor(BaseProcessor):
 
                 window = reader.window(*bbox)
 
+                compare = None
+                if self.pyramids is not None:
+                    compare = self.pyramid_compare
+                elif self.exceeds_budget(window):
+                    compare = self.chunked_compare
+                if compare is not None:
+                    above, valid = compare(
+                        level, polygon, window, threshold,
+                        need_valid=hazardlevel is None)
+                    if above:
+                        hazardlevel = level_hazardlevel
+                        break
+                    if valid and hazardlevel is None:
+                        hazardlevel = level_vlo
+                    continue
+
                 # data: MaskedArray
                 data = reader.read(1, window=window, masked=True)
 
@@ -346,32 +1263,19 @@ class Processor(BaseProcessor):
                 if data.mask.all():
                     continue
 
-                if inverted_comparison:
-                    data = data < threshold
-                else:
-                    data = data > threshold
+                data = plan.exceeds(data, threshold)
 
                 # some hazard types have a specific mask layer with very low
                 # return period which should be used as mask for other layers
                 # for example River Flood
-                if ('mask_return_period' in self.type_settings):
-                    mask_layer = self.layers['mask']
+                if plan.mask_threshold is not None:
                     mask_reader = self.readers['mask']
 
-                    mask_threshold = self.get_threshold(
-                        hazardtype,
-                        mask_layer.local,
-                        u'MASK',
-                        mask_layer.hazardunit)
-
                     mask_window = mask_reader.window(*bbox)
                     mask = self.readers['mask'].read(1,
                                                      window=mask_window,
                                                      masked=True)
-                    if inverted_comparison:
-                        mask = mask < mask_threshold
-                    else:
-                        mask = mask > mask_threshold
+                    mask = plan.masked(mask)
 
                     # apply the specific layer mask
                     data.mask = ma.getmaskarray(data) | mask.filled(False)
@@ -382,11 +1286,9 @@ class Processor(BaseProcessor):
                 if i in geometry_masks:
                     geometry_mask = geometry_masks[i]
                 else:
-                    geometry_mask = features.geometry_mask(
-                        [polygon],
-                        out_shape=data.shape,
-                        transform=reader.window_transform(window),
-                        all_touched=True)
+                    geometry_mask = self.geometry_mask(admin_id, i, polygon,
+                                                       reader, window,
+                                                       data.shape)
                     geometry_masks[i] = geometry_mask
 
                 data.mask = ma.getmaskarray(data) | geometry_mask
@@ -395,7 +1297,7 @@ class Processor(BaseProcessor):
                 # If at least one value is True this means that there's
                 # at least one raw value > threshold
                 if data.any():
-                    hazardlevel = layer.hazardlevel
+                    hazardlevel = level_hazardlevel
                     break
 
                 # check one last time is array is filled with NODATA
@@ -409,28 +1311,424 @@ class Processor(BaseProcessor):
 
             # we got a value for the level, no need to go further, this will be
             # the highest one
-            if hazardlevel == layer.hazardlevel:
+            if hazardlevel == level_hazardlevel:
                 break
 
         return hazardlevel
 
+    def statistics_hazardlevel(self, geometry, admin_id=None):
+        """Return the hazard level of a division and the statistics of the
+        pixels of each layer touched by the division, with the pixels of the
+        mask layer, reading all of them. The level is the one computed from
+        the statistics.
+        """
+        plan = self.classification_plan()
+        statistics = dict(
+            (layer, Statistics(mask=plan.mask_threshold is not None))
+            for layer in layer_names(plan))
+
+        for key, reader in self.readers.iteritems():
+            if key == 'mask':
+                continue
+            layer_statistics = statistics[layer_name(key)]
+            for i, polygon in enumerate(geometry.geoms):
+                if not polygon.intersects(self.bbox):
+                    continue
+                window = reader.window(*polygon.bounds)
+                chunked = self.exceeds_budget(window)
+                windows = self.chunks(reader, window) if chunked \
+                    else [window]
+                for chunk in windows:
+                    data = reader.read(1, window=chunk, masked=True)
+                    if data.size == 0 or ma.getmaskarray(data).all():
+                        continue
+                    mask_data = None
+                    if plan.mask_threshold is not None:
+                        mask_data = self.readers['mask'].read(1,
+                                                              window=chunk,
+                                                              masked=True)
+                    mask = ma.getmaskarray(data)
+                    if chunked:
+                        mask = mask | features.geometry_mask(
+                            [polygon],
+                            out_shape=data.shape,
+                            transform=reader.window_transform(chunk),
+                            all_touched=True)
+                    else:
+                        mask = mask | self.geometry_mask(admin_id, i,
+                                                         polygon, reader,
+                                                         chunk, data.shape)
+                    layer_statistics.add(
+                        ma.masked_array(ma.getdata(data), mask), mask_data)
+
+        level = classify(plan, statistics)
+        if level is None:
+            return None, statistics
+        return HazardLevel.get(level), statistics
+
+    def pyramid_compare(self, level, polygon, window, threshold, need_valid):
+        """Compare the pixels of the window touched by a polygon with the
+        threshold of a level, from the pyramid of the layer, reading only the
+        blocks which remain ambiguous. Return whether a pixel is beyond
+        threshold, and whether a pixel is valid, when need_valid is True.
+        """
+        reader = self.readers[level]
+        plan = self.classification_plan()
+        mask = None
+        if plan.mask_threshold is not None:
+            mask = (self.pyramids['mask'], plan.mask_threshold)
+
+        above, valid, ambiguous, uncertain = self.pyramids[level].classify(
+            polygon, window, reader.affine, threshold,
+            inverted=plan.inverted, mask=mask)
+        blocks = ambiguous
+        if need_valid and not valid:
+            blocks = blocks + uncertain
+        if above or not blocks:
+            self.pyramid_stats[0] += 1
+            return above, valid
+        self.pyramid_stats[1] += 1
+        self.pyramid_stats[2] += len(blocks)
+
+        for block_window in blocks:
+            block_above, block_valid = self.compare_window(
+                level, polygon, block_window, threshold)
+            if block_above:
+                return True, True
+            valid = valid or block_valid
+        return False, valid
+
+    def chunked_compare(self, level, polygon, window, threshold, need_valid):
+        """Compare the pixels of the window touched by a polygon with the
+        threshold of a level, reading the window in chunks within the memory
+        budget, and stopping at the first pixel beyond threshold. Return
+        whether a pixel is beyond threshold, and whether a pixel is valid.
+        """
+        reader = self.readers[level]
+        prepared = prep(polygon)
+        valid = False
+        for chunk in self.chunks(reader, window):
+            if not prepared.intersects(box(*pixel_bounds(reader.affine,
+                                                         *chunk))):
+                continue
+            chunk_above, chunk_valid = self.compare_window(
+                level, polygon, chunk, threshold)
+            if chunk_above:
+                return True, True
+            valid = valid or chunk_valid
+        return False, valid
+
+    def compare_window(self, level, polygon, window, threshold):
+        """Compare the pixels of a window touched by a polygon with the
+        threshold of a level. Return whether a pixel is beyond threshold,
+        and whether a pixel is valid.
+        """
+        reader = self.readers[level]
+        plan = self.classification_plan()
+        data = reader.read(1, window=window, masked=True)
+        if data.size == 0 or ma.getmaskarray(data).all():
+            return False, False
+
+        data = plan.exceeds(data, threshold)
+
+        if plan.mask_threshold is not None:
+            mask_data = plan.masked(self.readers['mask'].read(1,
+                                                              window=window,
+                                                              masked=True))
+            data.mask = ma.getmaskarray(data) | mask_data.filled(False)
+            del mask_data
+
+        data.mask = ma.getmaskarray(data) | features.geometry_mask(
+            [polygon],
+            out_shape=data.shape,
+            transform=reader.window_transform(window),
+            all_touched=True)
+
+        if data.any():
+            return True, True
+        return False, not data.mask.all()
+
+    def chunked_weight(self, polygon, window, lookup):
+        """Highest level weight of the pixels of the window touched by a
+        polygon, in a preprocessed layer, reading the window in chunks
+        within the memory budget.
+        """
+        reader = self.readers[0]
+        prepared = prep(polygon)
+        weight = 0
+        for chunk in self.chunks(reader, window):
+            if not prepared.intersects(box(*pixel_bounds(reader.affine,
+                                                         *chunk))):
+                continue
+            data = reader.read(1, window=chunk, masked=True)
+            if data.size == 0 or ma.getmaskarray(data).all():
+                continue
+            data.mask = ma.getmaskarray(data) | features.geometry_mask(
+                [polygon],
+                out_shape=data.shape,
+                transform=reader.window_transform(chunk),
+                all_touched=True)
+            weight = max(weight, lookup.max_weight(data))
+            if weight == level_weights[u'HIG']:
+                break
+        return weight
+
+    def exceeds_budget(self, window):
+        """Whether reading a window at once would exceed the memory
+        budget"""
+        if not self.window_budget:
+            return False
+        (row_start, row_stop), (col_start, col_stop) = window
+        pixels = (row_stop - row_start) * (col_stop - col_start)
+        return pixels * WINDOW_PIXEL_BYTES > self.window_budget
+
+    def chunks(self, reader, window):
+        """Split a window, clipped to the raster, in strips of rows within
+        the memory budget"""
+        return sub_windows(window, reader.shape,
+                           max(self.window_budget // WINDOW_PIXEL_BYTES, 1))
+
+    def geometry_mask(self, admin_id, index, polygon, reader, window, shape):
+        """Mask of the pixels of the window not touched by the polygon, which
+        is the polygon of given index in the division geometry.
+        """
+        division_index = self.division_index
+        if division_index is not None and admin_id is not None:
+            geometry_mask = division_index.mask(admin_id, index,
+                                                window, shape)
+            if geometry_mask is not None:
+                return geometry_mask
+
+        geometry_mask = features.geometry_mask(
+            [polygon],
+            out_shape=shape,
+            transform=reader.window_transform(window),
+            all_touched=True)
+
+        if division_index is not None and admin_id is not None:
+            division_index.add(admin_id, index, window, geometry_mask)
+        return geometry_mask
+
     def get_threshold(self, hazardtype, local, level, unit):
-        mysettings = self.settings['hazard_types'][hazardtype]['thresholds']
-        while type(mysettings) is dict:
-            if 'local' in mysettings.keys():
-                mysettings = mysettings['local' if local else 'global']
-            elif 'HIG' in mysettings.keys():
-                mysettings = mysettings[level]
-            elif unit in mysettings.keys():
-                mysettings = mysettings[unit]
-            else:
-                raise ProcessException(
-                    'No threshold found for {} {} {} {}'
-                    .format(hazardtype,
-                            'local' if local else 'global',
-                            level,
-                            unit))
-        return float(mysettings)
+        threshold = find_threshold(
+            self.settings['hazard_types'][hazardtype]['thresholds'],
+            local, level, unit)
+        if threshold is None:
+            raise ProcessException(
+                'No threshold found for {} {} {} {}'
+                .format(hazardtype,
+                        'local' if local else 'global',
+                        level,
+                        unit))
+        return float(threshold)
+
+
+def add_engine_arguments(parser):
+    """Add the options of the classification of administrative divisions,
+    shared with the pipeline"""
+    parser.add_argument(
+        '--engine', dest='engine', choices=('polygon', 'tile'),
+        default='polygon',
+        help='Classify administrative divisions polygon by polygon or '
+             'raster tile by raster tile. Defaults to polygon')
+    parser.add_argument(
+        '--block-cache', dest='block_cache', type=int, default=0,
+        help='Size in MB of the cache of decoded raster blocks. '
+             'Defaults to 0 (no cache)')
+    parser.add_argument(
+        '--division-index', dest='division_index',
+        action='store_const', const=True, default=False,
+        help='Store the pixels touched by the divisions for each raster '
+             'grid in data_path, and reuse them for next hazardsets')
+    parser.add_argument(
+        '--pyramid', dest='pyramid',
+        action='store_const', const=True, default=False,
+        help='Compare divisions with thresholds from min/max statistics '
+             'of raster blocks, stored in data_path, and only read the '
+             'blocks which remain ambiguous')
+    parser.add_argument(
+        '--memory-budget', dest='memory_budget', type=int, default=256,
+        help='Size in MB above which the window of a division polygon is '
+             'read in chunks. Defaults to 256, 0 for no limit')
+
+
+# Processor instance used by the current worker process
+worker_processor = None
+
+
+def init_worker(settings, options):
+    """Initialize a worker process with its own database connections"""
+    global worker_processor
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.remove()
+    DBSession.configure(bind=engine)
+    worker_processor = Processor()
+    worker_processor.settings = settings
+    for key, value in options.iteritems():
+        setattr(worker_processor, key, value)
+
+
+def work(lease):
+    worker_processor.work(lease)
+
+
+def process_chunk(task):
+    hazardset_id, admin_ids = task
+    try:
+        outputs, error = worker_processor.process_chunk(hazardset_id,
+                                                        admin_ids)
+    except Exception:
+        logger.error(traceback.format_exc())
+        outputs, error = [], ('Processing of hazardset {} failed'
+                              .format(hazardset_id))
+    finally:
+        transaction.abort()
+    return hazardset_id, outputs, error
+
+
+def division_batches(query, size=BATCH_SIZE, hashes=True, keys=False):
+    """Stream the administrative divisions of the query from a server side
+    cursor, in lists of (id, code, name, WKB, geometry hash) tuples, the
+    hash being None without hashes. With keys, the spatial order of the
+    division is appended, (spatial order, id) being the key of the division
+    in the query order.
+    """
+    columns = [AdministrativeDivision.id,
+               AdministrativeDivision.code,
+               AdministrativeDivision.name,
+               func.ST_AsBinary(AdministrativeDivision.geom),
+               geometry_hash(AdministrativeDivision.geom) if hashes
+               else null()]
+    if keys:
+        columns.append(spatial_order(AdministrativeDivision.geom))
+    rows = query \
+        .with_entities(*columns) \
+        .yield_per(size)
+    batch = []
+    for row in rows:
+        batch.append(tuple(row))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def divisions_fingerprint(hashes):
+    """Fingerprint of (admin_id, geometry hash) tuples"""
+    sha1 = hashlib.sha1()
+    for admin_id, hash in hashes:
+        sha1.update('{}:{},'.format(admin_id, hash))
+    return sha1.hexdigest()
+
+
+def checkpoint_fingerprint(fingerprints):
+    """Fingerprint of the inputs and divisions of a checkpoint, None if
+    unknown"""
+    if fingerprints[0] is None:
+        return None
+    return '{}:{}'.format(*fingerprints)
+
+
+def clear_checkpoint(hazardset):
+    hazardset.checkpoint_key = None
+    hazardset.checkpoint_id = None
+    hazardset.checkpoint_fingerprint = None
+
+
+def geometry_hash(geom):
+    return func.md5(func.ST_AsEWKB(geom))
+
+
+def spatial_order(geom):
+    """Sort key visiting geometries along a Z-order curve (geohash of the
+    bounding box center), so that neighbour divisions read the same raster
+    blocks one after the other.
+    """
+    return func.ST_GeoHash(func.ST_Centroid(func.ST_Envelope(geom)), 12)
+
+
+def sub_windows(window, shape, max_pixels):
+    """Split a window, clipped to a raster of given shape, in windows of
+    at most max_pixels pixels: strips of rows, or parts of rows for rows
+    larger than max_pixels.
+    """
+    height, width = shape
+    (row_start, row_stop), (col_start, col_stop) = window
+    row_start, row_stop = max(row_start, 0), min(row_stop, height)
+    col_start, col_stop = max(col_start, 0), min(col_stop, width)
+    cols = min(max(col_stop - col_start, 1), max_pixels)
+    rows = max(max_pixels // cols, 1)
+    windows = []
+    for row in xrange(row_start, row_stop, rows):
+        for col in xrange(col_start, col_stop, cols):
+            windows.append(((row, min(row + rows, row_stop)),
+                            (col, min(col + cols, col_stop))))
+    return windows
+
+
+def crosses_antimeridian(polygon):
+    """Whether a polygon crosses the antimeridian, having an edge which
+    jumps from one side of it to the other. Edges along the antimeridian,
+    like those of Antarctica, have their ends at -180 or 180.
+    """
+    minx, miny, maxx, maxy = polygon.bounds
+    if maxx - minx <= 180:
+        return False
+    x = np.array(polygon.exterior.coords)[:, 0]
+    jumps = np.abs(np.diff(x)) > 180
+    ends = (np.abs(x[:-1]) == 180) | (np.abs(x[1:]) == 180)
+    return bool((jumps & ~ends).any())
+
+
+def shift_longitude(polygon):
+    """Polygon with longitudes in the 0-360 range, like
+    ST_Shift_Longitude"""
+    def shift(x, y):
+        x = np.asarray(x)
+        return np.where(x < 0, x + 360, x), y
+    return transform(shift, polygon)
+
+
+def split_antimeridian(geometry):
+    """Split the polygons of a multipolygon which cross the antimeridian
+    into parts on each side of it, so that their windows only cover the
+    pixels near +180 and -180 instead of the whole raster width.
+    """
+    polygons = []
+    for polygon in geometry.geoms:
+        if not crosses_antimeridian(polygon):
+            polygons.append(polygon)
+            continue
+        shifted = shift_longitude(polygon)
+        minx, miny, maxx, maxy = shifted.bounds
+        if not shifted.is_valid:
+            shifted = shifted.buffer(0)
+        east = shifted.intersection(box(minx, miny, 180, maxy))
+        west = translate(shifted.intersection(box(180, miny, maxx, maxy)),
+                         -360)
+        for part in (east, west):
+            polygons.extend(polygon_parts(part))
+    return MultiPolygon(polygons)
+
+
+def polygon_parts(geometry):
+    """Polygons of the result of an intersection, which may also contain
+    lines and points"""
+    if geometry.geom_type == 'Polygon':
+        return [geometry] if not geometry.is_empty else []
+    if hasattr(geometry, 'geoms'):
+        return [part for part in geometry.geoms
+                if part.geom_type == 'Polygon' and not part.is_empty]
+    return []
+
+
+def level_from_weight(weight):
+    """Hazard level of a level weight, None for 0"""
+    for mnemonic, level_weight in level_weights.iteritems():
+        if mnemonic is not None and level_weight == weight:
+            return HazardLevel.get(mnemonic)
+    return None
 
 
 def polygon_from_boundingbox(boundingbox):
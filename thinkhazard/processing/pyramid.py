@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from numpy import ma
+from shapely.geometry import box
+from shapely.prepared import prep
+
+
+# Folder of the pyramid files, in data_path
+PYRAMID_DIR = 'pyramids'
+
+# Size in pixels of the smallest blocks
+BLOCK_SIZE = 16
+
+# Each block of a level covers FACTOR x FACTOR blocks of the level below
+FACTOR = 4
+
+# Rows of pixels read at once to build a pyramid
+STRIP_ROWS = 512
+
+
+class Pyramid(object):
+    """Minimum, maximum and number of valid pixels per square block of a
+    raster, for increasing block sizes, to compare the pixels touched by a
+    polygon with a threshold without reading them all.
+
+    Overviews are not enough as they average values.
+    """
+
+    def __init__(self, shape, block_size, factor, levels):
+        self.shape = tuple(shape)
+        self.block_size = block_size
+        self.factor = factor
+        # (min, max, count) arrays, from the smallest blocks to the largest
+        self.levels = levels
+
+    @classmethod
+    def build(cls, reader, block_size=BLOCK_SIZE, factor=FACTOR):
+        height, width = reader.shape
+        rows = -(-height // block_size)
+        cols = -(-width // block_size)
+        mins = np.full((rows, cols), np.nan)
+        maxs = np.full((rows, cols), np.nan)
+        counts = np.zeros((rows, cols), dtype=np.int64)
+
+        strip = max(STRIP_ROWS // block_size, 1)
+        for row in xrange(0, rows, strip):
+            stop = min(row + strip, rows)
+            window = ((row * block_size, min(stop * block_size, height)),
+                      (0, width))
+            data = reader.read(1, window=window, masked=True)
+            if data.dtype.kind == 'f':
+                # NaN pixels, often nodata values not masked by the reader,
+                # would make the min and max of their block NaN
+                data = ma.masked_where(np.isnan(ma.getdata(data)), data)
+            padded = ma.masked_all(((stop - row) * block_size,
+                                    cols * block_size))
+            padded[:data.shape[0], :data.shape[1]] = data
+            blocks = padded \
+                .reshape(stop - row, block_size, cols, block_size) \
+                .swapaxes(1, 2) \
+                .reshape(stop - row, cols, block_size * block_size)
+            counts[row:stop] = blocks.count(axis=2)
+            mins[row:stop] = blocks.min(axis=2).filled(np.nan)
+            maxs[row:stop] = blocks.max(axis=2).filled(np.nan)
+
+        levels = [(mins, maxs, counts)]
+        while max(mins.shape) > 1:
+            mins, maxs, counts = [reduce_blocks(array, factor, function)
+                                  for array, function in
+                                  ((mins, np.fmin), (maxs, np.fmax),
+                                   (counts, np.add))]
+            levels.append((mins, maxs, counts))
+        return cls(reader.shape, block_size, factor, levels)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            levels = [(f['min{}'.format(i)],
+                       f['max{}'.format(i)],
+                       f['count{}'.format(i)])
+                      for i in xrange(0, int(f['levels']))]
+            return cls(f['shape'], int(f['block_size']), int(f['factor']),
+                       levels)
+
+    def save(self, path):
+        arrays = {
+            'shape': np.array(self.shape),
+            'block_size': self.block_size,
+            'factor': self.factor,
+            'levels': len(self.levels),
+        }
+        for i, (mins, maxs, counts) in enumerate(self.levels):
+            arrays['min{}'.format(i)] = mins
+            arrays['max{}'.format(i)] = maxs
+            arrays['count{}'.format(i)] = counts
+
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def classify(self, polygon, window, affine, threshold, inverted=False,
+                 mask=None):
+        """Compare with threshold the pixels of window touched by polygon,
+        as rasterized with all_touched, using block statistics.
+
+        Pixels beyond threshold are greater than threshold, or lower with
+        inverted comparison. mask is an optional (pyramid, threshold)
+        tuple of a layer on the same grid whose pixels beyond threshold
+        exclude the pixels of this one.
+
+        Return (above, valid, ambiguous, uncertain):
+        * above: a valid touched pixel is beyond threshold,
+        * valid: a valid touched pixel is not excluded by the mask,
+        * ambiguous: windows of the smallest blocks with touched pixels
+          which may be beyond threshold, to be read,
+        * uncertain: windows of the smallest blocks with touched pixels
+          which are not beyond threshold but may be valid, to be read if
+          valid is needed.
+        """
+        height, width = self.shape
+        (row_start, row_stop), (col_start, col_stop) = window
+        window = ((max(row_start, 0), min(row_stop, height)),
+                  (max(col_start, 0), min(col_stop, width)))
+        if window[0][0] >= window[0][1] or window[1][0] >= window[1][1]:
+            return False, False, [], []
+
+        prepared = prep(polygon)
+        top = len(self.levels) - 1
+        stack = list(self.blocks(top, window))
+        ambiguous = []
+        uncertain = []
+        valid = False
+        while stack:
+            level, row, col = stack.pop()
+            mins, maxs, counts = self.levels[level]
+            count = counts[row, col]
+            if count == 0:
+                continue
+
+            size = self.block_size * self.factor ** level
+            rows = (row * size, min((row + 1) * size, height))
+            cols = (col * size, min((col + 1) * size, width))
+            bounds = pixel_bounds(affine, rows, cols)
+            if not prepared.intersects(box(*bounds)):
+                continue
+            inside = prepared.contains(box(*bounds))
+            # Polygon reaches pixels of the block, not only its border
+            reaches = inside or prepared.intersects(
+                box(*shrink(bounds, affine)))
+            full = count == (rows[1] - rows[0]) * (cols[1] - cols[0])
+            free = mask is None or not beyond_some(
+                mask[0].levels[level], row, col, mask[1], inverted)
+
+            some = beyond_some(self.levels[level], row, col,
+                               threshold, inverted)
+            if some:
+                if free and (inside or (reaches and full and beyond_all(
+                        self.levels[level], row, col,
+                        threshold, inverted))):
+                    return True, True, [], []
+            elif free and (inside or (reaches and full)):
+                valid = True
+                continue
+            elif valid:
+                continue
+
+            if level > 0:
+                stack.extend(self.children(level, row, col, window))
+            else:
+                block_window = ((max(rows[0], window[0][0]),
+                                 min(rows[1], window[0][1])),
+                                (max(cols[0], window[1][0]),
+                                 min(cols[1], window[1][1])))
+                (ambiguous if some else uncertain).append(block_window)
+
+        return False, valid, ambiguous, [] if valid else uncertain
+
+    def blocks(self, level, window):
+        """Blocks of a level intersecting a window"""
+        size = self.block_size * self.factor ** level
+        (row_start, row_stop), (col_start, col_stop) = window
+        for row in xrange(row_start // size, (row_stop - 1) // size + 1):
+            for col in xrange(col_start // size, (col_stop - 1) // size + 1):
+                yield level, row, col
+
+    def children(self, level, row, col, window):
+        """Blocks of the level below covered by a block, intersecting a
+        window"""
+        size = self.block_size * self.factor ** level
+        (row_start, row_stop), (col_start, col_stop) = window
+        window = ((max(row_start, row * size),
+                   min(row_stop, (row + 1) * size)),
+                  (max(col_start, col * size),
+                   min(col_stop, (col + 1) * size)))
+        return self.blocks(level - 1, window)
+
+
+def beyond_some(stats, row, col, threshold, inverted):
+    """Whether some valid pixels of a block may be beyond threshold"""
+    mins, maxs, counts = stats
+    if counts[row, col] == 0:
+        return False
+    if inverted:
+        return mins[row, col] < threshold
+    return maxs[row, col] > threshold
+
+
+def beyond_all(stats, row, col, threshold, inverted):
+    """Whether all valid pixels of a block are beyond threshold"""
+    mins, maxs, counts = stats
+    if inverted:
+        return maxs[row, col] < threshold
+    return mins[row, col] > threshold
+
+
+def reduce_blocks(array, factor, function):
+    """Combine the values of factor x factor blocks of array"""
+    rows = -(-array.shape[0] // factor)
+    cols = -(-array.shape[1] // factor)
+    fill = 0 if array.dtype.kind == 'i' else np.nan
+    padded = np.full((rows * factor, cols * factor), fill, dtype=array.dtype)
+    padded[:array.shape[0], :array.shape[1]] = array
+    blocks = padded.reshape(rows, factor, cols, factor)
+    return function.reduce(function.reduce(blocks, axis=3), axis=1)
+
+
+def pixel_bounds(affine, rows, cols):
+    """Bounds of a range of pixels, as (minx, miny, maxx, maxy)"""
+    x0, y0 = affine * (cols[0], rows[0])
+    x1, y1 = affine * (cols[1], rows[1])
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def shrink(bounds, affine):
+    """Bounds reduced by half a pixel on each side"""
+    dx = abs(affine.a) / 2
+    dy = abs(affine.e) / 2
+    minx, miny, maxx, maxy = bounds
+    return minx + dx, miny + dy, maxx - dx, maxy - dy
+
+
+def pyramid_path(data_path, checksum):
+    return os.path.join(data_path, PYRAMID_DIR, checksum + '.npz')
+
+
+def load_or_build(data_path, checksum, reader):
+    """Return the pyramid of a layer file, built and saved if missing"""
+    path = pyramid_path(data_path, checksum)
+    if os.path.isfile(path):
+        return Pyramid.load(path)
+    pyramid = Pyramid.build(reader)
+    pyramid.save(path)
+    return pyramid
+
+
+def collect_garbage(data_path, checksums):
+    """Remove the pyramids of files whose checksum is not in checksums,
+    return the number of bytes freed"""
+    dir_path = os.path.join(data_path, PYRAMID_DIR)
+    if not os.path.isdir(dir_path):
+        return 0
+    used = set(checksum + '.npz' for checksum in checksums)
+    freed = 0
+    for filename in os.listdir(dir_path):
+        if filename in used:
+            continue
+        path = os.path.join(dir_path, filename)
+        freed += os.path.getsize(path)
+        os.unlink(path)
+    return freed
+
+
+def clear(data_path):
+    """Remove all pyramid files"""
+    shutil.rmtree(os.path.join(data_path, PYRAMID_DIR), ignore_errors=True)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from numpy import ma
+
+
+# Rows of pixels decoded at once
+STRIP_ROWS = 512
+
+
+class SharedReader(object):
+    """Wrap a rasterio reader so that reads of band 1 are served from the
+    pixels decoded once by the parent process in memory mapped files. The
+    pages of the files are shared by all the worker processes, windows are
+    views on them, only their masks are copied.
+    """
+
+    def __init__(self, reader, path):
+        self.reader = reader
+        self.data = np.load(data_file(path), mmap_mode='r')
+        self.mask = None
+        if os.path.isfile(mask_file(path)):
+            self.mask = np.load(mask_file(path), mmap_mode='r')
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def read(self, indexes, window=None, masked=False):
+        if indexes != 1 or window is None or not masked:
+            return self.reader.read(indexes, window=window, masked=masked)
+
+        (row_start, row_stop), (col_start, col_stop) = window
+        rows = slice(max(row_start, 0), max(row_stop, 0))
+        cols = slice(max(col_start, 0), max(col_stop, 0))
+        data = self.data[rows, cols]
+        if self.mask is None:
+            mask = np.zeros(data.shape, dtype=np.bool)
+        else:
+            mask = np.array(self.mask[rows, cols])
+        return ma.masked_array(data, mask=mask, copy=False)
+
+
+def write(path, reader):
+    """Decode band 1 of a raster in memory mapped files, strip by strip.
+    The mask file is only written for rasters with nodata pixels."""
+    height, width = reader.shape
+    data = None
+    mask = None
+    for row in xrange(0, height, STRIP_ROWS):
+        window = ((row, min(row + STRIP_ROWS, height)), (0, width))
+        strip = reader.read(1, window=window, masked=True)
+        if data is None:
+            data = np.lib.format.open_memmap(data_file(path), mode='w+',
+                                             dtype=strip.dtype,
+                                             shape=(height, width))
+        data[window[0][0]:window[0][1]] = ma.getdata(strip)
+        strip_mask = ma.getmaskarray(strip)
+        if mask is None and strip_mask.any():
+            # New files are filled with zeros, rows above are not masked
+            mask = np.lib.format.open_memmap(mask_file(path), mode='w+',
+                                             dtype=np.bool,
+                                             shape=(height, width))
+        if mask is not None:
+            mask[window[0][0]:window[0][1]] = strip_mask
+    for array in (data, mask):
+        if array is not None:
+            array.flush()
+
+
+def data_file(path):
+    return path + '.npy'
+
+
+def mask_file(path):
+    return path + '.mask.npy'
+
+
+def remove(path):
+    """Remove the files of a decoded raster"""
+    for file_path in (data_file(path), mask_file(path)):
+        if os.path.isfile(file_path):
+            os.unlink(file_path)
+
+
+def create_dir(data_path):
+    """Create a folder for the decoded rasters of a processing run"""
+    return tempfile.mkdtemp(prefix='shared-', dir=data_path)
+
+
+def remove_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
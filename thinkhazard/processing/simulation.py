@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import yaml
+from itertools import groupby
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.exc import (
+    MultipleResultsFound,
+    NoResultFound,
+    )
+
+from ..models import (
+    DBSession,
+    AdministrativeDivision,
+    AdminLevelType,
+    DivisionStatistics,
+    HazardLevel,
+    HazardSet,
+    HazardType,
+    Output,
+    )
+from . import BaseProcessor
+from .classification import (
+    ClassificationError,
+    compile_plan,
+    )
+from .processing import Processor
+from .statistics import (
+    IncompleteStatistics,
+    Statistics,
+    classify,
+    )
+
+
+class Simulator(BaseProcessor):
+    """Report how many administrative divisions would change level with
+    other processing settings, from the statistics stored by
+    process --statistics, without reading the rasters."""
+
+    @staticmethod
+    def argument_parser():
+        parser = BaseProcessor.argument_parser()
+        parser.add_argument(
+            '--settings', dest='settings_path', required=True,
+            help='Processing settings file to simulate, like '
+                 'thinkhazard_processing.yaml')
+        parser.add_argument(
+            '--hazardtype', dest='hazardtype', action='store',
+            help='Only simulate this hazard type')
+        return parser
+
+    def do_execute(self, settings_path, hazardtype=None):
+        with open(settings_path, 'r') as f:
+            hazard_types = load_hazard_types(f.read())
+        report = simulate(hazard_types, hazardtype)
+        for mnemonic, error in sorted(report['errors'].iteritems()):
+            print '{}: {}'.format(mnemonic, error)
+        print '{:<4} {:<40} {:>9} {:>9} {:>9}'.format(
+            'Type', 'Country', 'Divisions', 'Changed', 'Undecided')
+        for row in report['countries']:
+            print '{:<4} {:<40} {:>9} {:>9} {:>9}'.format(
+                row['hazardtype'],
+                row['country'][:40].encode('utf-8'),
+                row['divisions'],
+                row['changed'],
+                row['undecided'])
+
+
+def load_hazard_types(text):
+    """Hazard types settings of the content of a processing settings
+    file"""
+    settings = yaml.safe_load(text)
+    if not isinstance(settings, dict) or \
+            not isinstance(settings.get('hazard_types'), dict):
+        raise ValueError('No hazard_types in settings')
+    return settings['hazard_types']
+
+
+def simulate(hazard_types, hazardtype=None):
+    """Classify again the administrative divisions of the processed
+    hazardsets with statistics, with the given hazard types settings, and
+    count by hazard type and country the divisions which would change
+    level, and those whose statistics are not enough for the new settings.
+
+    Return a dict with a list of dicts in ``countries`` and error messages
+    of the hazard types whose settings are invalid in ``errors``.
+    """
+    countries = division_countries()
+    levels = dict((level.id, level.mnemonic)
+                  for level in DBSession.query(HazardLevel))
+    # (hazard type, country code) => (all, changed, undecided) admin ids
+    divisions = {}
+    errors = {}
+
+    hazardsets = DBSession.query(HazardSet) \
+        .join(HazardType) \
+        .filter(HazardSet.processed.isnot(None)) \
+        .order_by(HazardSet.id)
+    if hazardtype is not None:
+        hazardsets = hazardsets.filter(HazardType.mnemonic == hazardtype)
+
+    processor = Processor()
+    for hazardset in hazardsets:
+        mnemonic = hazardset.hazardtype.mnemonic
+        if mnemonic in errors or mnemonic not in hazard_types:
+            continue
+        processor.type_settings = hazard_types[mnemonic]
+        try:
+            layers = dict(processor.hazardset_layers(hazardset))
+            plan = compile_plan(processor.type_settings, layers)
+        except ClassificationError as e:
+            errors[mnemonic] = str(e)
+            continue
+        except (NoResultFound, MultipleResultsFound):
+            errors[mnemonic] = ('Layers of hazardset {} do not match the '
+                                'settings'.format(hazardset.id))
+            continue
+
+        outputs = dict(DBSession.query(Output.admin_id,
+                                       Output.hazardlevel_id)
+                       .filter(Output.hazardset_id == hazardset.id))
+        for admin_id, statistics in hazardset_statistics(hazardset.id):
+            country = countries.get(admin_id)
+            if country is None:
+                continue
+            counts = divisions.setdefault((mnemonic, country),
+                                          (set(), set(), set()))
+            counts[0].add(admin_id)
+            try:
+                level = classify(plan, statistics)
+            except IncompleteStatistics:
+                counts[2].add(admin_id)
+                continue
+            if level != levels.get(outputs.get(admin_id)):
+                counts[1].add(admin_id)
+
+    rows = []
+    for (mnemonic, (code, name)), (admin_ids, changed, undecided) in \
+            sorted(divisions.iteritems(),
+                   key=lambda item: (item[0][0], item[0][1][1])):
+        rows.append({
+            'hazardtype': mnemonic,
+            'country_code': code,
+            'country': name,
+            'divisions': len(admin_ids),
+            'changed': len(changed),
+            'undecided': len(undecided - changed),
+        })
+    return {
+        'countries': rows,
+        'errors': errors,
+    }
+
+
+def hazardset_statistics(hazardset_id):
+    """Yield the administrative division ids of a hazardset with the
+    statistics of their layers, as dicts by layer name"""
+    rows = DBSession.query(*DivisionStatistics.__table__.columns) \
+        .filter(DivisionStatistics.hazardset_id == hazardset_id) \
+        .order_by(DivisionStatistics.admin_id)
+    for admin_id, division_rows in groupby(rows,
+                                           lambda row: row.admin_id):
+        yield admin_id, dict((row.layer, Statistics.from_row(row))
+                             for row in division_rows)
+
+
+def division_countries():
+    """Return the (code, name) of the country of each division of the
+    lowest level, by id"""
+    province = aliased(AdministrativeDivision)
+    country = aliased(AdministrativeDivision)
+    rows = DBSession.query(AdministrativeDivision.id,
+                           country.code,
+                           country.name) \
+        .join(province,
+              AdministrativeDivision.parent_code == province.code) \
+        .join(country, province.parent_code == country.code) \
+        .filter(AdministrativeDivision.leveltype_id ==
+                AdminLevelType.get(u'REG').id)
+    return dict((admin_id, (code, name)) for admin_id, code, name in rows)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy import ma
+
+from ..models import level_weights
+from .classification import LEVELS
+
+
+# Distinct values kept in the histogram of a layer, beyond which only the
+# extremes are kept
+MAX_VALUES = 16
+
+# Points kept in the extremes by mask value of a layer, which are few for
+# natural data, beyond which mask thresholds cannot be simulated
+MAX_POINTS = 64
+
+# Name of the statistics of a preprocessed layer
+VALUES_LAYER = u'values'
+
+
+class IncompleteStatistics(Exception):
+    """The statistics of a division are not enough to classify it with
+    given plan"""
+
+
+class Statistics(object):
+    """Number, extremes and histogram of the valid pixels of a layer
+    touched by a division, which are enough to classify the division with
+    other thresholds, or other values of a preprocessed layer.
+
+    When the hazard type has a mask layer, the extremes of the pixels kept
+    by any mask threshold are also stored, as two lists of points:
+    ``upper`` (mask value, highest value of the pixels whose mask value is
+    lower or equal), by increasing mask value, and ``lower`` (mask value,
+    lowest value of the pixels whose mask value is greater or equal), by
+    decreasing mask value. Pixels without mask value are never excluded.
+    """
+
+    def __init__(self, count=0, minimum=None, maximum=None, histogram=None,
+                 mask=False, upper=None, lower=None):
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+        # value => number of pixels, None when too many values
+        self.histogram = {} if histogram is None and count == 0 \
+            else histogram
+        self.mask = mask
+        if count == 0:
+            upper = upper or []
+            lower = lower or []
+        self.upper = upper
+        self.lower = lower
+
+    @classmethod
+    def from_row(cls, row):
+        """Statistics of a DivisionStatistics row"""
+        histogram = None
+        if row.values is not None:
+            histogram = dict(zip(row.values, row.counts))
+        return cls(row.count, row.minimum, row.maximum, histogram,
+                   row.mask, points(row.upper), points(row.lower))
+
+    def row(self):
+        """Columns of the DivisionStatistics row"""
+        values = counts = None
+        if self.histogram is not None:
+            values = sorted(self.histogram.keys())
+            counts = [self.histogram[value] for value in values]
+        return {
+            'count': self.count,
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'values': values,
+            'counts': counts,
+            'mask': self.mask,
+            'upper': points(self.upper) if self.mask else None,
+            'lower': points(self.lower) if self.mask else None,
+        }
+
+    def add(self, data, mask_data=None):
+        """Add the pixels of a masked array not masked, with the pixels of
+        the mask layer on the same window if any"""
+        valid = ~ma.getmaskarray(data)
+        values = ma.getdata(data)[valid]
+        if mask_data is not None:
+            self.mask = True
+            self.add_mask(values.astype(np.float64),
+                          ma.getdata(mask_data)[valid].astype(np.float64),
+                          ma.getmaskarray(mask_data)[valid])
+        if values.size == 0:
+            return
+        self.count += values.size
+
+        if values.dtype.kind == 'f':
+            values = values[~np.isnan(values)]
+            if values.size == 0:
+                return
+        self.minimum = min_none(self.minimum, float(values.min()))
+        self.maximum = max_none(self.maximum, float(values.max()))
+
+        if self.histogram is None:
+            return
+        distinct, counts = np.unique(values, return_counts=True)
+        if len(distinct) > MAX_VALUES:
+            self.histogram = None
+            return
+        for value, count in zip(distinct, counts):
+            value = float(value)
+            self.histogram[value] = self.histogram.get(value, 0) + int(count)
+        if len(self.histogram) > MAX_VALUES:
+            self.histogram = None
+
+    def add_mask(self, values, mask_values, mask_nodata):
+        unknown = mask_nodata | np.isnan(mask_values)
+        if self.upper is not None:
+            self.upper = extremes(
+                self.upper,
+                np.where(unknown, -np.inf, mask_values), values, False)
+        if self.lower is not None:
+            self.lower = extremes(
+                self.lower,
+                np.where(unknown, np.inf, mask_values), values, True)
+
+    def compare(self, plan, threshold):
+        """Return whether a pixel kept by the mask of the plan is beyond
+        threshold, and whether a pixel is kept."""
+        if not self.mask:
+            if plan.mask_threshold is not None:
+                raise IncompleteStatistics('No statistics of the mask layer')
+            if self.count == 0:
+                return False, False
+            if plan.inverted:
+                return (self.minimum is not None and
+                        self.minimum < threshold), True
+            return (self.maximum is not None and
+                    self.maximum > threshold), True
+
+        points = self.lower if plan.inverted else self.upper
+        if points is None:
+            raise IncompleteStatistics('Too many mask values')
+        if plan.mask_threshold is None:
+            kept = points
+        elif plan.inverted:
+            kept = [point for point in points
+                    if point[0] >= plan.mask_threshold]
+        else:
+            kept = [point for point in points
+                    if point[0] <= plan.mask_threshold]
+        if len(kept) == 0:
+            return False, False
+        # Extremes are cumulated, the last point kept is enough
+        extreme = kept[-1][1]
+        if plan.inverted:
+            return bool(extreme < threshold), True
+        return bool(extreme > threshold), True
+
+
+def extremes(points, keys, values, reverse):
+    """Merge pixels with (key, extreme) points, return the points where the
+    cumulated extreme of the values changes, by increasing keys, or
+    decreasing keys when reverse, None when there are too many."""
+    if len(points) > 0:
+        keys = np.concatenate([keys, [point[0] for point in points]])
+        values = np.concatenate([values, [point[1] for point in points]])
+    if len(keys) == 0:
+        return []
+    order = np.argsort(-keys if reverse else keys, kind='mergesort')
+    keys = keys[order]
+    if reverse:
+        cumulated = np.fmin.accumulate(values[order])
+    else:
+        cumulated = np.fmax.accumulate(values[order])
+    change = np.ones(len(keys), dtype=np.bool)
+    change[1:] = (cumulated[1:] != cumulated[:-1]) & \
+        ~(np.isnan(cumulated[1:]) & np.isnan(cumulated[:-1]))
+    if change.sum() > MAX_POINTS:
+        return None
+    return zip(keys[change].tolist(), cumulated[change].tolist())
+
+
+def points(items):
+    if items is None:
+        return None
+    return [list(item) for item in items]
+
+
+def classify(plan, statistics):
+    """Hazard level mnemonic of a division, or None, from the statistics of
+    its layers, a dict by layer name, for a classification plan. Gives the
+    level Processor computes from the pixels.
+    """
+    if plan.preprocessed:
+        layer = statistics.get(VALUES_LAYER)
+        if layer is None:
+            raise IncompleteStatistics('No statistics of values')
+        if layer.histogram is None:
+            raise IncompleteStatistics('Too many values')
+        weight = max([plan.lookup.weights.get(value, 0)
+                      for value in layer.histogram] + [0])
+        return weight_level(weight)
+
+    valid = False
+    for level, threshold in plan.levels:
+        layer = statistics.get(level)
+        if layer is None:
+            raise IncompleteStatistics('No statistics of {}'.format(level))
+        above, kept = layer.compare(plan, threshold)
+        if above:
+            return level
+        valid = valid or kept
+    if valid:
+        return u'VLO'
+    return None
+
+
+def layer_name(key):
+    """Name of the statistics of the layer with given Processor key"""
+    return VALUES_LAYER if key == 0 else key
+
+
+def layer_names(plan):
+    if plan.preprocessed:
+        return (VALUES_LAYER, )
+    return LEVELS
+
+
+def weight_level(weight):
+    """Hazard level mnemonic of a level weight, None for 0"""
+    for mnemonic, level_weight in level_weights.iteritems():
+        if level_weight == weight:
+            return mnemonic
+    return None
+
+
+def min_none(a, b):
+    return b if a is None else min(a, b)
+
+
+def max_none(a, b):
+    return b if a is None else max(a, b)
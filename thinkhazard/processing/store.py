@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content addressed store of raster files.
+
+Each file is stored once in data_path/store, named after its SHA-256
+checksum. Layers reference stored files with hard links in
+data_path/hazardsets, so the link count of a stored file is its reference
+count, and files without links left are garbage collected.
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Folder of the stored files, in data_path
+STORE_DIR = 'store'
+
+# Folder of the layer files, in data_path
+LAYERS_DIR = 'hazardsets'
+
+# Suffix of the files being downloaded in LAYERS_DIR
+PART_SUFFIX = '.part'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_checksum(path):
+    """Return the SHA-256 checksum of a file"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def object_path(data_path, checksum):
+    return os.path.join(data_path, STORE_DIR, checksum[:2], checksum)
+
+
+def contains(data_path, checksum):
+    return os.path.isfile(object_path(data_path, checksum))
+
+
+def add(data_path, path, checksum):
+    """Move a file with given checksum in the store, or remove it if the
+    store already contains the same content.
+    """
+    target = object_path(data_path, checksum)
+    if os.path.isfile(target):
+        if not os.path.samefile(path, target):
+            logger.info('  Reusing stored file {}'.format(checksum))
+        os.unlink(path)
+        return
+    dir_path = os.path.dirname(target)
+    try:
+        os.makedirs(dir_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    os.rename(path, target)
+
+
+def link(data_path, checksum, path):
+    """Make path a hard link to the stored file with given checksum"""
+    target = object_path(data_path, checksum)
+    if os.path.lexists(path):
+        if os.path.samefile(path, target):
+            return
+        os.unlink(path)
+    os.link(target, path)
+
+
+def collect_garbage(data_path, paths):
+    """Remove the files of LAYERS_DIR which are not in paths, except
+    partial downloads, then the stored files which are no more linked.
+    Return the number of bytes freed.
+    """
+    paths = set(os.path.abspath(path) for path in paths)
+    freed = 0
+
+    layers_path = os.path.join(data_path, LAYERS_DIR)
+    if os.path.isdir(layers_path):
+        for filename in os.listdir(layers_path):
+            path = os.path.abspath(os.path.join(layers_path, filename))
+            if (filename.endswith(PART_SUFFIX) or path in paths or
+                    not os.path.isfile(path)):
+                continue
+            logger.info('Removing unused layer file {}'.format(filename))
+            stat = os.stat(path)
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+            os.unlink(path)
+
+    store_path = os.path.join(data_path, STORE_DIR)
+    if os.path.isdir(store_path):
+        for dirpath, dirnames, filenames in os.walk(store_path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                if stat.st_nlink == 1:
+                    logger.info('Removing unused stored file {}'
+                                .format(filename))
+                    freed += stat.st_size
+                    os.unlink(path)
+
+    return freed
+
+
+def clear(data_path):
+    """Remove all stored files"""
+    shutil.rmtree(os.path.join(data_path, STORE_DIR), ignore_errors=True)
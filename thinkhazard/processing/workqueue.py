@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import socket
+import threading
+import datetime
+from sqlalchemy import (
+    func,
+    or_,
+    )
+
+from ..models import (
+    DBSession,
+    HazardSet,
+    Output,
+    ProcessingTask,
+    )
+from .outputwriter import OutputWriter
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds without heartbeat after which a task is given to another worker
+LEASE = 300
+
+# Claims of a task before it is given up, crashed workers included
+MAX_ATTEMPTS = 3
+
+# Seconds to wait before looking again for tasks held by other workers
+POLL_INTERVAL = 10
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def enqueue(hazardset_id, chunks, fingerprints):
+    """Replace the tasks of a hazardset with one task per chunk of
+    administrative division ids"""
+    DBSession.query(ProcessingTask) \
+        .filter(ProcessingTask.hazardset_id == hazardset_id) \
+        .delete(synchronize_session=False)
+    for admin_ids in chunks:
+        DBSession.add(ProcessingTask(
+            hazardset_id=hazardset_id,
+            admin_ids=admin_ids,
+            fingerprint=fingerprints[0],
+            divisions_fingerprint=fingerprints[1],
+            attempts=0,
+            done=False))
+    DBSession.flush()
+
+
+def claim(worker, lease=LEASE, session=DBSession):
+    """Give the first available task to worker, and return it, or None.
+    Tasks are available when not done and not held by a worker with a
+    heartbeat younger than lease seconds. Rows locked by other workers
+    claiming tasks at the same time are skipped, so that workers on several
+    hosts never wait for each other.
+    """
+    expiry = func.now() - datetime.timedelta(seconds=lease)
+    task = session.query(ProcessingTask) \
+        .filter(ProcessingTask.done.is_(False)) \
+        .filter(or_(ProcessingTask.worker.is_(None),
+                    ProcessingTask.heartbeat < expiry)) \
+        .order_by(ProcessingTask.id) \
+        .with_for_update(skip_locked=True) \
+        .first()
+    if task is None:
+        return None
+    task.worker = worker
+    task.heartbeat = func.now()
+    task.attempts = task.attempts + 1
+    session.flush()
+    return task
+
+
+def unfinished():
+    """Number of tasks not done, held by a worker or not"""
+    return DBSession.query(ProcessingTask) \
+        .filter(ProcessingTask.done.is_(False)) \
+        .count()
+
+
+def complete(task_id, hazardset_id, worker, outputs, error):
+    """Record the outputs or the error of a task in the current
+    transaction, and finish its hazardset if it was the last task. Return
+    False if the task has been given to another worker meanwhile, its
+    outputs are then dropped.
+    """
+    # Tasks of a hazardset are completed one at a time, so that exactly one
+    # worker sees that all are done
+    hazardset = DBSession.query(HazardSet) \
+        .filter(HazardSet.id == hazardset_id) \
+        .with_for_update() \
+        .one()
+    task = DBSession.query(ProcessingTask) \
+        .filter(ProcessingTask.id == task_id) \
+        .with_for_update() \
+        .one_or_none()
+    if task is None or task.done or task.worker != worker:
+        return False
+
+    if not error:
+        writer = OutputWriter(hazardset_id)
+        for admin_id, hazardlevel_id, fingerprint in outputs:
+            writer.write(admin_id, hazardlevel_id, fingerprint)
+        writer.close()
+    task.done = True
+    task.error = error or None
+    DBSession.flush()
+    finish(hazardset)
+    return True
+
+
+def finish(hazardset):
+    """Mark a hazardset as processed, or failed, once all its tasks are
+    done, and remove its tasks. Return whether it was finished."""
+    tasks = DBSession.query(ProcessingTask) \
+        .filter(ProcessingTask.hazardset_id == hazardset.id) \
+        .order_by(ProcessingTask.id) \
+        .all()
+    if any(not task.done for task in tasks):
+        return False
+
+    errors = [task.error for task in tasks if task.error]
+    hazardset.processing_error = errors[0] if errors else None
+    if errors:
+        # Remove outputs written by the other tasks
+        admin_ids = set()
+        for task in tasks:
+            admin_ids.update(task.admin_ids)
+        DBSession.query(Output) \
+            .filter(Output.hazardset_id == hazardset.id) \
+            .filter(Output.admin_id.in_(sorted(admin_ids))) \
+            .delete(synchronize_session=False)
+        logger.info('  Processing of {} failed: {}'
+                    .format(hazardset.id, errors[0]))
+    else:
+        hazardset.processed = datetime.datetime.now()
+        hazardset.fingerprint = tasks[0].fingerprint
+        hazardset.divisions_fingerprint = tasks[0].divisions_fingerprint
+        logger.info('  Successfully processed {}'.format(hazardset.id))
+
+    DBSession.query(ProcessingTask) \
+        .filter(ProcessingTask.hazardset_id == hazardset.id) \
+        .delete(synchronize_session=False)
+    DBSession.flush()
+    return True
+
+
+class Heartbeat(threading.Thread):
+    """Renew the lease of a task every interval seconds while it is being
+    processed, on a connection of its own"""
+
+    def __init__(self, engine, task_id, worker, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.engine = engine
+        self.task_id = task_id
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        table = ProcessingTask.__table__
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        table.update()
+                        .where(table.c.id == self.task_id)
+                        .where(table.c.worker == self.worker)
+                        .values(heartbeat=func.now()))
+            except Exception:
+                logger.warning('Heartbeat of task {} failed'
+                               .format(self.task_id), exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
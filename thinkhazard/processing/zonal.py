@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from numpy import ma
+from rasterio import features
+
+from ..models import (
+    HazardLevel,
+    level_weights,
+    )
+from .lookup import group_max
+
+
+# Size of the raster tiles, in pixels
+TILE_SIZE = 1024
+
+
+class TileClassifier(object):
+    """Compute the hazard levels of many administrative divisions at once.
+
+    Rasters are read tile by tile, polygons intersecting a tile are burnt
+    in label arrays with ``features.rasterize`` and hazard levels are then
+    obtained with grouped reductions over the labelled pixels. Results are
+    the same as those of ``Processor.preprocessed_hazardlevel`` and
+    ``Processor.notpreprocessed_hazardlevel``.
+    """
+
+    def __init__(self, processor, hazardtype, tile_size=TILE_SIZE):
+        self.processor = processor
+        self.hazardtype = hazardtype
+        self.tile_size = tile_size
+        self.plan = processor.classification_plan()
+        self.preprocessed = self.plan.preprocessed
+        # All layers of a hazardset share the same grid (see Completer)
+        self.reader = processor.readers[0 if self.preprocessed else u'HIG']
+        self.height, self.width = self.reader.shape
+
+    def hazardlevels(self, geometries):
+        """Return the list of hazard levels for the given geometries"""
+        polygons, divisions, windows = self.polygons(geometries)
+
+        if self.preprocessed:
+            weights = np.zeros(len(geometries), dtype=np.uint8)
+        else:
+            exceed = np.zeros((3, len(geometries)), dtype=np.bool)
+            valid = np.zeros(len(geometries), dtype=np.bool)
+
+        for window, members in self.tiles(windows):
+            rows, cols, polygon_ids = self.label_pixels(window,
+                                                        polygons,
+                                                        windows,
+                                                        members)
+            if len(rows) == 0:
+                continue
+            pixel_divisions = divisions[polygon_ids]
+            if self.preprocessed:
+                self.classify_preprocessed(window, rows, cols,
+                                           pixel_divisions, weights)
+            else:
+                self.classify_notpreprocessed(window, rows, cols,
+                                              pixel_divisions, exceed, valid)
+
+        if self.preprocessed:
+            mnemonics = dict((weight, mnemonic)
+                             for mnemonic, weight in level_weights.iteritems())
+            return [HazardLevel.get(mnemonics[weight])
+                    if weight > 0 else None
+                    for weight in weights]
+
+        hazardlevels = []
+        for i in xrange(0, len(geometries)):
+            hazardlevel = None
+            for j, level in enumerate((u'HIG', u'MED', u'LOW')):
+                if exceed[j, i]:
+                    hazardlevel = HazardLevel.get(level)
+                    break
+            if hazardlevel is None and valid[i]:
+                hazardlevel = HazardLevel.get(u'VLO')
+            hazardlevels.append(hazardlevel)
+        return hazardlevels
+
+    def polygons(self, geometries):
+        """Flatten geometries into polygons with their pixel windows"""
+        polygons = []
+        divisions = []
+        windows = []
+        for i, geometry in enumerate(geometries):
+            for polygon in geometry.geoms:
+                if not polygon.intersects(self.processor.bbox):
+                    continue
+                window = self.reader.window(*polygon.bounds)
+                (row_start, row_stop), (col_start, col_stop) = window
+                row_start = max(row_start, 0)
+                col_start = max(col_start, 0)
+                row_stop = min(row_stop, self.height)
+                col_stop = min(col_stop, self.width)
+                if row_stop <= row_start or col_stop <= col_start:
+                    continue
+                polygons.append(polygon)
+                divisions.append(i)
+                windows.append((row_start, row_stop, col_start, col_stop))
+        return (polygons,
+                np.array(divisions, dtype=np.int64),
+                np.array(windows, dtype=np.int64).reshape((-1, 4)))
+
+    def tiles(self, windows):
+        """Yield tile windows with the polygons intersecting them"""
+        size = self.tile_size
+        tiles = {}
+        for i, (row_start, row_stop, col_start, col_stop) in \
+                enumerate(windows):
+            for row in xrange(row_start // size, (row_stop - 1) // size + 1):
+                for col in xrange(col_start // size,
+                                  (col_stop - 1) // size + 1):
+                    tiles.setdefault((row, col), []).append(i)
+        for row, col in sorted(tiles.keys()):
+            window = ((row * size, min((row + 1) * size, self.height)),
+                      (col * size, min((col + 1) * size, self.width)))
+            yield window, tiles[(row, col)]
+
+    def label_pixels(self, window, polygons, windows, members):
+        """Return the pixels of the tile touched by each polygon, as three
+        arrays: rows and columns in the tile, and polygon indexes.
+
+        A pixel may be touched by several polygons, so polygons are split in
+        groups with disjoint windows and each group is rasterized in one
+        pass.
+        """
+        (row_start, row_stop), (col_start, col_stop) = window
+        shape = (row_stop - row_start, col_stop - col_start)
+        transform = self.reader.window_transform(window)
+
+        rows = []
+        cols = []
+        polygon_ids = []
+        for group in disjoint_groups(windows, members, window):
+            labels = features.rasterize(
+                [(polygons[i], i + 1) for i in group],
+                out_shape=shape,
+                transform=transform,
+                all_touched=True,
+                fill=0,
+                dtype='int32')
+            group_rows, group_cols = np.nonzero(labels)
+            group_ids = labels[group_rows, group_cols] - 1
+            # Restrict to the polygon window, as in the per polygon path
+            group_windows = windows[group_ids]
+            keep = ((group_rows + row_start >= group_windows[:, 0]) &
+                    (group_rows + row_start < group_windows[:, 1]) &
+                    (group_cols + col_start >= group_windows[:, 2]) &
+                    (group_cols + col_start < group_windows[:, 3]))
+            rows.append(group_rows[keep])
+            cols.append(group_cols[keep])
+            polygon_ids.append(group_ids[keep])
+
+        if len(rows) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        return (np.concatenate(rows),
+                np.concatenate(cols),
+                np.concatenate(polygon_ids))
+
+    def classify_preprocessed(self, window, rows, cols, divisions, weights):
+        data = self.processor.readers[0].read(1, window=window, masked=True)
+        # Only the labelled pixels are classified
+        pixels = ma.masked_array(ma.getdata(data)[rows, cols],
+                                 ma.getmaskarray(data)[rows, cols])
+        del data
+        group_max(self.plan.lookup.classify(pixels),
+                  divisions, weights)
+
+    def classify_notpreprocessed(self, window, rows, cols, divisions,
+                                 exceed, valid):
+        plan = self.plan
+        readers = self.processor.readers
+
+        masked = None
+        if plan.mask_threshold is not None:
+            mask = readers['mask'].read(1, window=window, masked=True)
+            masked = plan.masked(mask).filled(False)
+            del mask
+
+        for i, (level, threshold) in enumerate(plan.levels):
+            data = readers[level].read(1, window=window, masked=True)
+            pixel_valid = ~ma.getmaskarray(data)
+            if masked is not None:
+                pixel_valid &= ~masked
+            pixel_exceed = plan.exceeds(data, threshold).filled(False)
+            pixel_exceed &= pixel_valid
+            del data
+
+            valid[divisions[pixel_valid[rows, cols]]] = True
+            exceed[i, divisions[pixel_exceed[rows, cols]]] = True
+
+
+def disjoint_groups(windows, members, window):
+    """Split polygons in groups whose windows, clipped to the given window,
+    do not overlap, using a greedy coloring.
+    """
+    (row_start, row_stop), (col_start, col_stop) = window
+    clipped = windows[members].copy()
+    clipped[:, 0] = np.maximum(clipped[:, 0], row_start)
+    clipped[:, 1] = np.minimum(clipped[:, 1], row_stop)
+    clipped[:, 2] = np.maximum(clipped[:, 2], col_start)
+    clipped[:, 3] = np.minimum(clipped[:, 3], col_stop)
+
+    # Largest windows first gives fewer groups
+    areas = ((clipped[:, 1] - clipped[:, 0]) *
+             (clipped[:, 3] - clipped[:, 2]))
+    colors = np.full(len(members), -1, dtype=np.int64)
+    for i in np.argsort(-areas, kind='mergesort'):
+        w = clipped[i]
+        overlap = ((clipped[:, 0] < w[1]) & (clipped[:, 1] > w[0]) &
+                   (clipped[:, 2] < w[3]) & (clipped[:, 3] > w[2]))
+        used = set(colors[overlap & (colors >= 0)])
+        color = 0
+        while color in used:
+            color += 1
+        colors[i] = color
+
+    members = np.asarray(members)
+    return [members[colors == i].tolist()
+            for i in xrange(0, colors.max() + 1)]
@@ -28,6 +28,7 @@ from pyramid.paster import setup_logging
 from pyramid.scripts.common import parse_vars
 
 from ..settings import load_full_settings
+from ..processing import divisionindex
 
 from ..models import (
     DBSession,
@@ -40,6 +41,7 @@ from ..models import (
     HazardLevel,
     HazardCategory,
     HazardCategoryTechnicalRecommendationAssociation,
+    RegionMembership,
     TechnicalRecommendation,
     )
 
@@ -202,6 +204,13 @@ DROP TABLE g2015_2014_2;
         DBSession.query(AdministrativeDivision).count()
     )
 
+    print "Refreshing region memberships"
+    RegionMembership.refresh()
+    transaction.commit()
+
+    print "Clearing division rasterization index"
+    divisionindex.clear(settings['data_path'])
+
 
 def import_recommendations(argv=sys.argv):
     if len(argv) < 2:
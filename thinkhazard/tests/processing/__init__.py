@@ -31,6 +31,7 @@ from ...models import (
     AdminLevelType,
     AdministrativeDivision,
     Region,
+    RegionMembership,
     )
 
 
@@ -78,3 +79,4 @@ def populate_datamart():
     DBSession.add(div)
 
     DBSession.flush()
+    RegionMembership.refresh()
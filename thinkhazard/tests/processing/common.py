@@ -17,6 +17,14 @@
 # You should have received a copy of the GNU General Public License along with
 # ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
 
+import math
+import socket
+import threading
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit
+from affine import Affine
+from rasterio.coords import BoundingBox
 from sqlalchemy import func
 
 from ...models import (
@@ -30,3 +38,101 @@ def new_geonode_id():
     if row[0] is None:
         return 1
     return row[0] + 1
+
+
+class ArrayReader(object):
+    '''Minimal raster reader serving a masked array from memory'''
+
+    def __init__(self, array, affine, block_shape=(16, 16)):
+        self.array = array
+        self.affine = affine
+        self.transform = affine
+        self.shape = array.shape
+        self.block_shapes = [block_shape]
+        self.closed = False
+        left, top = affine * (0, 0)
+        right, bottom = affine * (self.shape[1], self.shape[0])
+        self.bounds = BoundingBox(left, bottom, right, top)
+        self.reads = 0
+
+    def index(self, x, y, op=math.floor):
+        col, row = ~self.affine * (x, y)
+        return int(op(row)), int(op(col))
+
+    def window(self, left, bottom, right, top, boundless=False):
+        left = max(left, self.bounds.left)
+        bottom = max(bottom, self.bounds.bottom)
+        right = min(right, self.bounds.right)
+        top = min(top, self.bounds.top)
+        return tuple(zip(self.index(left, top, op=math.floor),
+                         self.index(right, bottom, op=math.ceil)))
+
+    def window_transform(self, window):
+        (row_start, row_stop), (col_start, col_stop) = window
+        return self.affine * Affine.translation(col_start, row_start)
+
+    def read(self, indexes, window=None, masked=False):
+        self.reads += 1
+        (row_start, row_stop), (col_start, col_stop) = window
+        return self.array[max(row_start, 0):max(row_stop, 0),
+                          max(col_start, 0):max(col_stop, 0)].copy()
+
+    def close(self):
+        self.closed = True
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    '''Local HTTP server running in a thread, recording requests'''
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.requests = []
+        self.connections = set()
+        self.handlers = []
+        self.lock = threading.Lock()
+
+    @property
+    def netloc(self):
+        return '{}:{}'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # Close connections kept alive by clients
+        with self.lock:
+            handlers = list(self.handlers)
+        for request, thread in handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self.lock:
+            self.handlers.append((request, thread))
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Connections closed by stop()
+        pass
+
+    def record(self, handler):
+        '''Record request path and headers, return path'''
+        path = urlsplit(handler.path).path
+        with self.lock:
+            self.requests.append((path, dict(handler.headers)))
+            self.connections.add(handler.client_address)
+        return path
+
+    def paths(self):
+        return [path for path, headers in self.requests]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+from affine import Affine
+
+from ...processing.blockcache import (
+    BlockCache,
+    CachedReader,
+    )
+from .common import ArrayReader
+
+
+def make_reader(block_shape=(16, 16), shape=(100, 120)):
+    random = np.random.RandomState(0)
+    data = random.uniform(0, 1, shape).astype(np.float32)
+    mask = random.uniform(0, 1, shape) < 0.1
+    return ArrayReader(np.ma.masked_array(data, mask),
+                       Affine(0.1, 0.0, 0.0, 0.0, -0.1, 10.0),
+                       block_shape=block_shape)
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def test_read(self):
+        '''Test cached reads give the same result as direct reads'''
+        reader = make_reader()
+        cached = CachedReader(make_reader(), BlockCache(1024 * 1024), 1)
+        for window in (((0, 100), (0, 120)),
+                       ((3, 17), (5, 70)),
+                       ((90, 120), (110, 130)),
+                       ((50, 51), (60, 61))):
+            expected = reader.read(1, window=window, masked=True)
+            data = cached.read(1, window=window, masked=True)
+            self.assertEqual(data.shape, expected.shape)
+            self.assertTrue((data.mask == expected.mask).all())
+            self.assertTrue((data.data == expected.data).all())
+
+    def test_hits(self):
+        '''Test blocks are read once'''
+        reader = make_reader()
+        cache = BlockCache(1024 * 1024)
+        cached = CachedReader(reader, cache, 1)
+        cached.read(1, window=((0, 32), (0, 32)), masked=True)
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+        cached.read(1, window=((2, 12), (2, 12)), masked=True)
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        self.assertEqual(reader.reads, 4)
+
+    def test_eviction(self):
+        '''Test cache size is bounded'''
+        reader = make_reader()
+        # data + mask of a 16x16 float32 block is 1280 bytes
+        cache = BlockCache(3 * 1280)
+        cached = CachedReader(reader, cache, 1)
+        cached.read(1, window=((0, 16), (0, 64)), masked=True)
+        self.assertEqual(len(cache.blocks), 3)
+        self.assertLessEqual(cache.bytes, 3 * 1280)
+        # first block has been evicted
+        cached.read(1, window=((0, 16), (0, 16)), masked=True)
+        self.assertEqual(cache.misses, 5)
+
+    def test_strips(self):
+        '''Test strip organized rasters are cached by square blocks'''
+        reader = make_reader(block_shape=(1, 300), shape=(10, 300))
+        cached = CachedReader(reader, BlockCache(1024 * 1024), 1)
+        self.assertEqual(cached.block_shape, (256, 256))
+        data = cached.read(1, window=((2, 5), (250, 270)), masked=True)
+        self.assertEqual(data.shape, (3, 20))
+        self.assertEqual(reader.reads, 2)
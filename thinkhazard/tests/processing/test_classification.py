@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+from mock import Mock
+
+from ...processing.classification import (
+    ClassificationError,
+    compile_plan,
+    )
+
+
+def make_layers(unit='m', local=False, mask=True):
+    keys = [u'HIG', u'MED', u'LOW'] + (['mask'] if mask else [])
+    return dict((key, Mock(local=local, hazardunit=unit)) for key in keys)
+
+
+class TestClassificationPlan(unittest.TestCase):
+
+    def test_preprocessed(self):
+        '''Test plan of a preprocessed hazard type'''
+        type_settings = {'values': {u'HIG': [4], u'MED': [3]}}
+        plan = compile_plan(type_settings, {0: Mock()})
+        self.assertTrue(plan.preprocessed)
+        self.assertIs(plan.settings, type_settings)
+        data = np.ma.masked_array([3, 4], [False, True], dtype=np.uint8)
+        self.assertEqual(plan.lookup.max_weight(data), 3)
+
+    def test_thresholds(self):
+        '''Test thresholds per level and mask threshold'''
+        type_settings = {
+            'mask_return_period': [2, 5],
+            'thresholds': {'global': {'m': 1}, 'local': {'m': 0.5}},
+        }
+        plan = compile_plan(type_settings, make_layers(local=True))
+        self.assertFalse(plan.preprocessed)
+        self.assertEqual(plan.levels,
+                         ((u'HIG', 0.5), (u'MED', 0.5), (u'LOW', 0.5)))
+        self.assertEqual(plan.mask_threshold, 0.5)
+
+        type_settings = {'thresholds': {'HIG': {'g': 0.2},
+                                        'MED': {'g': 0.1},
+                                        'LOW': {'g': 0.05}}}
+        plan = compile_plan(type_settings, make_layers('g', mask=False))
+        self.assertEqual(plan.levels,
+                         ((u'HIG', 0.2), (u'MED', 0.1), (u'LOW', 0.05)))
+        self.assertIsNone(plan.mask_threshold)
+
+    def test_comparison(self):
+        '''Test comparison operator, inverted or not'''
+        data = np.ma.masked_array([1., 2., 3.])
+        type_settings = {'thresholds': {'m': 2}}
+        plan = compile_plan(type_settings, make_layers(mask=False))
+        np.testing.assert_array_equal(plan.exceeds(data, 2.),
+                                      [False, False, True])
+        type_settings['inverted_comparison'] = True
+        plan = compile_plan(type_settings, make_layers(mask=False))
+        np.testing.assert_array_equal(plan.exceeds(data, 2.),
+                                      [True, False, False])
+
+    def test_errors(self):
+        '''Test settings are validated when compiled'''
+        for type_settings, layers, message in (
+                ({'values': {u'XXX': [1]}}, {0: Mock()},
+                 'Unknown hazard level XXX in values'),
+                ({'values': {u'HIG': ['a']}}, {0: Mock()},
+                 'Values of HIG must be a list of numbers'),
+                ({}, make_layers(),
+                 'Neither values nor thresholds are set'),
+                ({'thresholds': {'cm': 100}}, make_layers(),
+                 'No threshold found for global HIG m'),
+                ({'thresholds': {'HIG': {'m': 1}}}, make_layers(),
+                 'No threshold found for global MED m'),
+                ({'thresholds': {'m': 1}, 'mask_return_period': 2},
+                 make_layers(mask=False),
+                 'No mask layer'),
+                ({'thresholds': {'m': 1}, 'inverted_comparison': 'yes'},
+                 make_layers(),
+                 'inverted_comparison must be a boolean')):
+            with self.assertRaises(ClassificationError) as context:
+                compile_plan(type_settings, layers)
+            self.assertEqual(str(context.exception), message)
@@ -52,6 +52,9 @@ def global_reader(path=''):
     reader.shape = (360, 720)
     reader.affine = Affine(-180., 0.5, 0.0, -90., 0.0, 0.5)
     reader.bounds = BoundingBox(-180., -90., 0., 0.)
+    reader.dtypes = ['float32']
+    reader.nodata = None
+    reader.block_shapes = [(1, 720)]
 
     context = Mock()
     context.__enter__ = Mock(return_value=reader)
@@ -59,28 +62,15 @@ def global_reader(path=''):
     return context
 
 
-def global_reader_bis(path=''):
-    reader = Mock(spec=RasterReader)
-    reader.shape = (361, 720)
-    reader.affine = Affine(-180., 0.5, 0.0, -90., 0.0, 0.5)
-    reader.bounds = BoundingBox(-180., -90., 0.5, 0.)
-
-    context = Mock()
-    context.__enter__ = Mock(return_value=reader)
-    context.__exit__ = Mock(return_value=False)
-    return context
-
-
-def global_reader_invalid_bounds(path=''):
-    reader = Mock(spec=RasterReader)
-    reader.shape = (360, 720)
-    reader.affine = Affine(-180., 0.5, 0.0, 90., 0.0, -0.5)
-    reader.bounds = BoundingBox(-180., 90., 0.5, 0.)
-
-    context = Mock()
-    context.__enter__ = Mock(return_value=reader)
-    context.__exit__ = Mock(return_value=False)
-    return context
+def set_header(layer, shape=(360, 720), bounds=(-180., -90., 0., 0.)):
+    """Set the raster header read at download time"""
+    layer.height, layer.width = shape
+    layer.transform = list(Affine(-180., 0.5, 0.0, -90., 0.0, 0.5))[:6]
+    layer.bounds = list(bounds)
+    layer.dtype = 'float32'
+    layer.nodata = None
+    layer.block_height, layer.block_width = 1, shape[1]
+    layer.file_size = shape[0] * shape[1] * 4
 
 
 class TestCompleting(unittest.TestCase):
@@ -98,7 +88,34 @@ class TestCompleting(unittest.TestCase):
         '''Test completer in force mode'''
         Completer().execute(settings, force=True)
 
-    @patch('rasterio.open', side_effect=global_reader)
+    def test_hazardset_error(self):
+        '''Test an error does not discard other hazardsets'''
+        hazardtype = HazardType.get(u'EQ')
+        for hazardset_id in (u'broken', u'valid'):
+            DBSession.add(HazardSet(
+                id=hazardset_id,
+                hazardtype=hazardtype,
+                local=False,
+                data_lastupdated_date=datetime.now(),
+                metadata_lastupdated_date=datetime.now()))
+        transaction.commit()
+
+        def complete_layers(hazardset, layers, regions):
+            hazardset.complete = True
+            if hazardset.id == u'broken':
+                raise Exception()
+            return True
+
+        with patch.object(Completer, 'complete_layers',
+                          side_effect=complete_layers):
+            Completer().execute(settings)
+
+        self.assertEqual(DBSession.query(HazardSet).get(u'broken').complete,
+                         False)
+        self.assertEqual(DBSession.query(HazardSet).get(u'valid').complete,
+                         True)
+
+    @patch('rasterio.open', side_effect=Exception())
     def test_complete_preprocessed(self, open_mock):
         '''Test complete preprocessed hazardset'''
 
@@ -129,6 +146,7 @@ class TestCompleting(unittest.TestCase):
             local=False,
             downloaded=True
         )
+        set_header(layer)
         hazardset.layers.append(layer)
 
         transaction.commit()
@@ -138,8 +156,10 @@ class TestCompleting(unittest.TestCase):
         hazardset = DBSession.query(HazardSet).one()
         self.assertEqual(hazardset.complete_error, None)
         self.assertEqual(hazardset.complete, True)
+        # Headers are read from the database
+        self.assertFalse(open_mock.called)
 
-    @patch('rasterio.open', side_effect=global_reader)
+    @patch('rasterio.open', side_effect=Exception())
     def test_complete_notpreprocessed(self, open_mock):
         '''Test complete notpreprocessed hazardset'''
 
@@ -171,6 +191,7 @@ class TestCompleting(unittest.TestCase):
                 local=False,
                 downloaded=True
             )
+            set_header(layer)
             hazardset.layers.append(layer)
 
         transaction.commit()
@@ -180,6 +201,8 @@ class TestCompleting(unittest.TestCase):
         hazardset = DBSession.query(HazardSet).one()
         self.assertEqual(hazardset.complete_error, None)
         self.assertEqual(hazardset.complete, True)
+        # Headers are read from the database
+        self.assertFalse(open_mock.called)
 
     def test_no_region(self):
         '''Test no region'''
@@ -219,7 +242,7 @@ class TestCompleting(unittest.TestCase):
         self.assertEqual(hazardset.complete_error, u'No associated regions')
         self.assertEqual(hazardset.complete, False)
 
-    @patch('rasterio.open', side_effect=global_reader_invalid_bounds)
+    @patch('rasterio.open', side_effect=Exception())
     def test_invalid_bounds(self, open_mock):
         '''Test invalid invalid'''
 
@@ -251,6 +274,7 @@ class TestCompleting(unittest.TestCase):
                 local=False,
                 downloaded=True
             )
+            set_header(layer, bounds=(-180., 90., 0.5, 0.))
             hazardset.layers.append(layer)
 
         transaction.commit()
@@ -262,7 +286,7 @@ class TestCompleting(unittest.TestCase):
                          u'bounds.bottom > bounds.top')
         self.assertEqual(hazardset.complete, False)
 
-    @patch('rasterio.open', side_effect=global_reader)
+    @patch('rasterio.open', side_effect=Exception())
     def test_missing_level(self, open_mock):
         '''Test missing level'''
 
@@ -294,6 +318,7 @@ class TestCompleting(unittest.TestCase):
                 local=False,
                 downloaded=True
             )
+            set_header(layer)
             hazardset.layers.append(layer)
 
         transaction.commit()
@@ -304,7 +329,7 @@ class TestCompleting(unittest.TestCase):
         self.assertEqual(hazardset.complete_error, u'No layer for level LOW')
         self.assertEqual(hazardset.complete, False)
 
-    @patch('rasterio.open', side_effect=global_reader)
+    @patch('rasterio.open', side_effect=Exception())
     def test_missing_mask(self, open_mock):
         '''Test missing mask'''
 
@@ -336,6 +361,7 @@ class TestCompleting(unittest.TestCase):
                 local=False,
                 downloaded=True
             )
+            set_header(layer)
             hazardset.layers.append(layer)
 
         transaction.commit()
@@ -389,11 +415,7 @@ class TestCompleting(unittest.TestCase):
                          "Error opening layer notpreprocessed")
         self.assertEqual(hazardset.complete, False)
 
-    @patch('rasterio.open', side_effect=[
-        global_reader(),
-        global_reader(),
-        global_reader(),
-        global_reader_bis()])
+    @patch('rasterio.open', side_effect=Exception())
     def test_not_corresponding_rasters(self, open_mock):
         '''Difference in origin, resolution or size must not complete'''
 
@@ -425,6 +447,7 @@ class TestCompleting(unittest.TestCase):
                 local=False,
                 downloaded=True
             )
+            set_header(layer)
             hazardset.layers.append(layer)
 
         mask_layer = Layer(
@@ -440,6 +463,8 @@ class TestCompleting(unittest.TestCase):
             local=False,
             downloaded=True
         )
+        set_header(mask_layer, shape=(361, 720),
+                   bounds=(-180., -90., 0.5, 0.))
         hazardset.layers.append(mask_layer)
 
         transaction.commit()
@@ -451,3 +476,52 @@ class TestCompleting(unittest.TestCase):
             hazardset.complete_error,
             u'All layers should have the same origin, resolution and size')
         self.assertEqual(hazardset.complete, False)
+
+    @patch('os.path.getsize', return_value=1036800)
+    @patch('rasterio.open', side_effect=global_reader)
+    def test_header_backfill(self, open_mock, getsize_mock):
+        '''Headers missing from the database are read once from files'''
+
+        hazardset_id = u'notpreprocessed'
+        hazardtype = HazardType.get(u'EQ')
+
+        regions = DBSession.query(Region).all()
+
+        hazardset = HazardSet(
+            id=hazardset_id,
+            hazardtype=hazardtype,
+            local=False,
+            data_lastupdated_date=datetime.now(),
+            metadata_lastupdated_date=datetime.now(),
+            regions=regions)
+        DBSession.add(hazardset)
+
+        for level in [u'HIG', u'MED', u'LOW']:
+            layer = Layer(
+                hazardlevel=HazardLevel.get(level),
+                mask=False,
+                return_period=None,
+                data_lastupdated_date=datetime.now(),
+                metadata_lastupdated_date=datetime.now(),
+                geonode_id=new_geonode_id(),
+                download_url='test',
+                calculation_method_quality=5,
+                scientific_quality=1,
+                local=False,
+                downloaded=True
+            )
+            hazardset.layers.append(layer)
+
+        transaction.commit()
+
+        Completer().execute(settings)
+
+        hazardset = DBSession.query(HazardSet).one()
+        self.assertEqual(hazardset.complete_error, None)
+        self.assertEqual(hazardset.complete, True)
+        self.assertEqual(open_mock.call_count, 3)
+        for layer in hazardset.layers:
+            self.assertEqual((layer.height, layer.width), (360, 720))
+            self.assertEqual(layer.bounds, [-180., -90., 0., 0.])
+            self.assertEqual(layer.dtype, 'float32')
+            self.assertEqual(layer.file_size, 1036800)
@@ -33,6 +33,8 @@ from ...models import (
     Output,
     )
 
+from .. import settings
+from ...processing.decisiontree import DecisionMaker
 from common import new_geonode_id
 
 
@@ -391,3 +393,72 @@ class TestDecisionTree(unittest.TestCase):
 
     def setUp(self):  # NOQA
         populate()
+
+    def test_incremental(self):
+        '''Test incremental mode gives the same relations as full mode'''
+        DecisionMaker().execute(settings)
+        previous = relations()
+
+        # hazardset2 processed again, hazardset6 not complete anymore
+        hazardset2 = DBSession.query(HazardSet).get(u'hazardset2')
+        hazardset2.processed = datetime.now()
+        admin31 = DBSession.query(AdministrativeDivision) \
+            .filter(AdministrativeDivision.code == 31).one()
+        output = DBSession.query(Output) \
+            .filter(Output.hazardset_id == u'hazardset2') \
+            .filter(Output.admin_id == admin31.id) \
+            .one()
+        output.hazardlevel = HazardLevel.get(u'HIG')
+        hazardset6 = DBSession.query(HazardSet).get(u'hazardset6')
+        hazardset6.complete = False
+        transaction.commit()
+
+        DecisionMaker().execute(settings, incremental=True)
+        incremental = relations()
+        self.assertNotEqual(incremental, previous)
+
+        DecisionMaker().execute(settings)
+        self.assertEqual(incremental, relations())
+
+        hazardset6 = DBSession.query(HazardSet).get(u'hazardset6')
+        self.assertIsNone(hazardset6.decided)
+        hazardset2 = DBSession.query(HazardSet).get(u'hazardset2')
+        self.assertGreater(hazardset2.decided, hazardset2.processed)
+
+    def test_incremental_failed_processing(self):
+        '''Test incremental mode after a processing which failed'''
+        DecisionMaker().execute(settings)
+
+        # hazardset2 processed again, without success
+        hazardset2 = DBSession.query(HazardSet).get(u'hazardset2')
+        hazardset2.processed = None
+        hazardset2.processing_error = u'Processing failed'
+        DBSession.query(Output) \
+            .filter(Output.hazardset_id == u'hazardset2') \
+            .delete()
+        transaction.commit()
+
+        DecisionMaker().execute(settings, incremental=True)
+        incremental = relations()
+
+        DecisionMaker().execute(settings)
+        self.assertEqual(incremental, relations())
+
+
+def relations():
+    return sorted(DBSession.execute('''
+SELECT
+    admindiv.code,
+    category.hazardtype_id,
+    category.hazardlevel_id,
+    rel_hs.hazardset_id
+FROM
+    datamart.rel_hazardcategory_administrativedivision AS rel
+    JOIN datamart.administrativedivision AS admindiv
+        ON admindiv.id = rel.administrativedivision_id
+    JOIN datamart.hazardcategory AS category
+        ON category.id = rel.hazardcategory_id
+    LEFT JOIN datamart.rel_hazardcategory_administrativedivision_hazardset
+        AS rel_hs
+        ON rel_hs.rel_hazardcategory_administrativedivision_id = rel.id
+''').fetchall())
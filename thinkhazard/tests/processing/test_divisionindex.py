@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from mock import patch
+from affine import Affine
+
+from ...processing import divisionindex
+from ...processing.divisionindex import (
+    DivisionIndex,
+    index_path,
+    mask_to_runs,
+    runs_to_mask,
+    )
+from .common import ArrayReader
+from .test_zonal import (
+    make_array,
+    make_divisions,
+    make_processor,
+    transform,
+    )
+
+
+class TestDivisionIndex(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.data_path = tempfile.mkdtemp()
+
+    def tearDown(self):  # NOQA
+        shutil.rmtree(self.data_path)
+
+    def test_runs(self):
+        '''Test geometry masks encoding as runs'''
+        random = np.random.RandomState(0)
+        mask = random.uniform(0, 1, (20, 30)) < 0.5
+        window = ((5, 25), (10, 40))
+        runs = mask_to_runs(mask, window)
+        np.testing.assert_array_equal(runs_to_mask(runs, window, mask.shape),
+                                      mask)
+
+        mask = np.ones((20, 30), dtype=np.bool)
+        runs = mask_to_runs(mask, window)
+        self.assertEqual(len(runs), 0)
+        np.testing.assert_array_equal(runs_to_mask(runs, window, mask.shape),
+                                      mask)
+
+    def test_save(self):
+        '''Test index saving and loading'''
+        path = index_path(self.data_path, transform, (100, 100), 'a')
+        self.assertNotEqual(path,
+                            index_path(self.data_path,
+                                       Affine(0.2, 0.0, 0.0, 0.0, -0.2, 10.0),
+                                       (100, 100), 'a'))
+        # Division geometries have changed
+        self.assertNotEqual(path,
+                            index_path(self.data_path, transform, (100, 100),
+                                       'b'))
+        mask = np.zeros((3, 4), dtype=np.bool)
+        mask[1, 2] = True
+
+        index = DivisionIndex(path)
+        index.add(1, 0, ((0, 3), (0, 4)), mask)
+        index.save()
+        self.assertTrue(os.path.isfile(path))
+
+        # Entries saved by others are kept
+        other = DivisionIndex(path)
+        other.add(2, 1, ((10, 13), (20, 24)), ~mask)
+        index.add(3, 0, ((0, 3), (0, 4)), mask)
+        other.save()
+        index.save()
+
+        index = DivisionIndex(path)
+        self.assertEqual(sorted(index.entries.keys()),
+                         [(1, 0), (2, 1), (3, 0)])
+        np.testing.assert_array_equal(
+            index.mask(2, 1, ((10, 13), (20, 24)), (3, 4)), ~mask)
+        # Window has changed
+        self.assertIsNone(index.mask(1, 0, ((0, 3), (1, 5)), (3, 4)))
+        self.assertIsNone(index.mask(4, 0, ((0, 3), (0, 4)), (3, 4)))
+
+        divisionindex.clear(self.data_path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_processor(self):
+        '''Test hazard levels using the division index'''
+        readers = {
+            u'HIG': ArrayReader(make_array(1, 0.001), transform),
+            u'MED': ArrayReader(make_array(2, 0.002), transform),
+            u'LOW': ArrayReader(make_array(3, 0.004), transform),
+            'mask': ArrayReader(make_array(4, 0.05), transform),
+        }
+        processor = make_processor('FL', readers)
+        divisions = make_divisions()
+        expected = [processor.notpreprocessed_hazardlevel('FL', division)
+                    for division in divisions]
+
+        path = index_path(self.data_path, transform, (100, 100), 'a')
+        processor.division_index = DivisionIndex(path)
+        levels = [processor.notpreprocessed_hazardlevel('FL', division,
+                                                        admin_id=i)
+                  for i, division in enumerate(divisions)]
+        self.assertEqual(levels, expected)
+        processor.division_index.save()
+
+        processor.division_index = DivisionIndex(path)
+        with patch('rasterio.features.geometry_mask') as geometry_mask:
+            levels = [processor.notpreprocessed_hazardlevel('FL', division,
+                                                            admin_id=i)
+                      for i, division in enumerate(divisions)]
+        self.assertFalse(geometry_mask.called)
+        self.assertEqual(levels, expected)
+        self.assertEqual(processor.division_index.misses, 0)
@@ -19,11 +19,35 @@
 
 import unittest
 import transaction
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime
+from BaseHTTPServer import BaseHTTPRequestHandler
 from mock import patch
 
+from ...models import (
+    DBSession,
+    HazardSet,
+    HazardType,
+    Layer,
+    )
 from .. import settings
 from . import populate_datamart
-from ...processing.downloading import Downloader
+from common import (
+    StubServer,
+    new_geonode_id,
+    )
+from ...processing import (
+    prefetch,
+    store,
+    )
+from ...processing.downloading import (
+    Download,
+    Downloader,
+    )
 
 
 def populate():
@@ -40,8 +64,242 @@ class TestDownloading(unittest.TestCase):
     def test_cli(self, mock):
         '''Test downloader cli'''
         Downloader.run(['complete', '--config_uri', 'tests.ini'])
-        mock.assert_called_with(hazardset_id=None, clear_cache=False)
+        mock.assert_called_with(hazardset_id=None, clear_cache=False,
+                                workers=1)
 
     def test_force(self):
         '''Test downloader in force mode'''
         Downloader().execute(settings, force=True)
+
+
+class StubFileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # NOQA
+        server = self.server
+        path = server.record(self)
+        content = server.files[path]
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and server.ranges:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        with server.lock:
+            drop = server.drops.get(path, 0)
+            if drop:
+                server.drops[path] = drop - 1
+        if drop:
+            # Connection lost in the middle of the file
+            self.wfile.write(content[start:start + len(content) // 3])
+            self.close_connection = 1
+            return
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubFileServer(StubServer):
+
+    def __init__(self, files, drops={}, ranges=True):
+        StubServer.__init__(self, StubFileHandler)
+        self.files = files
+        self.drops = dict(drops)
+        self.ranges = ranges
+
+
+class TestDownloadFile(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        self.checksum = hashlib.sha256(self.content).hexdigest()
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'hazardsets'))
+        self.downloader = Downloader()
+        self.downloader.settings = {'data_path': self.tmpdir}
+        self.downloader.backoff = 0
+
+    def tearDown(self):  # NOQA
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, **kwargs):
+        server = StubFileServer({'/data/{}.tif'.format(i): self.content
+                                 for i in range(0, 4)}, **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def download(self, server, i=0, checksum=None):
+        return Download(i,
+                        'layer {}'.format(i),
+                        'http://{}/data/{}.tif'.format(server.netloc, i),
+                        os.path.join(self.tmpdir,
+                                     'hazardsets',
+                                     '{}.tif'.format(i)),
+                        datetime(2000, 1, 1),
+                        checksum)
+
+    def assertDownloaded(self, download):  # NOQA
+        self.assertFalse(os.path.exists(download.path + '.part'))
+        with open(download.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertTrue(os.path.samefile(
+            download.path, store.object_path(self.tmpdir, self.checksum)))
+
+    def test_resume(self):
+        '''Interrupted download must resume with a range request'''
+        server = self.serve(drops={'/data/0.tif': 1})
+        download = self.download(server)
+
+        checksum = self.downloader.download_file(download)
+
+        self.assertEqual(checksum, self.checksum)
+        self.assertDownloaded(download)
+        self.assertEqual(len(server.requests), 2)
+        self.assertNotIn('range', server.requests[0][1])
+        self.assertRegexpMatches(server.requests[1][1]['range'],
+                                 r'bytes=[1-9]\d*-')
+
+    def test_resume_part(self):
+        '''Partial file of a previous run must be completed'''
+        server = self.serve()
+        download = self.download(server)
+        with open(download.path + '.part', 'wb') as f:
+            f.write(self.content[:1000])
+
+        checksum = self.downloader.download_file(download)
+
+        self.assertEqual(checksum, self.checksum)
+        self.assertDownloaded(download)
+        self.assertEqual(server.requests[0][1]['range'], 'bytes=1000-')
+
+    def test_no_ranges(self):
+        '''Download must start again if server ignores ranges'''
+        server = self.serve(drops={'/data/0.tif': 1}, ranges=False)
+        download = self.download(server)
+
+        checksum = self.downloader.download_file(download)
+
+        self.assertEqual(checksum, self.checksum)
+        self.assertDownloaded(download)
+
+    def test_checksum(self):
+        '''Download must be verified against known checksum'''
+        server = self.serve()
+        download = self.download(server, checksum='0' * 64)
+
+        with self.assertRaises(Exception) as cm:
+            self.downloader.download_file(download)
+
+        self.assertIn('Checksum mismatch', cm.exception.message)
+        self.assertFalse(os.path.exists(download.path))
+        self.assertFalse(os.path.exists(download.path + '.part'))
+
+    def test_concurrent(self):
+        '''Test concurrent downloads'''
+        server = self.serve(drops={'/data/1.tif': 1, '/data/2.tif': 2})
+        downloads = [self.download(server, i, checksum=self.checksum)
+                     for i in range(0, 4)]
+
+        results = prefetch(self.downloader.download_file, downloads, 3)
+
+        self.assertEqual([result() for result in results],
+                         [self.checksum] * 4)
+        for download in downloads:
+            self.assertDownloaded(download)
+
+
+class TestDownloadLayers(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        DBSession.query(Layer).delete()
+        DBSession.query(HazardSet).delete()
+        populate_datamart()
+        transaction.commit()
+
+        self.content = os.urandom(1024)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.server = StubFileServer({'/data/same.tif': self.content})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.settings = dict(settings,
+                             data_path=self.tmpdir,
+                             geonode=dict(settings['geonode'],
+                                          scheme='http',
+                                          netloc=self.server.netloc))
+        self.ids = [new_geonode_id(), new_geonode_id() + 1]
+        self.populate_layers()
+
+    def populate_layers(self):
+        DBSession.query(Layer).delete()
+        DBSession.query(HazardSet).delete()
+        hazardset = HazardSet(
+            id=u'test',
+            hazardtype=HazardType.get(u'EQ'),
+            local=False,
+            data_lastupdated_date=datetime(2000, 1, 1),
+            metadata_lastupdated_date=datetime(2000, 1, 1))
+        DBSession.add(hazardset)
+        for geonode_id in self.ids:
+            hazardset.layers.append(Layer(
+                geonode_id=geonode_id,
+                return_period=geonode_id,
+                data_lastupdated_date=datetime(2000, 1, 1),
+                metadata_lastupdated_date=datetime(2000, 1, 1),
+                download_url='/data/same.tif',
+                calculation_method_quality=5,
+                scientific_quality=1,
+                local=False,
+                downloaded=False))
+        transaction.commit()
+
+    def test_checksum_mismatch(self):
+        '''File not matching the layer checksum must not be accepted'''
+        DBSession.query(Layer).update({Layer.checksum: u'0' * 64})
+        transaction.commit()
+
+        Downloader().execute(self.settings)
+
+        for layer in DBSession.query(Layer):
+            self.assertFalse(layer.downloaded)
+            self.assertEqual(layer.checksum, u'0' * 64)
+
+        # Accepted once the checksum is cleared
+        DBSession.query(Layer).update({Layer.checksum: None})
+        transaction.commit()
+
+        Downloader().execute(self.settings)
+
+        for layer in DBSession.query(Layer):
+            self.assertTrue(layer.downloaded)
+            self.assertEqual(layer.checksum,
+                             hashlib.sha256(self.content).hexdigest())
+
+    def test_deduplication(self):
+        '''Layers publishing the same file must share one download'''
+        Downloader().execute(self.settings)
+
+        self.assertEqual(len(self.server.requests), 1)
+        layers = DBSession.query(Layer).all()
+        self.assertEqual(set(layer.checksum for layer in layers),
+                         set([hashlib.sha256(self.content).hexdigest()]))
+        self.assertTrue(all(layer.downloaded for layer in layers))
+        downloader = Downloader()
+        downloader.settings = self.settings
+        self.assertTrue(os.path.samefile(downloader.layer_path(layers[0]),
+                                         downloader.layer_path(layers[1])))
+
+        # Complete harvesting recreates the layers
+        self.populate_layers()
+        Downloader().execute(self.settings)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(all(layer.downloaded and layer.checksum
+                            for layer in DBSession.query(Layer)))
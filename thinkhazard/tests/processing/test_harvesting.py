@@ -19,6 +19,9 @@
 
 import unittest
 import transaction
+import random
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
 from datetime import datetime, timedelta
 from mock import Mock, patch, mock_open
 import httplib2
@@ -34,6 +37,7 @@ from ...models import (
 
 from .. import settings
 from . import populate_datamart
+from common import StubServer
 from ...processing.harvesting import Harvester
 
 
@@ -97,7 +101,7 @@ class TestHarvesting(unittest.TestCase):
     def test_cli(self, mock):
         '''Test harvester cli'''
         Harvester.run(['harvest', '--config_uri', 'tests.ini'])
-        mock.assert_called_with(hazard_type=None)
+        mock.assert_called_with(hazard_type=None, workers=1)
 
     @patch.object(Harvester, 'fetch', return_value=[])
     def test_force(self, fetch_mock):
@@ -280,3 +284,96 @@ class TestHarvesting(unittest.TestCase):
 
         layer = DBSession.query(Layer).one()
         self.assertEqual(layer.typename, 'hazard:adm2_fu_raster_v3')
+
+
+class StubGeonodeHandler(BaseHTTPRequestHandler):
+    # Keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # NOQA
+        server = self.server
+        path = server.record(self)
+        with server.lock:
+            failures = server.failures.get(path, 0)
+            if failures:
+                server.failures[path] = failures - 1
+        # Shuffle responses order
+        time.sleep(random.random() * 0.01)
+        if failures:
+            status, content = 503, {'error_message': 'Unavailable'}
+        else:
+            status, content = server.routes.get(
+                path, (404, {'error_message': 'Not found'}))
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGeonode(StubServer):
+
+    def __init__(self, routes, failures={}):
+        StubServer.__init__(self, StubGeonodeHandler)
+        self.routes = routes
+        self.failures = dict(failures)
+
+    def settings(self):
+        return dict(settings, geonode=dict(
+            settings['geonode'],
+            scheme='http',
+            netloc=self.netloc))
+
+
+class TestConcurrentHarvesting(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        populate()
+        ids = range(1, 21)
+        routes = {
+            '/api/layers/': (200, {'objects': layers([{
+                'id': id,
+                'title': 'layer {:02d}'.format(len(ids) - id),
+            } for id in ids])}),
+            '/api/layers/7/': (500, {'error_message': 'Some error.'}),
+        }
+        for id in ids:
+            if id != 7:
+                routes['/api/layers/{}/'.format(id)] = (200, layer({
+                    'id': id,
+                    'title': 'layer {:02d}'.format(len(ids) - id),
+                    'hazard_set': 'TEST{:02d}_GLOBAL'.format(id),
+                }))
+        self.server = StubGeonode(routes, failures={'/api/layers/5/': 2})
+        self.server.start()
+
+    def tearDown(self):  # NOQA
+        self.server.stop()
+
+    def test_layers(self):
+        '''Test concurrent harvesting against a stub GeoNode'''
+        harvester = Harvester()
+        harvester.settings = self.server.settings()
+        harvester.workers = 4
+        harvester.backoff = 0
+
+        with patch.object(Harvester, 'harvest_layer', autospec=True,
+                          side_effect=Harvester.harvest_layer) as mock:
+            harvester.harvest_layers()
+
+        # Layers are written in listing order, failing one is skipped
+        self.assertEqual([call[0][1]['id'] for call in mock.call_args_list],
+                         [id for id in range(20, 0, -1) if id != 7])
+        self.assertEqual(DBSession.query(Layer).count(), 19)
+
+        # Transient errors are retried, others are not
+        paths = self.server.paths()
+        self.assertEqual(paths.count('/api/layers/5/'), 3)
+        self.assertEqual(paths.count('/api/layers/7/'), 1)
+
+        # Listing client plus one persistent connection per worker
+        self.assertLessEqual(len(self.server.connections), 5)
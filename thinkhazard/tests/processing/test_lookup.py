@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+
+from ...models import level_weights
+from ...processing.lookup import (
+    LevelLookup,
+    group_max,
+    )
+
+
+VALUES = {
+    u'HIG': [103, -3],
+    u'MED': [102],
+    u'LOW': [101, 1.5],
+    u'VLO': [100, 0, 103],
+}
+
+
+def reference(values, data):
+    '''Former classification, level by level and value by value'''
+    weights = np.zeros(data.shape, dtype=np.uint8)
+    for level in (u'VLO', u'LOW', u'MED', u'HIG'):
+        for value in values.get(level, []):
+            weights[(data == value).filled(False)] = level_weights[level]
+    return weights
+
+
+class TestLevelLookup(unittest.TestCase):
+
+    def test_classify(self):
+        '''Test lookup against value by value comparisons'''
+        lookup = LevelLookup(VALUES)
+        random = np.random.RandomState(0)
+        for dtype in ('uint8', 'int8', 'uint16', 'int16', 'int32',
+                      'float32', 'float64'):
+            data = random.choice([-3, 0, 1, 5, 100, 101, 102, 103, 255],
+                                 size=(50, 60))
+            data = np.ma.masked_array(
+                data.astype(dtype),
+                random.uniform(0, 1, data.shape) < 0.2)
+            np.testing.assert_array_equal(lookup.classify(data),
+                                          reference(VALUES, data),
+                                          err_msg=dtype)
+        self.assertEqual(sorted(str(dtype) for dtype in lookup.tables),
+                         ['float32', 'float64', 'int16', 'int32', 'int8',
+                          'uint16', 'uint8'])
+
+    def test_max_weight(self):
+        '''Test highest level of a window'''
+        lookup = LevelLookup(VALUES)
+        data = np.ma.masked_array([[0, 101], [103, 102]],
+                                  [[False, False], [True, False]],
+                                  dtype=np.uint8)
+        self.assertEqual(lookup.max_weight(data), level_weights[u'MED'])
+        data[1, 0] = 103
+        self.assertEqual(lookup.max_weight(data), level_weights[u'HIG'])
+        self.assertEqual(lookup.max_weight(data[:0]), 0)
+        self.assertEqual(LevelLookup({}).max_weight(data.astype('float32')),
+                         0)
+
+    def test_group_max(self):
+        '''Test highest weight per group'''
+        weights = np.array([1, 3, 0, 2, 4, 1], dtype=np.uint8)
+        groups = np.array([0, 0, 1, 2, 2, 3])
+        out = np.array([0, 0, 3, 2], dtype=np.uint8)
+        group_max(weights, groups, out)
+        np.testing.assert_array_equal(out, [3, 0, 4, 2])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+from affine import Affine
+
+from ...processing.normalizing import (
+    normalize,
+    overview_factors,
+    same_nodata,
+    )
+
+
+class TestNormalize(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):  # NOQA
+        shutil.rmtree(self.tmpdir)
+
+    def write_strips(self, path, data, nodata):
+        '''Write a strip organized raster, like GeoNode often serves'''
+        with rasterio.drivers():
+            with rasterio.open(path, 'w',
+                               driver='GTiff',
+                               width=data.shape[1],
+                               height=data.shape[0],
+                               count=1,
+                               dtype=data.dtype,
+                               crs={'init': 'epsg:4326'},
+                               transform=Affine(0.1, 0.0, -30.0,
+                                                0.0, -0.1, 20.0),
+                               nodata=nodata,
+                               compress='deflate') as dst:
+                dst.write(data, 1)
+
+    def test_normalize(self):
+        '''Normalized raster must be tiled with same data and georeferencing
+        '''
+        src_path = os.path.join(self.tmpdir, 'src.tif')
+        dst_path = os.path.join(self.tmpdir, 'normalized', 'dst.tif')
+        data = np.random.RandomState(0) \
+            .uniform(0, 10, (700, 1100)).astype(np.float32)
+        self.write_strips(src_path, data, -9999)
+
+        normalize(src_path, dst_path)
+
+        self.assertEqual(os.listdir(os.path.dirname(dst_path)), ['dst.tif'])
+        with rasterio.drivers():
+            with rasterio.open(src_path) as src, \
+                    rasterio.open(dst_path) as dst:
+                self.assertEqual(src.block_shapes[0][1], 1100)
+                self.assertEqual(dst.block_shapes, [(256, 256)])
+                self.assertEqual(dst.overviews(1), [2, 4])
+                self.assertEqual(dst.affine, src.affine)
+                self.assertEqual(dst.shape, src.shape)
+                self.assertEqual(dst.nodata, -9999)
+                window = ((300, 420), (500, 640))
+                np.testing.assert_array_equal(dst.read(1, window=window),
+                                              data[300:420, 500:640])
+
+    def test_normalize_nan_nodata(self):
+        '''Float raster with NaN as nodata must be normalized'''
+        src_path = os.path.join(self.tmpdir, 'src.tif')
+        dst_path = os.path.join(self.tmpdir, 'normalized', 'dst.tif')
+        data = np.random.RandomState(0) \
+            .uniform(0, 10, (300, 400)).astype(np.float32)
+        data[:10] = np.nan
+        self.write_strips(src_path, data, float('nan'))
+
+        normalize(src_path, dst_path)
+
+        with rasterio.drivers():
+            with rasterio.open(dst_path) as dst:
+                self.assertTrue(np.isnan(dst.nodata))
+                np.testing.assert_array_equal(dst.read(1), data)
+
+    def test_same_nodata(self):
+        self.assertTrue(same_nodata(float('nan'), float('nan')))
+        self.assertTrue(same_nodata(-9999, -9999.))
+        self.assertTrue(same_nodata(None, None))
+        self.assertFalse(same_nodata(float('nan'), -9999))
+        self.assertFalse(same_nodata(None, float('nan')))
+        self.assertFalse(same_nodata(0, None))
+
+    def test_overview_factors(self):
+        self.assertEqual(overview_factors((200, 100)), [])
+        self.assertEqual(overview_factors((1800, 3600)),
+                         [2, 4, 8])
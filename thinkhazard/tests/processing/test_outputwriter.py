@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from mock import patch
+
+from ...processing.outputwriter import (
+    OutputWriter,
+    copy_row,
+    )
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def test_copy_row(self):
+        '''Test encoding of rows in COPY text format'''
+        self.assertEqual(copy_row((u'EQ-PA', 12, 3, None)),
+                         'EQ-PA\t12\t3\t\\N\n')
+        self.assertEqual(copy_row((u'a\tb\\c\nd', u'é')),
+                         'a\\tb\\\\c\\nd\t\xc3\xa9\n')
+
+    @patch('thinkhazard.processing.outputwriter.DBSession')
+    def test_buffer(self, session):
+        '''Test rows are sent by bounded batches'''
+        cursor = session.connection.return_value.connection.cursor \
+            .return_value
+        copied = []
+        cursor.copy_expert.side_effect = \
+            lambda sql, buffer: copied.append(buffer.read())
+
+        writer = OutputWriter(u'EQ-PA', buffer_size=2)
+        for admin_id in xrange(0, 5):
+            writer.write(admin_id, 1, 'hash')
+        self.assertEqual(len(copied), 2)
+        writer.close()
+        self.assertEqual(len(copied), 3)
+        self.assertEqual(copied[2], 'EQ-PA\t4\t1\thash\n')
+        self.assertEqual(writer.count, 5)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import transaction
+from datetime import datetime
+from mock import patch
+
+from ...models import (
+    DBSession,
+    HazardSet,
+    Layer,
+    )
+
+from .. import settings
+from ...processing.pipeline import Pipeline
+from ...processing.downloading import Downloader
+from ...processing.normalizing import Normalizer
+from ...processing.completing import Completer
+from ...processing.processing import Processor
+from ...processing.decisiontree import DecisionMaker
+from .test_process import populate
+
+
+def complete_layers(hazardset, layers, regions):
+    hazardset.complete = True
+    return True
+
+
+@patch.object(Downloader, 'collect_garbage')
+@patch.object(Normalizer, 'collect_garbage')
+@patch.object(DecisionMaker, 'do_execute')
+@patch.object(Processor, 'process_hazardset')
+@patch.object(Completer, 'complete_layers', side_effect=complete_layers)
+@patch.object(Normalizer, 'normalize_layer')
+@patch.object(Downloader, 'download_layer')
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        populate()
+
+    def run_pipeline(self, **kwargs):
+        Pipeline().execute(settings, harvest=False, **kwargs)
+
+    @patch.object(Pipeline, 'do_execute')
+    def test_cli(self, mock, *args):
+        '''Test pipeline cli'''
+        Pipeline.run(['pipeline', '--config_uri', 'tests.ini'])
+        mock.assert_called_with(hazardset_id=None, workers=1, harvest=True,
+                                engine='polygon', block_cache=0,
+                                division_index=False, pyramid=False,
+                                memory_budget=256)
+
+    def test_stages(self, download, normalize, complete, process,
+                    decision_tree, *args):
+        '''Test pending stages are run for each hazardset'''
+        layer = DBSession.query(Layer) \
+            .filter(Layer.hazardset_id == u'notpreprocessed') \
+            .first()
+        layer.downloaded = False
+        hazardset = DBSession.query(HazardSet).get(u'notpreprocessed')
+        hazardset.complete = False
+        transaction.commit()
+
+        self.run_pipeline()
+
+        download.assert_called_once_with((layer.geonode_id, ))
+        # Download is mocked, so the layer is still not downloaded
+        self.assertEqual(normalize.call_count,
+                         DBSession.query(Layer)
+                         .filter(Layer.downloaded.is_(True)).count())
+        self.assertEqual([call[0][0].id for call in complete.call_args_list],
+                         [u'notpreprocessed'])
+        self.assertEqual(sorted(call[0][0] for call in
+                                process.call_args_list),
+                         [u'notpreprocessed', u'preprocessed'])
+        decision_tree.assert_called_once_with(incremental=True)
+
+    def test_up_to_date(self, download, normalize, complete, process,
+                        decision_tree, *args):
+        '''Test up to date hazardsets are skipped'''
+        DBSession.query(Layer).update({
+            Layer.normalized_path: 'normalized/file.tif'
+        })
+        DBSession.query(HazardSet).update({
+            HazardSet.processed: datetime.now()
+        })
+        transaction.commit()
+
+        self.run_pipeline()
+
+        self.assertFalse(download.called)
+        self.assertFalse(normalize.called)
+        self.assertFalse(complete.called)
+        self.assertFalse(process.called)
+        decision_tree.assert_called_once_with(incremental=True)
+
+    def test_force(self, download, normalize, complete, process,
+                   decision_tree, *args):
+        '''Test hazardsets are completed and processed again in force
+        mode'''
+        DBSession.query(Layer).update({
+            Layer.normalized_path: 'normalized/file.tif'
+        })
+        DBSession.query(HazardSet).update({
+            HazardSet.processed: datetime.now()
+        })
+        transaction.commit()
+
+        self.run_pipeline(force=True)
+
+        self.assertFalse(download.called)
+        self.assertEqual(complete.call_count, 2)
+        self.assertEqual(process.call_count, 2)
+        decision_tree.assert_called_once_with(incremental=False)
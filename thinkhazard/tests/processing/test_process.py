@@ -27,17 +27,23 @@ from affine import Affine
 
 from ...models import (
     DBSession,
+    AdministrativeDivision,
     HazardLevel,
     HazardSet,
     HazardType,
     Layer,
     Output,
     Region,
+    RegionMembership,
     )
 
 from .. import settings
 from . import populate_datamart
-from ...processing.processing import Processor
+from ...processing.processing import (
+    Processor,
+    division_batches,
+    spatial_order,
+    )
 from common import new_geonode_id
 
 
@@ -85,7 +91,13 @@ class TestProcess(unittest.TestCase):
     def test_cli(self, mock):
         '''Test processor cli'''
         Processor.run(['process', '--config_uri', 'tests.ini'])
-        mock.assert_called_with(hazardset_id=None)
+        mock.assert_called_with(hazardset_id=None, workers=1,
+                                engine='polygon', block_cache=0,
+                                division_index=False, incremental=False,
+                                pyramid=False, memory_budget=256,
+                                shared_rasters=False, enqueue=False,
+                                worker=False, lease=300,
+                                resume=False, statistics=False)
 
     @patch('rasterio.open', return_value=global_reader())
     def test_force(self, open_mock):
@@ -110,6 +122,29 @@ class TestProcess(unittest.TestCase):
         Processor().execute(settings, hazardset_id='notpreprocessed')
         output = DBSession.query(Output).first()
         self.assertEqual(output.hazardlevel.mnemonic, 'VLO')
+        # Geometries are only hashed for incremental processing
+        self.assertIsNone(output.fingerprint)
+        hazardset = DBSession.query(HazardSet).get(u'notpreprocessed')
+        self.assertIsNone(hazardset.divisions_fingerprint)
+
+    @patch('rasterio.open', side_effect=[
+        global_reader(0.0),
+        global_reader(),
+        global_reader(),
+        global_reader()
+    ])
+    def test_region_membership(self, open_mock):
+        '''Test divisions out of the hazardset regions are not processed'''
+        self.assertEqual(DBSession.query(RegionMembership).count(), 1)
+        for region in DBSession.query(Region):
+            region.administrativedivisions = []
+        RegionMembership.refresh()
+        transaction.commit()
+        self.assertEqual(DBSession.query(RegionMembership).count(), 0)
+
+        Processor().execute(settings, hazardset_id='notpreprocessed')
+        output = DBSession.query(Output).first()
+        self.assertEqual(output, None)
 
     @patch('rasterio.open', side_effect=[
         global_reader(),
@@ -159,6 +194,20 @@ class TestProcess(unittest.TestCase):
         output = DBSession.query(Output).first()
         self.assertEqual(output, None)
 
+    @patch('rasterio.open', return_value=global_reader(100.0))
+    def test_process_invalid_settings(self, open_mock):
+        '''Test settings without threshold for the layers unit'''
+        type_settings = settings['hazard_types'][notpreprocessed_type]
+        with patch.dict(type_settings, {'thresholds': {'xx': 1}}):
+            Processor().execute(settings, hazardset_id='notpreprocessed')
+        hazardset = DBSession.query(HazardSet).get(u'notpreprocessed')
+        self.assertIsNone(hazardset.processed)
+        self.assertEqual(hazardset.processing_error,
+                         'Invalid settings of hazard type {}: '
+                         'No threshold found for global HIG {}'
+                         .format(notpreprocessed_type, notpreprocessed_unit))
+        self.assertEqual(DBSession.query(Output).first(), None)
+
     @patch('rasterio.open', side_effect=[
         global_reader(),
     ])
@@ -216,6 +265,145 @@ class TestProcess(unittest.TestCase):
         output = DBSession.query(Output).first()
         self.assertEqual(output.hazardlevel.mnemonic, u'HIG')
 
+    @patch('rasterio.open')
+    def test_process_workers(self, open_mock):
+        '''Test processing with a pool of worker processes'''
+        hazardtype = HazardType.get(preprocessed_type)
+        hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
+        open_mock.return_value = global_reader(
+            hazardtype_settings['values']['HIG'][0])
+        Processor().execute(settings, hazardset_id='preprocessed', workers=2)
+        output = DBSession.query(Output).first()
+        self.assertEqual(output.hazardlevel.mnemonic, u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+
+    @patch('rasterio.open')
+    def test_incremental(self, open_mock):
+        '''Test incremental processing'''
+        hazardtype = HazardType.get(preprocessed_type)
+        hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
+
+        def process(level, checksum):
+            hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+            hazardset.processed = None
+            transaction.commit()
+            open_mock.return_value = global_reader(
+                hazardtype_settings['values'][level][0])
+            with patch.object(Processor, 'layer_checksum',
+                              return_value=checksum):
+                Processor().execute(settings, hazardset_id='preprocessed',
+                                    incremental=True)
+            return DBSession.query(Output).first().hazardlevel.mnemonic
+
+        self.assertEqual(process(u'HIG', 'a'), u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.fingerprint)
+        self.assertIsNotNone(DBSession.query(Output).first().fingerprint)
+
+        # Same inputs, outputs are kept
+        self.assertEqual(process(u'MED', 'a'), u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+
+        # Layer file has changed
+        DBSession.query(Layer).update({Layer.checksum: None})
+        self.assertEqual(process(u'MED', 'b'), u'MED')
+
+    @patch('rasterio.open')
+    def test_resume(self, open_mock):
+        '''Test processing resumed after a checkpoint'''
+        hazardtype = HazardType.get(preprocessed_type)
+        hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
+
+        def process(level, checkpoint_fingerprint):
+            hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+            if hazardset.processed is not None:
+                checkpoint_fingerprint = checkpoint_fingerprint or \
+                    '{}:{}'.format(hazardset.fingerprint,
+                                   hazardset.divisions_fingerprint)
+                hazardset.processed = None
+            # Checkpoint at the last division
+            hazardset.checkpoint_key, hazardset.checkpoint_id = \
+                DBSession.query(spatial_order(AdministrativeDivision.geom),
+                                AdministrativeDivision.id) \
+                .filter(AdministrativeDivision.geom.isnot(None)) \
+                .order_by(spatial_order(AdministrativeDivision.geom).desc(),
+                          AdministrativeDivision.id.desc()) \
+                .first()
+            hazardset.checkpoint_fingerprint = checkpoint_fingerprint
+            transaction.commit()
+            open_mock.return_value = global_reader(
+                hazardtype_settings['values'][level][0])
+            with patch.object(Processor, 'layer_checksum',
+                              return_value='a'):
+                Processor().execute(settings, hazardset_id='preprocessed',
+                                    resume=True)
+            return DBSession.query(Output).first()
+
+        # No previous run, all divisions are processed
+        self.assertEqual(process(u'HIG', None).hazardlevel.mnemonic, u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+        self.assertIsNone(hazardset.checkpoint_id)
+
+        # Same inputs, all divisions were done before the interruption, their
+        # outputs are kept
+        self.assertEqual(process(u'MED', None).hazardlevel.mnemonic, u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+        self.assertIsNone(hazardset.checkpoint_id)
+
+        # Inputs have changed since the checkpoint
+        self.assertEqual(process(u'MED', 'other').hazardlevel.mnemonic,
+                         u'MED')
+
+    @patch('rasterio.open')
+    def test_resume_error(self, open_mock):
+        '''Test outputs committed before an error are kept for resuming'''
+        hazardtype = HazardType.get(preprocessed_type)
+        hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
+        open_mock.return_value = global_reader(
+            hazardtype_settings['values'][u'HIG'][0])
+        batches = []
+        write_outputs = Processor.write_outputs
+
+        def failing_write_outputs(self, hazardset, writer, batch):
+            batches.append(batch)
+            if len(batches) == 2:
+                return 'Failure'
+            return write_outputs(self, hazardset, writer, batch)
+
+        def single_batches(query, hashes, keys):
+            return division_batches(query, 1, hashes, keys)
+
+        with patch('thinkhazard.processing.processing.division_batches',
+                   side_effect=single_batches), \
+                patch.object(Processor, 'write_outputs',
+                             failing_write_outputs), \
+                patch.object(Processor, 'layer_checksum', return_value='a'):
+            Processor().execute(settings, hazardset_id='preprocessed',
+                                resume=True)
+
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertEqual(hazardset.processing_error, 'Failure')
+        self.assertIsNone(hazardset.processed)
+        self.assertEqual(hazardset.checkpoint_id, batches[0][0][0])
+        self.assertEqual(set(output.admin_id
+                             for output in DBSession.query(Output)),
+                         set([batches[0][0][0]]))
+
+        # Next run resumes after the checkpoint
+        with patch.object(Processor, 'layer_checksum', return_value='a'):
+            Processor().execute(settings, hazardset_id='preprocessed',
+                                resume=True)
+
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+        self.assertIsNone(hazardset.checkpoint_id)
+        self.assertIn(batches[0][0][0], set(
+            output.admin_id for output in DBSession.query(Output)))
+
 
 def populate_notpreprocessed(type, unit):
     hazardset_id = u'notpreprocessed'
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from ...processing import pyramid
+from ...processing.pyramid import (
+    Pyramid,
+    load_or_build,
+    pyramid_path,
+    )
+from .common import ArrayReader
+from .test_zonal import (
+    make_array,
+    make_divisions,
+    make_processor,
+    transform,
+    )
+
+
+def make_readers():
+    return {
+        u'HIG': ArrayReader(make_array(1, 0.001), transform),
+        u'MED': ArrayReader(make_array(2, 0.002), transform),
+        u'LOW': ArrayReader(make_array(3, 0.004), transform),
+        'mask': ArrayReader(make_array(4, 0.05), transform),
+    }
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.data_path = tempfile.mkdtemp()
+
+    def tearDown(self):  # NOQA
+        shutil.rmtree(self.data_path)
+
+    def test_build(self):
+        '''Test block statistics at each level'''
+        data = make_array(1, 0.01)
+        result = Pyramid.build(ArrayReader(data, transform),
+                               block_size=8, factor=2)
+        self.assertEqual([level[0].shape for level in result.levels],
+                         [(13, 13), (7, 7), (4, 4), (2, 2), (1, 1)])
+        for i, (mins, maxs, counts) in enumerate(result.levels):
+            size = 8 * 2 ** i
+            last = 99 // size
+            block = data[last * size:, last * size:]
+            self.assertEqual(counts[last, last], block.count())
+            self.assertEqual(mins[last, last], block.min())
+            self.assertEqual(maxs[last, last], block.max())
+        # Block with nodata only
+        self.assertEqual(result.levels[0][2][0, 0], 0)
+        self.assertTrue(np.isnan(result.levels[0][1][0, 0]))
+        self.assertEqual(result.levels[-1][2][0, 0], data.count())
+
+    def test_build_nan(self):
+        '''Test NaN pixels are ignored in block statistics'''
+        data = make_array(1, 0.01)
+        data[8:16, 8:16] = 0.5
+        data[8, 8] = 2.0
+        data[9, 9] = np.nan
+        data[16:24, 16:24] = np.nan
+        data.mask[8:24, 8:24] = False
+        result = Pyramid.build(ArrayReader(data, transform),
+                               block_size=8, factor=2)
+        mins, maxs, counts = result.levels[0]
+        self.assertEqual((mins[1, 1], maxs[1, 1], counts[1, 1]),
+                         (0.5, 2.0, 63))
+        self.assertEqual(counts[2, 2], 0)
+        mins, maxs, counts = result.levels[1]
+        self.assertEqual(maxs[0, 0], 2.0)
+
+    def test_save(self):
+        '''Test pyramid saving and loading'''
+        reader = ArrayReader(make_array(1, 0.01), transform)
+        built = load_or_build(self.data_path, 'abc', reader)
+        path = pyramid_path(self.data_path, 'abc')
+        self.assertTrue(os.path.isfile(path))
+
+        loaded = load_or_build(self.data_path, 'abc', None)
+        self.assertEqual(loaded.shape, built.shape)
+        self.assertEqual(len(loaded.levels), len(built.levels))
+        for expected, actual in zip(built.levels, loaded.levels):
+            for a, b in zip(expected, actual):
+                np.testing.assert_array_equal(a, b)
+
+        self.assertEqual(pyramid.collect_garbage(self.data_path, ['abc']), 0)
+        self.assertGreater(pyramid.collect_garbage(self.data_path, []), 0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_processor(self):
+        '''Test hazard levels using pyramids against full reads'''
+        divisions = make_divisions()
+        for mask, inverted in ((True, False), (False, False), (False, True)):
+            readers = make_readers()
+            processor = make_processor('FL', readers)
+            processor.type_settings = dict(processor.type_settings)
+            if not mask:
+                del processor.type_settings['mask_return_period']
+                del readers['mask']
+            processor.type_settings['inverted_comparison'] = inverted
+            expected = [processor.notpreprocessed_hazardlevel('FL', division)
+                        for division in divisions]
+
+            for block_size, factor in ((4, 2), (16, 4)):
+                processor.pyramids = dict(
+                    (key, Pyramid.build(reader, block_size, factor))
+                    for key, reader in readers.items())
+                processor.pyramid_stats = [0, 0, 0]
+                levels = [processor.notpreprocessed_hazardlevel('FL',
+                                                                division)
+                          for division in divisions]
+                self.assertEqual(levels, expected)
+                if block_size == 4:
+                    # Some comparisons decided from statistics only
+                    self.assertGreater(processor.pyramid_stats[0], 0)
+
+    def test_reads(self):
+        '''Test pixels are not read when statistics are enough'''
+        readers = make_readers()
+        del readers['mask']
+        readers[u'HIG'].array[:] = 2.0
+        processor = make_processor('FL', readers)
+        processor.type_settings = dict(processor.type_settings)
+        del processor.type_settings['mask_return_period']
+        processor.pyramids = dict((key, Pyramid.build(reader))
+                                  for key, reader in readers.items())
+        processor.pyramid_stats = [0, 0, 0]
+        readers[u'HIG'].reads = 0
+
+        for division in make_divisions():
+            level = processor.notpreprocessed_hazardlevel('FL', division)
+            self.assertEqual(level.mnemonic, u'HIG')
+        self.assertEqual(readers[u'HIG'].reads, 0)
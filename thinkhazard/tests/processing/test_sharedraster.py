@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from ...processing import sharedraster
+from ...processing.sharedraster import SharedReader
+from .common import ArrayReader
+from .test_pyramid import make_readers
+from .test_zonal import (
+    make_array,
+    make_divisions,
+    make_processor,
+    transform,
+    )
+
+
+class TestSharedRaster(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.data_path = tempfile.mkdtemp()
+        self.strip_rows = sharedraster.STRIP_ROWS
+        # Several strips per raster
+        sharedraster.STRIP_ROWS = 32
+
+    def tearDown(self):  # NOQA
+        sharedraster.STRIP_ROWS = self.strip_rows
+        shutil.rmtree(self.data_path)
+
+    def share(self, reader, name='layer'):
+        path = os.path.join(self.data_path, name)
+        sharedraster.write(path, reader)
+        return SharedReader(reader, path)
+
+    def test_read(self):
+        '''Test windows read from shared files'''
+        reader = ArrayReader(make_array(1, 0.01), transform)
+        shared = self.share(reader)
+        for window in (((0, 100), (0, 100)), ((10, 45), (20, 21)),
+                       ((-5, 20), (90, 120)), ((50, 50), (0, 10))):
+            expected = reader.read(1, window=window, masked=True)
+            actual = shared.read(1, window=window, masked=True)
+            np.testing.assert_array_equal(actual.data, expected.data)
+            np.testing.assert_array_equal(actual.mask, expected.mask)
+        # Pixel values are not copied
+        self.assertFalse(actual.data.flags.owndata)
+        self.assertEqual(shared.bounds, reader.bounds)
+
+    def test_no_nodata(self):
+        '''Test rasters without nodata have no mask file'''
+        reader = ArrayReader(make_array(1, 0.01, nodata=False), transform)
+        shared = self.share(reader)
+        self.assertIsNone(shared.mask)
+        data = shared.read(1, window=((0, 10), (0, 10)), masked=True)
+        self.assertFalse(data.mask.any())
+        # Mask can be updated by processing
+        data.mask = data.mask | True
+        self.assertTrue(data.mask.all())
+
+    def test_processor(self):
+        '''Test hazard levels from shared files against raster reads'''
+        readers = make_readers()
+        processor = make_processor('FL', readers)
+        divisions = make_divisions()
+        expected = [processor.notpreprocessed_hazardlevel('FL', division)
+                    for division in divisions]
+
+        processor.readers = dict(
+            (key, self.share(reader, str(key)))
+            for key, reader in readers.items())
+        self.assertEqual([processor.notpreprocessed_hazardlevel('FL',
+                                                                division)
+                          for division in divisions],
+                         expected)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import unittest
+import yaml
+from mock import patch
+
+from ...models import (
+    DBSession,
+    DivisionStatistics,
+    HazardSet,
+    )
+
+from .. import settings
+from ...processing.processing import Processor
+from ...processing.simulation import (
+    load_hazard_types,
+    simulate,
+    )
+from .test_process import (
+    global_reader,
+    populate,
+    preprocessed_type,
+    )
+
+
+class TestSimulation(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        populate()
+        type_settings = settings['hazard_types'][preprocessed_type]
+        with patch('rasterio.open', return_value=global_reader(
+                type_settings['values']['HIG'][0])):
+            Processor().execute(settings, hazardset_id='preprocessed',
+                                statistics=True)
+
+    def test_statistics(self):
+        '''Test statistics are stored by processing'''
+        rows = DBSession.query(DivisionStatistics).all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].layer, u'values')
+        self.assertGreater(rows[0].count, 0)
+        self.assertEqual(len(rows[0].values), 1)
+
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        Processor().clean_outputs(hazardset)
+        self.assertEqual(DBSession.query(DivisionStatistics).count(), 0)
+
+    def test_simulate(self):
+        '''Test divisions changing level with other values'''
+        hazard_types = copy.deepcopy(settings['hazard_types'])
+        report = simulate(hazard_types)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(len(report['countries']), 1)
+        row = report['countries'][0]
+        self.assertEqual(row['hazardtype'], preprocessed_type)
+        self.assertEqual(row['country_code'], 10)
+        self.assertEqual((row['divisions'], row['changed'],
+                          row['undecided']), (1, 0, 0))
+
+        values = hazard_types[preprocessed_type]['values']
+        values['LOW'] = values.pop('HIG')
+        report = simulate(hazard_types, preprocessed_type)
+        self.assertEqual(report['countries'][0]['changed'], 1)
+
+        values['HIG'] = 'a'
+        report = simulate(hazard_types)
+        self.assertEqual(report['countries'], [])
+        self.assertEqual(report['errors'].keys(), [preprocessed_type])
+
+    def test_load_hazard_types(self):
+        '''Test settings file content'''
+        hazard_types = load_hazard_types(yaml.dump(
+            {'hazard_types': settings['hazard_types']}))
+        self.assertIn(preprocessed_type, hazard_types)
+        with self.assertRaises(ValueError):
+            load_hazard_types('- a')
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+from mock import Mock
+
+from ...processing.processing import WINDOW_PIXEL_BYTES
+from ...processing.statistics import (
+    IncompleteStatistics,
+    Statistics,
+    classify,
+    )
+from .common import ArrayReader
+from .test_pyramid import make_readers
+from .test_zonal import (
+    make_divisions,
+    make_processor,
+    shape,
+    transform,
+    )
+
+
+def mnemonic(level):
+    return None if level is None else level.mnemonic
+
+
+class TestStatistics(unittest.TestCase):
+
+    def test_add(self):
+        '''Test statistics of the pixels not masked'''
+        statistics = Statistics()
+        statistics.add(np.ma.masked_array([1., 5., np.nan, 9.],
+                                          [False, False, False, True]))
+        statistics.add(np.ma.masked_array([3., 1.]))
+        self.assertEqual(statistics.count, 5)
+        self.assertEqual(statistics.minimum, 1.)
+        self.assertEqual(statistics.maximum, 5.)
+        self.assertEqual(statistics.histogram, {1.: 2, 3.: 1, 5.: 1})
+
+        statistics.add(np.ma.masked_array(np.arange(20.)))
+        self.assertIsNone(statistics.histogram)
+        self.assertEqual(statistics.maximum, 19.)
+
+    def test_notpreprocessed(self):
+        '''Test levels from statistics against levels from pixels, with
+        other thresholds'''
+        processor = make_processor('FL', make_readers())
+        divisions = make_divisions()
+        expected = [mnemonic(processor.notpreprocessed_hazardlevel('FL',
+                                                                   division))
+                    for division in divisions]
+        statistics = []
+        for budget in (0, 37):
+            processor.window_budget = budget * WINDOW_PIXEL_BYTES
+            levels = []
+            for division in divisions:
+                level, division_statistics = \
+                    processor.statistics_hazardlevel(division)
+                levels.append(mnemonic(level))
+                statistics.append(division_statistics)
+            self.assertEqual(levels, expected)
+
+        processor.window_budget = 0
+        for thresholds, inverted, mask in (({'m': 0.899}, False, True),
+                                           ({'m': 0.001}, True, True),
+                                           ({'m': 0.899}, False, False)):
+            processor.type_settings = dict(processor.type_settings,
+                                           thresholds=thresholds,
+                                           inverted_comparison=inverted)
+            if not mask:
+                del processor.type_settings['mask_return_period']
+            plan = processor.classification_plan()
+            expected = [
+                mnemonic(processor.notpreprocessed_hazardlevel('FL',
+                                                               division))
+                for division in divisions]
+            self.assertEqual(set(expected),
+                             set([u'HIG', u'MED', u'LOW', u'VLO', None]))
+            self.assertEqual([classify(plan, item)
+                              for item in statistics[:len(divisions)]],
+                             expected)
+
+        # Statistics collected without mask layer
+        level, no_mask = processor.statistics_hazardlevel(divisions[0])
+        processor.type_settings = dict(processor.type_settings,
+                                       mask_return_period=[2, 5])
+        with self.assertRaises(IncompleteStatistics):
+            classify(processor.classification_plan(), no_mask)
+
+    def test_row(self):
+        '''Test statistics are the same once stored'''
+        statistics = Statistics()
+        statistics.add(np.ma.masked_array([1., 5., 3.], [False, False, True]),
+                       np.ma.masked_array([0., 2., 1.], [True, False, False]))
+        self.assertEqual(statistics.upper, [(-np.inf, 1.), (2., 5.)])
+        self.assertEqual(statistics.lower, [(np.inf, 1.)])
+        row = statistics.row()
+        self.assertEqual(row['upper'], [[-np.inf, 1.], [2., 5.]])
+        loaded = Statistics.from_row(Mock(**row))
+        for name in ('count', 'minimum', 'maximum', 'histogram', 'mask',
+                     'upper', 'lower'):
+            self.assertEqual(getattr(loaded, name), row.get(name, getattr(
+                statistics, name)))
+
+    def test_preprocessed(self):
+        '''Test levels from statistics against levels from pixels, with
+        other values'''
+        random = np.random.RandomState(5)
+        data = random.choice([0, 5, 100, 101, 102],
+                             size=shape).astype(np.float32)
+        data[random.uniform(0, 1, shape) < 0.0005] = 103
+        mask = np.zeros(shape, dtype=np.bool)
+        mask[0:30, 0:30] = True
+        readers = {
+            0: ArrayReader(np.ma.masked_array(data, mask), transform)
+        }
+        processor = make_processor('VA', readers)
+        divisions = make_divisions()
+
+        statistics = []
+        for division in divisions:
+            level, division_statistics = \
+                processor.statistics_hazardlevel(division)
+            self.assertEqual(mnemonic(level),
+                             mnemonic(processor.preprocessed_hazardlevel(
+                                 division)))
+            statistics.append(division_statistics)
+
+        processor.type_settings = dict(processor.type_settings,
+                                       values={u'HIG': [102], u'LOW': [5]})
+        plan = processor.classification_plan()
+        self.assertEqual(
+            [classify(plan, item) for item in statistics],
+            [mnemonic(processor.preprocessed_hazardlevel(division))
+             for division in divisions])
+
+        statistics[0]['values'].histogram = None
+        with self.assertRaises(IncompleteStatistics):
+            classify(plan, statistics[0])
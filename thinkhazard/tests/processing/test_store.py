@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from ...processing import store
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.data_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.data_path, 'hazardsets'))
+
+    def tearDown(self):  # NOQA
+        shutil.rmtree(self.data_path)
+
+    def layer_file(self, name, content):
+        path = os.path.join(self.data_path, 'hazardsets', name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_deduplication(self):
+        '''Same content must be stored once and linked by each layer'''
+        checksum = hashlib.sha256('data').hexdigest()
+        for name in ('1-a.tif', '2-b.tif'):
+            path = self.layer_file(name + '.part', 'data')
+            self.assertEqual(store.file_checksum(path), checksum)
+            store.add(self.data_path, path, checksum)
+            self.assertFalse(os.path.exists(path))
+            store.link(self.data_path, checksum, path[:-5])
+
+        stored = store.object_path(self.data_path, checksum)
+        self.assertTrue(store.contains(self.data_path, checksum))
+        self.assertEqual(os.stat(stored).st_nlink, 3)
+        with open(os.path.join(self.data_path, 'hazardsets', '2-b.tif')) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_link_replace(self):
+        '''Linking must replace a previous file of the layer'''
+        checksum = hashlib.sha256('new').hexdigest()
+        store.add(self.data_path, self.layer_file('new', 'new'), checksum)
+        path = self.layer_file('1-a.tif', 'old')
+
+        store.link(self.data_path, checksum, path)
+
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new')
+
+    def test_collect_garbage(self):
+        '''Unused layer files and stored files must be removed'''
+        paths = []
+        for content in ('used', 'unused'):
+            checksum = hashlib.sha256(content).hexdigest()
+            store.add(self.data_path,
+                      self.layer_file('download', content),
+                      checksum)
+            path = os.path.join(self.data_path, 'hazardsets', content)
+            store.link(self.data_path, checksum, path)
+            paths.append(path)
+        self.layer_file('legacy.tif', 'legacy')
+        self.layer_file('partial.tif.part', 'partial')
+
+        freed = store.collect_garbage(self.data_path, paths[:1])
+
+        self.assertEqual(freed, len('unused') + len('legacy'))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.data_path,
+                                                        'hazardsets'))),
+                         ['partial.tif.part', 'used'])
+        self.assertTrue(store.contains(
+            self.data_path, hashlib.sha256('used').hexdigest()))
+        self.assertFalse(store.contains(
+            self.data_path, hashlib.sha256('unused').hexdigest()))
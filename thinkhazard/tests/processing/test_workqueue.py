@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import transaction
+from datetime import datetime, timedelta
+from mock import patch
+from sqlalchemy.orm import sessionmaker
+
+from ...models import (
+    DBSession,
+    HazardSet,
+    HazardType,
+    Output,
+    ProcessingTask,
+    )
+
+from .. import settings
+from ...processing import workqueue
+from ...processing.processing import Processor
+from .test_process import (
+    global_reader,
+    populate,
+    preprocessed_type,
+    )
+
+
+def hig_reader():
+    hazardtype = HazardType.get(preprocessed_type)
+    hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
+    return global_reader(hazardtype_settings['values']['HIG'][0])
+
+
+def enqueue():
+    Processor().execute(settings, hazardset_id='preprocessed', enqueue=True)
+
+
+def expire(task, worker='deadhost:1'):
+    '''Give a task to a worker which stopped sending heartbeats'''
+    task.worker = worker
+    task.heartbeat = datetime.now() - timedelta(hours=1)
+
+
+@patch('rasterio.open')
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        populate()
+
+    def test_enqueue(self, open_mock):
+        '''Test hazardsets are split in tasks'''
+        open_mock.return_value = hig_reader()
+        enqueue()
+        tasks = DBSession.query(ProcessingTask).all()
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual([task.hazardset_id for task in tasks],
+                         [u'preprocessed'])
+        self.assertGreater(len(tasks[0].admin_ids), 0)
+        self.assertIsNone(tasks[0].worker)
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNone(hazardset.processed)
+        self.assertEqual(DBSession.query(Output).count(), 0)
+
+    def test_workers(self, open_mock):
+        '''Test tasks are run by several worker processes'''
+        open_mock.return_value = hig_reader()
+        enqueue()
+        Processor().execute(settings, worker=True, workers=2)
+
+        output = DBSession.query(Output).first()
+        self.assertEqual(output.hazardlevel.mnemonic, u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+        self.assertIsNotNone(hazardset.fingerprint)
+        self.assertEqual(DBSession.query(ProcessingTask).count(), 0)
+
+    def test_skip_locked(self, open_mock):
+        '''Test a task being claimed is skipped by other workers'''
+        open_mock.return_value = hig_reader()
+        enqueue()
+        task = workqueue.claim('host1:1')
+        self.assertIsNotNone(task)
+
+        # Another host, while the claim is not committed
+        other = sessionmaker(bind=DBSession.bind)()
+        try:
+            self.assertIsNone(workqueue.claim('host2:1', session=other))
+        finally:
+            other.rollback()
+            other.close()
+
+        transaction.commit()
+        self.assertIsNone(workqueue.claim('host2:1'))
+        transaction.abort()
+
+    def test_lease_expiry(self, open_mock):
+        '''Test the task of a crashed worker is run again'''
+        open_mock.return_value = hig_reader()
+        enqueue()
+        task = workqueue.claim('deadhost:1')
+        expire(task)
+        transaction.commit()
+
+        Processor().execute(settings, worker=True)
+
+        output = DBSession.query(Output).first()
+        self.assertEqual(output.hazardlevel.mnemonic, u'HIG')
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNotNone(hazardset.processed)
+
+    def test_lost_lease(self, open_mock):
+        '''Test outputs of a task given to another worker are dropped'''
+        open_mock.return_value = hig_reader()
+        enqueue()
+        task = workqueue.claim('slowhost:1')
+        task_id = task.id
+        expire(task)
+        transaction.commit()
+        workqueue.claim('host2:1')
+        transaction.commit()
+
+        self.assertFalse(workqueue.complete(task_id, u'preprocessed',
+                                            'slowhost:1', [], None))
+        transaction.abort()
+        self.assertFalse(DBSession.query(ProcessingTask).get(task_id).done)
+
+    def test_abandoned(self, open_mock):
+        '''Test tasks failing too many times are given up'''
+        open_mock.return_value = hig_reader()
+        enqueue()
+        task = DBSession.query(ProcessingTask).first()
+        task.attempts = workqueue.MAX_ATTEMPTS
+        expire(task)
+        transaction.commit()
+
+        Processor().execute(settings, worker=True)
+
+        self.assertEqual(DBSession.query(Output).count(), 0)
+        hazardset = DBSession.query(HazardSet).get(u'preprocessed')
+        self.assertIsNone(hazardset.processed)
+        self.assertIn('abandoned', hazardset.processing_error)
+        self.assertEqual(DBSession.query(ProcessingTask).count(), 0)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2017 by the GFDRR / World Bank
+#
+# This file is part of ThinkHazard.
+#
+# ThinkHazard is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# ThinkHazard is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ThinkHazard.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+from mock import Mock
+from affine import Affine
+from shapely.geometry import (
+    MultiPolygon,
+    Polygon,
+    )
+
+from ...models import HazardLevel
+from .. import settings
+from ...processing.processing import (
+    WINDOW_PIXEL_BYTES,
+    Processor,
+    polygon_from_boundingbox,
+    split_antimeridian,
+    sub_windows,
+    )
+from ...processing.zonal import TileClassifier
+from .common import ArrayReader
+
+
+transform = Affine(0.1, 0.0, 0.0, 0.0, -0.1, 10.0)
+shape = (100, 100)
+LEVELS = (u'HIG', u'MED', u'LOW')
+
+
+def make_divisions(size=7):
+    '''A jittered mesh of quadrilaterals sharing their edges. Some divisions
+    are made of two distant cells.'''
+    random = np.random.RandomState(0)
+    step = 10.0 / size
+    nodes = {}
+    for i in xrange(0, size + 1):
+        for j in xrange(0, size + 1):
+            x, y = i * step, j * step
+            if 0 < i < size and 0 < j < size:
+                x += random.uniform(-0.3, 0.3) * step
+                y += random.uniform(-0.3, 0.3) * step
+            nodes[(i, j)] = (x, y)
+    cells = []
+    for i in xrange(0, size):
+        for j in xrange(0, size):
+            cells.append(Polygon([nodes[(i, j)],
+                                  nodes[(i + 1, j)],
+                                  nodes[(i + 1, j + 1)],
+                                  nodes[(i, j + 1)]]))
+    divisions = []
+    while len(cells) > 1:
+        if len(cells) % 5 == 0:
+            divisions.append(MultiPolygon([cells.pop(0), cells.pop(-1)]))
+        else:
+            divisions.append(MultiPolygon([cells.pop(0)]))
+    divisions.append(MultiPolygon(cells))
+    # A division partially out of the raster
+    divisions.append(MultiPolygon([
+        Polygon([(9.5, 9.5), (11, 9.5), (11, 11), (9.5, 11)])]))
+    return divisions
+
+
+def make_array(seed, spikes, value=2.0, nodata=True):
+    random = np.random.RandomState(seed)
+    data = random.uniform(0, 0.9, shape).astype(np.float32)
+    data[random.uniform(0, 1, shape) < spikes] = value
+    mask = np.zeros(shape, dtype=np.bool)
+    if nodata:
+        mask[0:30, 0:30] = True
+        mask[random.uniform(0, 1, shape) < 0.2] = True
+    return np.ma.masked_array(data, mask)
+
+
+def make_processor(type, readers):
+    processor = Processor()
+    processor.settings = settings
+    processor.type_settings = settings['hazard_types'][type]
+    processor.readers = readers
+    processor.layers = {}
+    for key in readers.keys():
+        processor.layers[key] = Mock(
+            local=False,
+            hazardunit='m',
+            hazardlevel=HazardLevel.get(key) if key in LEVELS else None)
+    processor.bbox = polygon_from_boundingbox(readers.values()[0].bounds)
+    return processor
+
+
+class TestTileClassifier(unittest.TestCase):
+
+    def assertSameLevels(self, expected, actual):  # NOQA
+        self.assertEqual(
+            [None if level is None else level.mnemonic for level in expected],
+            [None if level is None else level.mnemonic for level in actual])
+
+    def test_notpreprocessed(self):
+        '''Test tile engine against polygon engine, not preprocessed'''
+        readers = {
+            u'HIG': ArrayReader(make_array(1, 0.001), transform),
+            u'MED': ArrayReader(make_array(2, 0.002), transform),
+            u'LOW': ArrayReader(make_array(3, 0.004), transform),
+            'mask': ArrayReader(make_array(4, 0.05), transform),
+        }
+        processor = make_processor('FL', readers)
+        divisions = make_divisions()
+
+        expected = [processor.notpreprocessed_hazardlevel('FL', division)
+                    for division in divisions]
+        levels = set(level.mnemonic for level in expected if level)
+        self.assertEqual(levels, set([u'HIG', u'MED', u'LOW', u'VLO']))
+        self.assertIn(None, expected)
+
+        for tile_size in (16, 37, 1024):
+            classifier = TileClassifier(processor, 'FL', tile_size=tile_size)
+            self.assertSameLevels(expected,
+                                  classifier.hazardlevels(divisions))
+
+    def test_preprocessed(self):
+        '''Test tile engine against polygon engine, preprocessed'''
+        random = np.random.RandomState(5)
+        data = random.choice([0, 5, 100, 101, 102],
+                             size=shape).astype(np.float32)
+        data[random.uniform(0, 1, shape) < 0.0005] = 103
+        mask = np.zeros(shape, dtype=np.bool)
+        mask[0:30, 0:30] = True
+        readers = {
+            0: ArrayReader(np.ma.masked_array(data, mask), transform)
+        }
+        processor = make_processor('VA', readers)
+        divisions = make_divisions()
+
+        expected = [processor.preprocessed_hazardlevel(division)
+                    for division in divisions]
+        self.assertIn(None, expected)
+
+        for tile_size in (16, 1024):
+            classifier = TileClassifier(processor, 'VA', tile_size=tile_size)
+            self.assertSameLevels(expected,
+                                  classifier.hazardlevels(divisions))
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def test_sub_windows(self):
+        '''Test windows are split within the budget and clipped'''
+        windows = sub_windows(((-5, 30), (10, 40)), shape, 100)
+        self.assertEqual(windows[0], ((0, 3), (10, 40)))
+        self.assertEqual(windows[-1], ((27, 30), (10, 40)))
+        self.assertEqual(len(windows), 10)
+        windows = sub_windows(((0, 2), (0, 100)), shape, 30)
+        self.assertEqual(windows, [((0, 1), (0, 30)), ((0, 1), (30, 60)),
+                                   ((0, 1), (60, 90)), ((0, 1), (90, 100)),
+                                   ((1, 2), (0, 30)), ((1, 2), (30, 60)),
+                                   ((1, 2), (60, 90)), ((1, 2), (90, 100))])
+
+    def test_notpreprocessed(self):
+        '''Test chunked reads against reads of whole windows, not
+        preprocessed'''
+        readers = {
+            u'HIG': ArrayReader(make_array(1, 0.001), transform),
+            u'MED': ArrayReader(make_array(2, 0.002), transform),
+            u'LOW': ArrayReader(make_array(3, 0.004), transform),
+            'mask': ArrayReader(make_array(4, 0.05), transform),
+        }
+        processor = make_processor('FL', readers)
+        divisions = make_divisions()
+        expected = [processor.notpreprocessed_hazardlevel('FL', division)
+                    for division in divisions]
+
+        for pixels in (7, 37, 200):
+            processor.window_budget = pixels * WINDOW_PIXEL_BYTES
+            self.assertEqual(
+                [processor.notpreprocessed_hazardlevel('FL', division)
+                 for division in divisions],
+                expected)
+
+    def test_preprocessed(self):
+        '''Test chunked reads against reads of whole windows,
+        preprocessed'''
+        random = np.random.RandomState(5)
+        data = random.choice([0, 5, 100, 101, 102],
+                             size=shape).astype(np.float32)
+        data[random.uniform(0, 1, shape) < 0.0005] = 103
+        readers = {
+            0: ArrayReader(np.ma.masked_array(data, data == 0), transform)
+        }
+        processor = make_processor('VA', readers)
+        divisions = make_divisions()
+        expected = [processor.preprocessed_hazardlevel(division)
+                    for division in divisions]
+
+        for pixels in (7, 37, 200):
+            processor.window_budget = pixels * WINDOW_PIXEL_BYTES
+            self.assertEqual([processor.preprocessed_hazardlevel(division)
+                              for division in divisions],
+                             expected)
+
+    def test_early_termination(self):
+        '''Test chunks are no longer read once a pixel is beyond the
+        threshold of the highest level'''
+        readers = {
+            u'HIG': ArrayReader(make_array(1, 0.001, nodata=False),
+                                transform),
+            u'MED': ArrayReader(make_array(2, 0.002), transform),
+            u'LOW': ArrayReader(make_array(3, 0.004), transform),
+        }
+        readers[u'HIG'].array[:] = 2.0
+        processor = make_processor('FL', readers)
+        processor.type_settings = dict(processor.type_settings)
+        del processor.type_settings['mask_return_period']
+        processor.window_budget = 100 * WINDOW_PIXEL_BYTES
+
+        division = MultiPolygon([polygon_from_boundingbox((1, 1, 9, 9))])
+        level = processor.notpreprocessed_hazardlevel('FL', division)
+        self.assertEqual(level.mnemonic, u'HIG')
+        self.assertEqual(readers[u'HIG'].reads, 1)
+        self.assertEqual(readers[u'MED'].reads, 0)
+
+
+class TestAntimeridian(unittest.TestCase):
+
+    def test_split(self):
+        '''Test polygons crossing the antimeridian are split'''
+        crossing = Polygon([(170, -10), (-170, -10), (-170, 10), (170, 10)])
+        other = polygon_from_boundingbox((0, 0, 10, 10))
+        antarctica = Polygon([(-180, -90), (180, -90), (180, -60),
+                              (0, -70), (-180, -60)])
+        result = split_antimeridian(MultiPolygon([crossing, other,
+                                                  antarctica]))
+        self.assertEqual([polygon.bounds for polygon in result.geoms],
+                         [(170, -10, 180, 10), (-180, -10, -170, 10),
+                          other.bounds, antarctica.bounds])
+
+    def test_windows(self):
+        '''Test only pixels near the antimeridian are read'''
+        global_transform = Affine(1.0, 0.0, -180.0, 0.0, -1.0, 90.0)
+        data = np.ma.masked_array(np.zeros((180, 360), dtype=np.float32))
+        # Beyond threshold in the middle of the globe, and near -180
+        data[80, 180] = 2.0
+        readers = {
+            u'HIG': ArrayReader(data.copy(), global_transform),
+            u'MED': ArrayReader(data.copy(), global_transform),
+            u'LOW': ArrayReader(data.copy(), global_transform),
+        }
+        widths = []
+        for reader in readers.values():
+            read = reader.read
+
+            def read_window(indexes, window=None, masked=False, read=read):
+                widths.append(window[1][1] - window[1][0])
+                return read(indexes, window=window, masked=masked)
+            reader.read = read_window
+        processor = make_processor('FL', readers)
+        processor.type_settings = dict(processor.type_settings)
+        del processor.type_settings['mask_return_period']
+
+        geometry = MultiPolygon([
+            Polygon([(170, -10), (-170, -10), (-170, 10), (170, 10)])])
+        division = processor.division_geometry(geometry, 'fingerprint')
+        self.assertEqual(
+            processor.notpreprocessed_hazardlevel('FL', division).mnemonic,
+            u'VLO')
+        self.assertLessEqual(max(widths), 10)
+        # Split once per division geometry
+        self.assertIs(processor.division_geometry(geometry, 'fingerprint'),
+                      division)
+
+        readers[u'HIG'].array[80, 5] = 2.0
+        self.assertEqual(
+            processor.notpreprocessed_hazardlevel('FL', division).mnemonic,
+            u'HIG')
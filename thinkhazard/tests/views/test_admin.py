@@ -68,6 +68,16 @@ class TestAdminFunction(BaseTestCase):
         form['associations'] = ['EQ - MED', 'EQ - LOW']
         form.submit(status=302)
 
+    def test_simulation(self):
+        resp = self.testapp.post('/simulation',
+                                 'hazard_types:\n  EQ:\n    values: {}\n',
+                                 content_type='application/x-yaml',
+                                 status=200)
+        self.assertIn('countries', resp.json)
+        self.testapp.post('/simulation', '- a',
+                          content_type='application/x-yaml',
+                          status=400)
+
     def test_climate_rec(self):
         self.testapp.get('/climate_rec', status=302)
 
@@ -33,6 +33,7 @@ from sqlalchemy import (
 from sqlalchemy.orm import contains_eager, joinedload
 
 import json
+import yaml
 
 from ..models import (
     DBSession,
@@ -234,6 +235,21 @@ def hazardset(request):
     }
 
 
+@view_config(route_name='admin_simulation', request_method='POST',
+             renderer='json')
+def simulation(request):
+    """Divisions which would change level with the processing settings
+    posted, in YAML, by hazard type and country"""
+    # Imported here to keep the processing engine (rasterio, numpy) out of
+    # the web application until the simulation is requested
+    from ..processing.simulation import load_hazard_types, simulate
+    try:
+        hazard_types = load_hazard_types(request.body)
+    except (ValueError, yaml.YAMLError) as e:
+        raise HTTPBadRequest(detail=str(e))
+    return simulate(hazard_types, request.params.get('hazardtype'))
+
+
 @view_config(route_name='admin_admindiv_hazardsets')
 def admindiv_hazardsets(request):
     hazardtype = DBSession.query(HazardType).first()